@@ -0,0 +1,253 @@
+"""
+Benchmark of clusterlib.storage with concurrent writer and reader processes.
+
+Writers dump batches of values with sqlite3_dumps while readers load batches
+of keys with sqlite3_loads, against a database in a given directory, e.g. a
+tmpfs, a local disk or a NFS mount. Each combination of value size, batch
+size and journal mode is run on a fresh database. Throughput, latency
+percentiles and lock timeouts are reported as JSON.
+
+Example::
+
+    python benchmarks/bench_storage.py --directory /nfs/scratch \\
+        --writers 8 --readers 2 --value-sizes 100 100000 \\
+        --batch-sizes 1 100 --journal-modes delete wal --output bench.json
+
+"""
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import time
+from itertools import product
+from multiprocessing import Event
+from multiprocessing import Process
+from multiprocessing import Queue
+from tempfile import mkdtemp
+
+try:
+    from queue import Empty
+except ImportError:  # Python 2
+    from Queue import Empty
+
+from clusterlib.storage import sqlite3_dumps
+from clusterlib.storage import sqlite3_loads
+
+
+def _is_lock_timeout(exception):
+    """Check if a sqlite3 error is due to the lock timeout."""
+    return "locked" in str(exception) or "busy" in str(exception)
+
+
+def writer(file_name, worker_id, n_batches, batch_size, value_size, timeout,
+           start, results):
+    """Dump n_batches of batch_size values and report the latencies."""
+    value = os.urandom(value_size)
+    latencies = []
+    lock_timeouts = 0
+
+    start.wait()
+    for batch in range(n_batches):
+        data = dict(("w%s-b%s-k%s" % (worker_id, batch, i), value)
+                    for i in range(batch_size))
+        tic = time.time()
+        try:
+            sqlite3_dumps(data, file_name, timeout=timeout)
+            latencies.append(time.time() - tic)
+        except sqlite3.OperationalError as exception:
+            if not _is_lock_timeout(exception):
+                raise
+            lock_timeouts += 1
+
+    results.put(("write", latencies, lock_timeouts))
+
+
+def reader(file_name, worker_id, n_writers, n_batches, batch_size, timeout,
+           start, stop, results):
+    """Load batches of keys until the writers are done."""
+    rng = random.Random(worker_id)
+    latencies = []
+    n_values = 0
+    lock_timeouts = 0
+
+    start.wait()
+    while not stop.is_set():
+        keys = ["w%s-b%s-k%s" % (rng.randrange(n_writers),
+                                 rng.randrange(n_batches),
+                                 rng.randrange(batch_size))
+                for _ in range(batch_size)]
+        tic = time.time()
+        try:
+            n_values += len(sqlite3_loads(file_name, keys, timeout=timeout))
+            latencies.append(time.time() - tic)
+        except sqlite3.OperationalError as exception:
+            if not _is_lock_timeout(exception):
+                raise
+            lock_timeouts += 1
+
+    results.put(("read", latencies, lock_timeouts, n_values))
+
+
+def _gather(results, processes, n_results):
+    """Gather the measures of the workers, failing if one has crashed."""
+    measures = []
+    while len(measures) < n_results:
+        try:
+            measures.append(results.get(timeout=1.))
+        except Empty:
+            for process in processes:
+                if process.exitcode not in (None, 0):
+                    raise RuntimeError("The worker %s has exited with code "
+                                       "%s" % (process.name,
+                                               process.exitcode))
+    return measures
+
+
+def _percentile(values, q):
+    """Percentile q of the values using the nearest rank method."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(q / 100. * len(values))) - 1, 0)
+    return values[rank]
+
+
+def _summary(latencies, lock_timeouts, n_values, value_size, duration):
+    """Summarize the measures of a kind of operation."""
+    return {
+        "n_calls": len(latencies),
+        "n_values": n_values,
+        "values_per_second": n_values / duration,
+        "megabytes_per_second": n_values * value_size / duration / 1e6,
+        "latency_p50": _percentile(latencies, 50),
+        "latency_p99": _percentile(latencies, 99),
+        "latency_max": max(latencies) if latencies else None,
+        "lock_timeouts": lock_timeouts,
+    }
+
+
+def run(directory, n_writers, n_readers, n_batches, batch_size, value_size,
+        journal_mode, page_size, timeout):
+    """Run one benchmark configuration on a fresh database."""
+    temp_folder = mkdtemp(prefix="bench_storage_", dir=directory)
+    try:
+        file_name = os.path.join(temp_folder, "bench.sqlite3")
+        connection = sqlite3.connect(file_name)
+        if page_size is not None:
+            connection.execute("PRAGMA page_size = %d" % page_size)
+        connection.execute("PRAGMA journal_mode = %s" % journal_mode)
+        connection.execute("""CREATE TABLE IF NOT EXISTS dict
+                              (key TEXT PRIMARY KEY, value BLOB)""")
+        connection.commit()
+        connection.close()
+
+        start, stop, results = Event(), Event(), Queue()
+        writers = [Process(target=writer,
+                           args=(file_name, i, n_batches, batch_size,
+                                 value_size, timeout, start, results))
+                   for i in range(n_writers)]
+        readers = [Process(target=reader,
+                           args=(file_name, i, n_writers, n_batches,
+                                 batch_size, timeout, start, stop, results))
+                   for i in range(n_readers)]
+        processes = writers + readers
+        for process in processes:
+            process.start()
+
+        try:
+            tic = time.time()
+            start.set()
+            measures = _gather(results, processes, len(writers))
+            duration = time.time() - tic
+            stop.set()
+            measures.extend(_gather(results, processes, len(readers)))
+            for process in processes:
+                process.join()
+        finally:
+            # The remaining workers are stopped if one of them has crashed
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        write_latencies, read_latencies = [], []
+        write_timeouts = read_timeouts = n_read = 0
+        for measure in measures:
+            if measure[0] == "write":
+                write_latencies.extend(measure[1])
+                write_timeouts += measure[2]
+            else:
+                read_latencies.extend(measure[1])
+                read_timeouts += measure[2]
+                n_read += measure[3]
+
+        return {
+            "writers": n_writers,
+            "readers": n_readers,
+            "n_batches": n_batches,
+            "batch_size": batch_size,
+            "value_size": value_size,
+            "journal_mode": journal_mode,
+            "page_size": page_size,
+            "timeout": timeout,
+            "duration": duration,
+            "file_size": os.path.getsize(file_name),
+            "write": _summary(write_latencies, write_timeouts,
+                              len(write_latencies) * batch_size, value_size,
+                              duration),
+            "read": _summary(read_latencies, read_timeouts, n_read,
+                             value_size, duration),
+        }
+    finally:
+        shutil.rmtree(temp_folder)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--directory", default=".",
+                        help="Directory of the databases, e.g. a NFS mount.")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=2)
+    parser.add_argument("--n-batches", type=int, default=20,
+                        help="Number of batches dumped by each writer.")
+    parser.add_argument("--value-sizes", type=int, nargs="+",
+                        default=[100, 100000], help="Value sizes in bytes.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=[1, 100], help="Number of keys per call.")
+    parser.add_argument("--journal-modes", nargs="+",
+                        default=["delete", "wal"])
+    parser.add_argument("--page-size", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=60.,
+                        help="Lock timeout of each call in seconds.")
+    parser.add_argument("--output", default=None,
+                        help="JSON file of the results, stdout by default.")
+    args = parser.parse_args(argv)
+
+    results = []
+    for value_size, batch_size, journal_mode in product(
+            args.value_sizes, args.batch_sizes, args.journal_modes):
+        print("value_size=%s batch_size=%s journal_mode=%s"
+              % (value_size, batch_size, journal_mode), file=sys.stderr)
+        results.append(run(args.directory, args.writers, args.readers,
+                           args.n_batches, batch_size, value_size,
+                           journal_mode, args.page_size, args.timeout))
+
+    report = json.dumps({"sqlite_version": sqlite3.sqlite_version,
+                         "python_version": sys.version.split()[0],
+                         "results": results}, indent=2, sort_keys=True)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as fhandle:
+            fhandle.write(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,11 @@ Note: this module has a dependency on the nose package.
 # Authors: Olivier Grisel
 #
 # License: BSD 3 clause
+import glob
 import shutil
 import os
 import warnings
+from contextlib import contextmanager
 from tempfile import mkdtemp
 
 from nose import SkipTest
@@ -72,6 +74,76 @@ class TemporaryDirectory(object):
             self._closed = True
 
 
+def fake_executable(directory, name, output="", returncode=0, run=False):
+    """Write an executable faking a command of the scheduler.
+
+    Each call of the executable appends its arguments as a line of
+    ``name.calls``, writes them one per line in ``name.argv``, saves its
+    standard input in ``name.stdin``, prints the output and exits with the
+    return code. The records of a previous fake of the same name are reset.
+
+    Parameters
+    ----------
+    directory : str
+        Absolute path to the folder of the executable and of its records.
+
+    name : str
+        Name of the command, e.g. "sbatch".
+
+    output : str or list of str, optional (default="")
+        Output of the command. If a list, the i-th call prints the i-th
+        output and the following calls print the last one.
+
+    returncode : int, optional (default=0)
+        Exit status of the command.
+
+    run : bool, optional (default=False)
+        Whether the standard input is run as a shell script, as a scheduler
+        runs a job script, instead of being saved.
+
+    """
+    prefix = os.path.join(directory, name)
+    for file_name in glob.glob(prefix + ".out*") + glob.glob(prefix +
+                                                            ".calls"):
+        os.remove(file_name)
+
+    outputs = [output] if isinstance(output, type("")) else list(output)
+    for i, text in enumerate(outputs):
+        with open("%s.out.%s" % (prefix, i + 1), "w") as fhandle:
+            fhandle.write(text)
+    with open(prefix + ".out", "w") as fhandle:
+        fhandle.write(outputs[-1] if outputs else "")
+
+    with open(prefix, "w") as fhandle:
+        fhandle.write('#!/bin/sh\n'
+                      'echo "$*" >> "{0}.calls"\n'
+                      'printf "%s\\n" "$@" > "{0}.argv"\n'
+                      'n=$(($(wc -l < "{0}.calls")))\n'
+                      '{1}\n'
+                      'if [ -f "{0}.out.$n" ]; then\n'
+                      '    cat "{0}.out.$n"\n'
+                      'else\n'
+                      '    cat "{0}.out"\n'
+                      'fi\n'
+                      'exit {2}\n'.format(
+                          prefix,
+                          "bash -s > /dev/null 2>&1" if run
+                          else 'cat > "%s.stdin"' % prefix,
+                          returncode))
+    os.chmod(prefix, 0o755)
+
+
+@contextmanager
+def prepend_path(directory):
+    """Look for executables in a folder first, e.g. fake commands."""
+    path = os.environ.get("PATH", "")
+    os.environ["PATH"] = directory + os.pathsep + path
+    try:
+        yield
+    finally:
+        os.environ["PATH"] = path
+
+
 def _skip_if_no_backend():
     """Test decorator to skip test if no backend is available."""
     # Note that we can't use _get_backend since the user might
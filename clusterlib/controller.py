@@ -0,0 +1,357 @@
+"""
+This module allows to keep a number of jobs in flight until all the tasks
+of a sweep are done.
+
+Instead of submitting all the missing jobs at once, which floods the queue,
+a controller submits new jobs as earlier ones end. The completion of a task
+is checked in a :mod:`clusterlib.storage` database, as in the launcher
+pattern of the user guide, while the states of the jobs in flight are
+queried at a low rate with :func:`clusterlib.scheduler.job_states`. The
+state of the controller is persisted, so that a restarted controller
+resumes where it stopped.
+
+"""
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+from __future__ import unicode_literals
+
+import json
+import os
+import subprocess
+import time
+import warnings
+from collections import deque
+from getpass import getuser
+from itertools import islice
+from tempfile import mkstemp
+
+from .scheduler import _ACTIVE_STATES
+from .scheduler import job_states
+from .scheduler import launch
+from .scheduler import queued_or_running_jobs
+from .storage import sqlite3_contains
+
+
+__all__ = [
+    "Controller",
+]
+
+_replace = getattr(os, "replace", os.rename)
+
+# Maximal number of job ids given to a single query of the scheduler
+_BATCH_SIZE = 500
+
+
+class Controller(object):
+    """Submit the jobs of a sweep while keeping a number of them in flight.
+
+    A task in flight is done whenever its key is stored in the ``storage``
+    database. A task whose job has left the queue without being done has
+    failed, it is submitted again up to ``max_retries`` times. While the
+    scheduler can not be queried, the tasks in flight are left unchanged.
+
+    If a submission fails, e.g. the scheduler is unavailable, a warning is
+    raised and the next submissions are delayed by ``poll_interval``
+    seconds, twice as long after each failure up to 16 times longer.
+
+    Parameters
+    ----------
+    tasks : iterable of (job_name, job_command)
+        Tasks of the sweep, possibly a generator. After a restart, the
+        iterable must yield the same tasks in the same order.
+
+    state_file : str
+        JSON file where the state of the controller is persisted.
+
+    storage : str or None, optional (default=None)
+        Path to the sqlite database where the tasks store their results. If
+        None, a task is considered done as soon as it has left the queue.
+
+    n_in_flight : int, optional (default=100)
+        Number of jobs kept in flight.
+
+    max_submit_jobs : int or None, optional (default=None)
+        Maximal number of queued or running jobs of the user, e.g. the
+        MaxSubmitJobs limit of SLURM. Jobs which are not submitted by the
+        controller are also counted.
+
+    max_retries : int, optional (default=0)
+        Maximal number of resubmissions of a failed task.
+
+    poll_interval : float, optional (default=60.)
+        Delay in seconds between two checks of the completion of the tasks.
+
+    queue_poll_interval : float, optional (default=300.)
+        Minimal delay in seconds between two queries of the scheduler.
+
+    key : callable or None, optional (default=None)
+        Return the key of a task in the storage given its job name and job
+        command. If None, the key is the job command.
+
+    launch_params : dict or None, optional (default=None)
+        Further parameters of :func:`clusterlib.scheduler.launch`, e.g.
+        ``{"time": "01:00:00", "memory": 8000}``.
+
+    Attributes
+    ----------
+    in_flight : dict
+        Job name, command, id, submission time and number of attempts of
+        the tasks in flight indexed by their job name.
+
+    failed : dict
+        Job command of the failed tasks indexed by their job name.
+
+    n_done : int
+        Number of tasks done since the first start.
+
+    Examples
+    --------
+    >>> from clusterlib.controller import Controller
+    >>> tasks = (("job-param=%s" % param,
+    ...           "python clusterlib_main.py --param %s" % param)
+    ...          for param in range(10000))
+    >>> controller = Controller(tasks, "controller.json",
+    ...                         storage="results.sqlite3",
+    ...                         n_in_flight=500)  # doctest: +SKIP
+    >>> controller.run()  # doctest: +SKIP
+
+    """
+
+    def __init__(self, tasks, state_file, storage=None, n_in_flight=100,
+                 max_submit_jobs=None, max_retries=0, poll_interval=60.,
+                 queue_poll_interval=300., key=None, launch_params=None):
+        if n_in_flight < 1:
+            raise ValueError("n_in_flight should be positive, got %r"
+                             % n_in_flight)
+        self.state_file = state_file
+        self.storage = storage
+        self.n_in_flight = n_in_flight
+        self.max_submit_jobs = max_submit_jobs
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self.queue_poll_interval = queue_poll_interval
+        self.key = key
+        self.launch_params = launch_params or {}
+        self.user = getuser()
+
+        self.position = 0
+        self.in_flight = {}
+        self.failed = {}
+        self.n_done = 0
+        # Failed tasks waiting for their next submission
+        self._retries = []
+        if os.path.exists(state_file):
+            with open(state_file) as fhandle:
+                state = json.load(fhandle)
+            self.position = state["position"]
+            self.in_flight = state["in_flight"]
+            self.failed = state["failed"]
+            self.n_done = state["n_done"]
+            self._retries = state.get("retries", [])
+
+        # Skip the tasks already submitted before a restart. The tasks read
+        # but not yet submitted nor skipped are pending.
+        self._tasks = islice(iter(tasks), self.position, None)
+        self._pending = deque()
+        self._exhausted = False
+        self._queue = set()
+        self._queue_time = None
+        # States of the jobs in flight at the last query of the scheduler,
+        # and ids of the jobs whose state could be queried.
+        self._states = {}
+        self._queried = set()
+        self._submit_delay = 0.
+        self._submit_time = None
+
+    def _task_key(self, job_name, job_command):
+        if self.key is None:
+            return job_command
+        return self.key(job_name, job_command)
+
+    def _done_keys(self, keys):
+        if self.storage is None:
+            return set()
+        return sqlite3_contains(self.storage, keys)
+
+    def _save(self):
+        """Write atomically the state of the controller."""
+        directory, base_name = os.path.split(os.path.abspath(self.state_file))
+        fd, tmp_name = mkstemp(prefix="." + base_name, dir=directory)
+        with os.fdopen(fd, "w") as fhandle:
+            json.dump({"position": self.position,
+                       "in_flight": self.in_flight,
+                       "failed": self.failed,
+                       "n_done": self.n_done,
+                       "retries": self._retries}, fhandle)
+        _replace(tmp_name, self.state_file)
+
+    def _refresh_queue(self):
+        """Query the scheduler if the last query is old enough."""
+        now = time.time()
+        if (self._queue_time is not None and
+                now - self._queue_time < self.queue_poll_interval):
+            return
+
+        # The jobs of the user are only needed to skip the tasks already
+        # queued and to count the jobs submitted by others, the previous
+        # answer is kept if the query fails.
+        try:
+            self._queue = set(queued_or_running_jobs(user=self.user))
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+        job_ids = sorted(set(task["job_id"]
+                             for task in self.in_flight.values()))
+        backend = self.launch_params.get("backend", "auto")
+        self._states = {}
+        self._queried = set()
+        for start in range(0, len(job_ids), _BATCH_SIZE):
+            batch = job_ids[start:start + _BATCH_SIZE]
+            try:
+                self._states.update(job_states(batch, backend=backend))
+            except RuntimeError:
+                # The scheduler is unavailable for now, the tasks of these
+                # jobs are left unchanged.
+                continue
+            self._queried.update(batch)
+        self._queue_time = now
+
+    def _check_in_flight(self):
+        """Forget the tasks which are done and retry the failed ones."""
+        tasks = list(self.in_flight.values())
+        done = self._done_keys([self._task_key(task["job_name"],
+                                               task["job_command"])
+                                for task in tasks])
+        for task in tasks:
+            job_name = task["job_name"]
+            if self._task_key(job_name, task["job_command"]) in done:
+                del self.in_flight[job_name]
+                self.n_done += 1
+
+            # Only the jobs submitted before the last query of the
+            # scheduler can have left the queue.
+            elif (task["submit_time"] < self._queue_time and
+                    task["job_id"] in self._queried and
+                    self._states.get(task["job_id"]) not in _ACTIVE_STATES):
+                del self.in_flight[job_name]
+                if self.storage is None:
+                    self.n_done += 1
+                elif task["n_attempts"] <= self.max_retries:
+                    self._retries.append([job_name, task["job_command"],
+                                          task["n_attempts"] + 1])
+                else:
+                    self.failed[job_name] = task["job_command"]
+
+    def _submit(self, job_name, job_command, n_attempts=1):
+        """Submit a task and record it as in flight."""
+        params = dict(self.launch_params, job_name=job_name)
+        job_id = launch(job_command, **params)
+        self.in_flight[job_name] = {"job_name": job_name,
+                                    "job_command": job_command,
+                                    "job_id": job_id,
+                                    "submit_time": time.time(),
+                                    "n_attempts": n_attempts}
+
+    def _try_submit(self, job_name, job_command, n_attempts=1):
+        """Submit a task, or delay the next submissions if it fails."""
+        try:
+            self._submit(job_name, job_command, n_attempts)
+        except (RuntimeError, OSError) as exception:
+            self._submit_delay = min(2 * self._submit_delay or
+                                     self.poll_interval,
+                                     16 * self.poll_interval)
+            self._submit_time = time.time() + self._submit_delay
+            warnings.warn("Failed to submit the job %s, next attempt in %s "
+                          "seconds: %s" % (job_name, self._submit_delay,
+                                           exception))
+            return False
+
+        self._submit_delay = 0.
+        return True
+
+    def _n_slots(self):
+        """Number of jobs which can be submitted."""
+        n_slots = self.n_in_flight - len(self.in_flight)
+        if self.max_submit_jobs is not None:
+            # The queue does not know yet the jobs submitted since its
+            # last query.
+            n_recent = sum(task["submit_time"] >= self._queue_time
+                           for task in self.in_flight.values())
+            n_slots = min(n_slots, self.max_submit_jobs - len(self._queue) -
+                          n_recent)
+        return n_slots
+
+    def _fill(self):
+        """Submit new tasks until the number of jobs in flight is reached."""
+        while self._n_slots() > 0:
+            if (self._submit_time is not None and
+                    time.time() < self._submit_time):
+                return
+
+            # Failed tasks are submitted again first
+            if self._retries:
+                if not self._try_submit(*self._retries[0]):
+                    return
+                self._retries.pop(0)
+                self._save()
+                continue
+
+            if not self._pending:
+                if self._exhausted:
+                    return
+                n_slots = self._n_slots()
+                tasks = list(islice(self._tasks, n_slots))
+                if len(tasks) < n_slots:
+                    self._exhausted = True
+                done = self._done_keys([self._task_key(job_name, job_command)
+                                        for job_name, job_command in tasks])
+                self._pending.extend(
+                    (job_name, job_command,
+                     self._task_key(job_name, job_command) in done)
+                    for job_name, job_command in tasks)
+                continue
+
+            # Tasks done or queued, e.g. before a restart, are skipped
+            job_name, job_command, is_done = self._pending[0]
+            submitted = False
+            if is_done:
+                self.n_done += 1
+            elif (job_name not in self._queue and
+                    job_name not in self.in_flight):
+                if not self._try_submit(job_name, job_command):
+                    return
+                submitted = True
+            self._pending.popleft()
+            self.position += 1
+            if submitted:
+                self._save()
+
+    def step(self):
+        """Check the tasks in flight and submit new ones.
+
+        Returns
+        -------
+        remaining : bool
+            Whether some tasks are still in flight or to be submitted.
+
+        """
+        self._refresh_queue()
+        self._check_in_flight()
+        self._fill()
+        self._save()
+        return (bool(self.in_flight or self._pending or self._retries) or
+                not self._exhausted)
+
+    def run(self):
+        """Keep jobs in flight until all the tasks are done or failed.
+
+        Returns
+        -------
+        failed : dict
+            Job command of the failed tasks indexed by their job name.
+
+        """
+        while self.step():
+            time.sleep(self.poll_interval)
+        return self.failed
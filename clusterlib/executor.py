@@ -0,0 +1,340 @@
+"""
+This module allows to run Python callables as jobs through the standard
+:mod:`concurrent.futures` interface.
+
+The callables and their arguments are pickled into a directory shared with
+the computing nodes, where a generic runner, ``python -m
+clusterlib.executor``, executes them and pickles their outcome. Futures are
+resolved by a thread polling this directory.
+
+"""
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+from __future__ import unicode_literals
+
+import os
+import pickle
+import sys
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from tempfile import mkstemp
+
+try:
+    from shlex import quote
+except ImportError:  # Python 2
+    from pipes import quote
+
+from .scheduler import _ACTIVE_STATES
+from .scheduler import job_states
+from .scheduler import launch
+
+
+__all__ = [
+    "ClusterExecutor",
+]
+
+_replace = getattr(os, "replace", os.rename)
+
+
+def _run_calls(task_file):
+    """Run the calls of a task file and pickle their outcome atomically."""
+    with open(task_file, "rb") as fhandle:
+        fn, calls = pickle.load(fhandle)
+
+    outcomes = []
+    for args, kwargs in calls:
+        try:
+            outcomes.append((True, fn(*args, **kwargs)))
+        except Exception as exception:
+            try:
+                pickle.dumps(exception)
+            except Exception:
+                exception = RuntimeError(traceback.format_exc())
+            outcomes.append((False, exception))
+
+    result_file = os.path.splitext(task_file)[0] + ".result"
+    fd, temp_file = mkstemp(dir=os.path.dirname(result_file),
+                            suffix=".tmp")
+    with os.fdopen(fd, "wb") as fhandle:
+        pickle.dump(outcomes, fhandle, pickle.HIGHEST_PROTOCOL)
+    _replace(temp_file, result_file)
+
+
+class ClusterExecutor(Executor):
+    """Executor running callables as jobs of a cluster.
+
+    Each call of :meth:`submit`, or each chunk of calls of :meth:`map`,
+    is submitted as a job with :func:`clusterlib.scheduler.launch`. The
+    callables and their arguments must be picklable, and importable from
+    the computing nodes, which run the jobs from the current working
+    directory.
+
+    A job is considered lost if it has left the queue of the scheduler
+    without any outcome, e.g. it was killed for exceeding its time limit.
+    The futures of a lost job raise a RuntimeError. The states of the jobs
+    are queried with :func:`clusterlib.scheduler.job_states`, and no job is
+    considered lost while the scheduler can not be queried.
+
+    Parameters
+    ----------
+    directory : str
+        Directory where the calls and their outcome are pickled. It must be
+        accessible from the computing nodes.
+
+    job_name : str, optional (default="executor")
+        Prefix of the names of the jobs.
+
+    time : str, optional (default="24:00:00")
+        Maximum time format "HH:MM:SS" of each job.
+
+    memory : str, optional (default=4000)
+        Maximum virtual memory in mega-bytes of each job.
+
+    log_directory : str, optional (default=None)
+        Specify the log directory. If None, no log directory is specified.
+
+    backend : {'auto', 'slurm', 'sge', 'local'}, optional (default="auto")
+        Backend where the jobs will be submitted, see
+        :func:`clusterlib.scheduler.submit`.
+
+    options : list of str or None, optional (default=None)
+        Further arguments given to the launcher.
+
+    poll_interval : float, optional (default=10.)
+        Delay in seconds between two checks of the outcome of the jobs.
+
+    Examples
+    --------
+    >>> from clusterlib.executor import ClusterExecutor
+    >>> with ClusterExecutor("executor") as executor:  # doctest: +SKIP
+    ...     print(list(executor.map(pow, range(4), range(4), chunksize=2)))
+    [1, 1, 4, 27]
+
+    """
+
+    def __init__(self, directory, job_name="executor", time="24:00:00",
+                 memory=4000, log_directory=None, backend="auto",
+                 options=None, poll_interval=10.):
+        self.directory = os.path.abspath(directory)
+        self.job_name = job_name
+        self.time = time
+        self.memory = memory
+        self.log_directory = log_directory
+        self.backend = backend
+        self.options = options
+        self.poll_interval = poll_interval
+
+        # Futures and job id of the pending jobs, and number of consecutive
+        # checks for which each job was neither queued nor done
+        self._jobs = {}
+        self._job_ids = {}
+        self._n_missing = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._shutdown = False
+
+    def _file(self, job_name, extension):
+        return os.path.join(self.directory, job_name + extension)
+
+    def _submit_calls(self, fn, calls):
+        """Submit a job running the calls and return their futures."""
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit after shutdown.")
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        job_name = "%s.%s" % (self.job_name, uuid.uuid4().hex)
+        task_file = self._file(job_name, ".task")
+        with open(task_file, "wb") as fhandle:
+            pickle.dump((fn, calls), fhandle, pickle.HIGHEST_PROTOCOL)
+
+        job_command = "cd %s && %s -m clusterlib.executor %s" % (
+            quote(os.getcwd()), quote(sys.executable), quote(task_file))
+        try:
+            job_id = launch(job_command, job_name=job_name, time=self.time,
+                            memory=self.memory,
+                            log_directory=self.log_directory,
+                            backend=self.backend, options=self.options)
+        except Exception:
+            os.remove(task_file)
+            raise
+
+        futures = [Future() for _ in calls]
+        with self._lock:
+            self._jobs[job_name] = futures
+            self._job_ids[job_name] = job_id
+            self._n_missing[job_name] = 0
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll)
+                self._thread.daemon = True
+                self._thread.start()
+        return futures
+
+    def submit(self, fn, *args, **kwargs):
+        """Submit a job running ``fn(*args, **kwargs)``.
+
+        Returns
+        -------
+        future : Future
+            Future of the outcome of the call.
+
+        """
+        return self._submit_calls(fn, [(args, kwargs)])[0]
+
+    def map(self, fn, *iterables, **kwargs):
+        """Return an iterator equivalent to ``map(fn, *iterables)``.
+
+        Parameters
+        ----------
+        fn : callable
+            Callable applied to the items of the iterables.
+
+        *iterables : iterables
+            Arguments of the calls.
+
+        timeout : float or None, optional (default=None)
+            Maximal number of seconds to wait for the outcomes. If None,
+            wait without limit.
+
+        chunksize : int, optional (default=1)
+            Number of calls run by each job.
+
+        Returns
+        -------
+        results : iterator
+            Outcome of each call, in the order of the arguments. If a call
+            raised an exception, it is raised when its outcome is reached.
+
+        """
+        timeout = kwargs.pop("timeout", None)
+        chunksize = kwargs.pop("chunksize", 1)
+        if kwargs:
+            raise TypeError("Unexpected arguments: %s" % ", ".join(kwargs))
+        if chunksize < 1:
+            raise ValueError("chunksize should be positive, got %r"
+                             % chunksize)
+
+        end_time = None if timeout is None else timeout + time.time()
+        calls = [(args, {}) for args in zip(*iterables)]
+        futures = []
+        for start in range(0, len(calls), chunksize):
+            futures.extend(self._submit_calls(fn,
+                                              calls[start:start + chunksize]))
+
+        def result_iterator():
+            try:
+                for future in futures:
+                    if end_time is None:
+                        yield future.result()
+                    else:
+                        yield future.result(end_time - time.time())
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        return result_iterator()
+
+    def shutdown(self, wait=True):
+        """Stop accepting calls once the pending jobs are done.
+
+        Parameters
+        ----------
+        wait : bool, optional (default=True)
+            Whether to wait until the outcome of all pending jobs is known.
+
+        """
+        with self._lock:
+            self._shutdown = True
+            thread = self._thread
+        self._wakeup.set()
+        if wait and thread is not None:
+            thread.join()
+
+    def _poll(self):
+        """Resolve the futures of the jobs until shutdown."""
+        while True:
+            with self._lock:
+                if self._shutdown and not self._jobs:
+                    return
+                job_names = list(self._jobs)
+
+            if job_names:
+                self._check(job_names)
+
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _check(self, job_names):
+        """Resolve the futures of the jobs which are done or lost."""
+        job_ids = {}
+        for job_name in job_names:
+            if os.path.exists(self._file(job_name, ".result")):
+                self._resolve(job_name)
+            else:
+                with self._lock:
+                    job_ids[job_name] = self._job_ids[job_name]
+        if not job_ids:
+            return
+
+        try:
+            states = job_states(sorted(set(job_ids.values())),
+                                backend=self.backend)
+        except RuntimeError:
+            # The scheduler is unavailable for now, only the outcomes are
+            # checked.
+            return
+
+        for job_name, job_id in job_ids.items():
+            # A job which has just ended might have left the queue while
+            # its outcome was being checked, thus a job is only considered
+            # lost after two consecutive checks.
+            if states.get(job_id) in _ACTIVE_STATES:
+                self._n_missing[job_name] = 0
+            else:
+                self._n_missing[job_name] += 1
+                if self._n_missing[job_name] >= 2:
+                    self._resolve(job_name, lost=True)
+
+    def _resolve(self, job_name, lost=False):
+        """Set the outcome of the futures of a job and remove its files."""
+        with self._lock:
+            futures = self._jobs.pop(job_name)
+            del self._job_ids[job_name]
+            del self._n_missing[job_name]
+
+        if lost:
+            outcomes = [(False, RuntimeError(
+                "The job %s has left the queue without any outcome, see its "
+                "log for details." % job_name))] * len(futures)
+        else:
+            try:
+                with open(self._file(job_name, ".result"), "rb") as fhandle:
+                    outcomes = pickle.load(fhandle)
+            except Exception as exception:
+                outcomes = [(False, exception)] * len(futures)
+
+        for future, (success, value) in zip(futures, outcomes):
+            # Cancelled futures are left as they are
+            if future.set_running_or_notify_cancel():
+                if success:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+        for extension in [".task", ".result"]:
+            try:
+                os.remove(self._file(job_name, extension))
+            except OSError:
+                pass
+
+
+if __name__ == "__main__":
+    _run_calls(sys.argv[1])
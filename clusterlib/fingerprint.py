@@ -0,0 +1,293 @@
+"""
+This module allows to compute stable fingerprints of job parameters.
+
+Fingerprints are the same across processes, hosts and Python versions,
+contrary to the built-in ``hash`` which is salted for each process. They
+can be used as unique job names or as keys in a :mod:`clusterlib.storage`
+database.
+
+Supported objects are None, booleans, numbers, strings, bytes, lists,
+tuples, dicts, sets and NumPy arrays and scalars, possibly nested. The data
+of NumPy arrays is hashed by chunks without being copied whenever they are
+contiguous, and the fingerprint of read-only arrays is cached while they
+stay read-only.
+
+"""
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+from __future__ import unicode_literals
+
+import hashlib
+import re
+import sys
+import weakref
+
+from .storage import sqlite3_dumps
+
+
+__all__ = [
+    "fingerprint",
+    "job_name",
+    "sqlite3_dumps_index",
+]
+
+# Number of bytes of array data hashed at once
+_CHUNK_SIZE = 2 ** 24
+
+# Fingerprints of the read-only arrays indexed by their id
+_ARRAY_CACHE = {}
+
+# Characters allowed in job names by every scheduler
+_INVALID_NAME_CHARACTERS = re.compile(r"[^A-Za-z0-9_.=+-]")
+
+_TEXT_TYPE = type("")
+try:
+    _INTEGER_TYPES = (int, long)
+except NameError:  # Python 3
+    _INTEGER_TYPES = (int, )
+
+
+def _sized(tag, data):
+    return tag + str(len(data)).encode("ascii") + b":" + data
+
+
+def _digest(obj):
+    hasher = hashlib.sha1()
+    _update(hasher, obj)
+    return hasher.digest()
+
+
+def _is_frozen(array):
+    """Whether the data of the array can not be modified.
+
+    The array and all its bases must be read-only arrays: a base which is
+    another kind of buffer, e.g. a bytearray, might be modified. Arrays of
+    objects are never frozen since their items might be modified.
+    """
+    if array.dtype.hasobject:
+        return False
+    while array is not None:
+        flags = getattr(array, "flags", None)
+        if flags is None or getattr(flags, "writeable", True):
+            return False
+        array = array.base
+    return True
+
+
+def _array_digest(array):
+    """Hash the data of an array by chunks."""
+    np = sys.modules["numpy"]
+    hasher = hashlib.sha1()
+    hasher.update(_sized(b"a", array.dtype.str.encode("ascii")))
+    hasher.update(_sized(b"s", repr(tuple(int(n) for n in array.shape))
+                         .encode("ascii")))
+
+    if array.dtype.hasobject:
+        _update(hasher, array.tolist())
+    elif array.flags.c_contiguous:
+        data = array.reshape(-1).view(np.uint8)
+        for start in range(0, data.shape[0], _CHUNK_SIZE):
+            hasher.update(data[start:start + _CHUNK_SIZE])
+    else:
+        row_size = array[:1].nbytes
+        n_rows = max(1, _CHUNK_SIZE // max(1, row_size))
+        for start in range(0, array.shape[0], n_rows):
+            chunk = np.ascontiguousarray(array[start:start + n_rows])
+            hasher.update(chunk.reshape(-1).view(np.uint8))
+    return hasher.digest()
+
+
+def _cached_array_digest(array):
+    key = id(array)
+    frozen = _is_frozen(array)
+    entry = _ARRAY_CACHE.get(key)
+    if entry is not None and entry[0]() is array:
+        if frozen:
+            return entry[1]
+        # The array has been made writeable since, its data might differ
+        del _ARRAY_CACHE[key]
+
+    digest = _array_digest(array)
+    if frozen:
+        reference = weakref.ref(array,
+                                lambda _: _ARRAY_CACHE.pop(key, None))
+        _ARRAY_CACHE[key] = (reference, digest)
+    return digest
+
+
+def _update(hasher, obj):
+    """Feed the hasher with an unambiguous encoding of the object."""
+    np = sys.modules.get("numpy")
+    if np is not None:
+        if isinstance(obj, np.ndarray):
+            hasher.update(_cached_array_digest(obj))
+            return
+        if isinstance(obj, np.generic) and not obj.dtype.hasobject:
+            # NumPy scalars have the fingerprint of the Python scalars
+            obj = obj.item()
+
+    if obj is None:
+        hasher.update(b"N")
+    elif isinstance(obj, bool):
+        hasher.update(b"T" if obj else b"F")
+    elif isinstance(obj, _INTEGER_TYPES):
+        hasher.update(_sized(b"i", str(obj).encode("ascii")))
+    elif isinstance(obj, float):
+        hasher.update(_sized(b"f", repr(obj).encode("ascii")))
+    elif isinstance(obj, complex):
+        hasher.update(_sized(b"c", repr(obj).encode("ascii")))
+    elif isinstance(obj, _TEXT_TYPE):
+        hasher.update(_sized(b"u", obj.encode("utf-8")))
+    elif isinstance(obj, bytes):
+        hasher.update(_sized(b"b", obj))
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(_sized(b"l" if isinstance(obj, list) else b"t",
+                             str(len(obj)).encode("ascii")))
+        for item in obj:
+            _update(hasher, item)
+    elif isinstance(obj, dict):
+        # Items are sorted by the fingerprint of their key, which does not
+        # depend on the insertion order nor on comparisons between types.
+        hasher.update(_sized(b"d", str(len(obj)).encode("ascii")))
+        for key_digest, value in sorted((_digest(key), value)
+                                        for key, value in obj.items()):
+            hasher.update(key_digest)
+            _update(hasher, value)
+    elif isinstance(obj, (set, frozenset)):
+        hasher.update(_sized(b"e", str(len(obj)).encode("ascii")))
+        for item_digest in sorted(_digest(item) for item in obj):
+            hasher.update(item_digest)
+    else:
+        raise TypeError("Cannot fingerprint an object of type %s."
+                        % type(obj).__name__)
+
+
+def fingerprint(obj):
+    """Return a stable fingerprint of the object.
+
+    Parameters
+    ----------
+    obj : object
+        Object to fingerprint, e.g. a dict of parameters or a command
+        string.
+
+    Returns
+    -------
+    fingerprint : str
+        Hexadecimal SHA-1 digest of an unambiguous encoding of the object.
+        Dicts and sets give the same fingerprint whatever the order of their
+        items.
+
+    Examples
+    --------
+    >>> from clusterlib.fingerprint import fingerprint
+    >>> fingerprint({"alpha": 0.1, "n": 10})
+    'e9ff4f4304072a7272cbbdc56bd019fd17ca5331'
+    >>> fingerprint({"n": 10, "alpha": 0.1}) == fingerprint({"alpha": 0.1,
+    ...                                                       "n": 10})
+    True
+
+    """
+    hasher = hashlib.sha1()
+    _update(hasher, obj)
+    return hasher.hexdigest()
+
+
+def job_name(obj, prefix="job", max_length=64):
+    """Return a unique job name made of a prefix and a fingerprint.
+
+    Parameters
+    ----------
+    obj : object
+        Parameters of the job, see :func:`fingerprint`.
+
+    prefix : str, optional (default="job")
+        Readable prefix of the job name. Characters which are not allowed by
+        every scheduler are replaced by ``"_"``.
+
+    max_length : int, optional (default=64)
+        Maximal length of the job name. The fingerprint is truncated to fit
+        in, down to 16 hexadecimal digits, then the prefix is truncated.
+
+    Returns
+    -------
+    job_name : str
+        Job name ``"prefix-fingerprint"``.
+
+    Examples
+    --------
+    >>> from clusterlib.fingerprint import job_name
+    >>> job_name({"alpha": 0.1, "n": 10}, prefix="svm", max_length=24)
+    'svm-e9ff4f4304072a7272cb'
+
+    """
+    if max_length < 16:
+        raise ValueError("max_length should be at least 16, got %r"
+                         % max_length)
+
+    digest = fingerprint(obj)
+    prefix = _INVALID_NAME_CHARACTERS.sub("_", prefix)
+    if not prefix:
+        return digest[:max_length]
+
+    n_digits = min(len(digest), max(16, max_length - len(prefix) - 1))
+    prefix = prefix[:max(0, max_length - n_digits - 1)]
+    if not prefix:
+        return digest[:max_length]
+    return "%s-%s" % (prefix, digest[:n_digits])
+
+
+def sqlite3_dumps_index(params, file_name, prefix="job", max_length=64,
+                        timeout=7200.0):
+    """Name jobs with :func:`job_name` and store their parameters by name.
+
+    The parameters of a job can then be retrieved from its name, e.g. found
+    in the queue or in a log file name, with
+    :func:`clusterlib.storage.sqlite3_loads`.
+
+    Parameters
+    ----------
+    params : list of object
+        Parameters of each job.
+
+    file_name : str
+        Path to the sqlite database of the index.
+
+    prefix : str, optional (default="job")
+        Readable prefix of the job names.
+
+    max_length : int, optional (default=64)
+        Maximal length of the job names.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    Returns
+    -------
+    job_names : list of str
+        Name of each job.
+
+    Examples
+    --------
+    >>> from tempfile import NamedTemporaryFile
+    >>> from clusterlib.fingerprint import sqlite3_dumps_index
+    >>> from clusterlib.storage import sqlite3_loads
+    >>> with NamedTemporaryFile() as fhandle:
+    ...     names = sqlite3_dumps_index([{"n": 1}, {"n": 2}], fhandle.name)
+    ...     print(sqlite3_loads(fhandle.name, key=names[1])[names[1]])
+    {'n': 2}
+
+    """
+    index = dict()
+    job_names = []
+    for obj in params:
+        name = job_name(obj, prefix=prefix, max_length=max_length)
+        index[name] = obj
+        job_names.append(name)
+
+    # Names are derived from the parameters, a stored name has thus the
+    # same parameters.
+    sqlite3_dumps(index, file_name, timeout=timeout, overwrite=True)
+    return job_names
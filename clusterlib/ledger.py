@@ -0,0 +1,264 @@
+"""
+This module allows to record the submitted jobs in a sqlite database.
+
+A launcher avoiding duplicate submissions usually queries the whole queue of
+the scheduler at each run. With a ledger of the submissions, only the jobs
+which were still queued or running at the last run are queried, with
+targeted queries of the scheduler, see
+:func:`clusterlib.scheduler.job_states`. The cost of a launcher run then
+depends on the number of jobs in flight instead of the size of the queue.
+
+"""
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+from __future__ import unicode_literals
+
+import json
+import sqlite3
+import time
+from collections import namedtuple
+from contextlib import closing
+
+from .scheduler import _ACTIVE_STATES
+from .scheduler import _get_backend
+from .scheduler import job_states
+from .scheduler import launch
+
+
+__all__ = [
+    "Ledger",
+    "LedgerEntry",
+]
+
+# Maximal number of job ids given to a single query of the scheduler
+_BATCH_SIZE = 500
+
+
+class LedgerEntry(namedtuple("LedgerEntry", ["key", "job_name", "job_id",
+                                             "backend", "submit_time",
+                                             "resources", "state",
+                                             "update_time"])):
+    """Record of a submission in a :class:`Ledger`.
+
+    The state is the last known state of the job, given by its SLURM name,
+    see :func:`clusterlib.scheduler.job_states`, or "UNKNOWN" if the job has
+    left the scheduler without any accounting. Times are timestamps and
+    resources are a dict.
+    """
+    __slots__ = ()
+
+
+class Ledger(object):
+    """Ledger of the jobs submitted for each task.
+
+    Each task is identified by a key, e.g. its job command, and only its
+    last submission is kept.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the sqlite database. It can be the database where the tasks
+        store their results.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock on the database to go away until raising an exception.
+
+    Examples
+    --------
+    Here, a launcher only submits the tasks neither in flight nor done.
+
+    >>> import sys
+    >>> from clusterlib.ledger import Ledger
+    >>> from clusterlib.storage import sqlite3_contains
+    >>> ledger = Ledger("ledger.sqlite3")  # doctest: +SKIP
+    >>> in_flight = ledger.reconcile()  # doctest: +SKIP
+    >>> job_commands = ["%s main.py --param %s" % (sys.executable, param)
+    ...                 for param in range(100)]
+    >>> done = sqlite3_contains("results.sqlite3", job_commands)
+    >>> for param, job_command in enumerate(job_commands):
+    ...     if job_command not in in_flight and job_command not in done:
+    ...         job_name = "job-param=%s" % param
+    ...         ledger.launch(job_command, job_name=job_name)  # doctest: +SKIP
+
+    """
+
+    def __init__(self, file_name, timeout=7200.0):
+        self.file_name = file_name
+        self.timeout = timeout
+
+    def _connect(self):
+        connection = sqlite3.connect(self.file_name, timeout=self.timeout)
+        connection.execute("""CREATE TABLE IF NOT EXISTS ledger
+                              (key TEXT PRIMARY KEY, job_name TEXT,
+                               job_id TEXT, backend TEXT, submit_time REAL,
+                               resources TEXT, state TEXT,
+                               update_time REAL)""")
+        connection.execute("CREATE INDEX IF NOT EXISTS ledger_state "
+                           "ON ledger(state)")
+        return closing(connection)
+
+    def record(self, key, job_id, job_name=None, backend="auto",
+               resources=None):
+        """Record the submission of a task.
+
+        Parameters
+        ----------
+        key : str
+            Key of the task. A previous submission of the task is replaced.
+
+        job_id : str
+            Id of the submitted job.
+
+        job_name : str or None, optional (default=None)
+            Name of the submitted job.
+
+        backend : {'auto', 'slurm', 'sge', 'local'}, optional (default="auto")
+            Backend where the job was submitted, see
+            :func:`clusterlib.scheduler.submit`.
+
+        resources : dict or None, optional (default=None)
+            Resources requested by the job, e.g. its time and memory.
+
+        """
+        now = time.time()
+        with self._connect() as connection:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO ledger(key, job_name, job_id, "
+                    "backend, submit_time, resources, state, update_time) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, job_name, str(job_id), _get_backend(backend), now,
+                     json.dumps(resources or {}), "PENDING", now))
+
+    def launch(self, job_command, key=None, job_name="job", time="24:00:00",
+               memory=4000, backend="auto", **kwargs):
+        """Launch a job with :func:`clusterlib.scheduler.launch` and record it.
+
+        Parameters
+        ----------
+        job_command : str
+            Command of the job.
+
+        key : str or None, optional (default=None)
+            Key of the task. If None, the key is the job command.
+
+        job_name, time, memory, backend, **kwargs :
+            Parameters of :func:`clusterlib.scheduler.launch`.
+
+        Returns
+        -------
+        job_id : str
+            Id of the job.
+
+        """
+        job_id = launch(job_command, job_name=job_name, time=time,
+                        memory=memory, backend=backend, **kwargs)
+        self.record(job_command if key is None else key, job_id,
+                    job_name=job_name, backend=backend,
+                    resources={"time": time, "memory": memory})
+        return job_id
+
+    def entries(self, keys=None):
+        """Return the recorded submissions.
+
+        Parameters
+        ----------
+        keys : list of str or None, optional (default=None)
+            Keys of the tasks. If None, all the submissions are returned.
+
+        Returns
+        -------
+        entries : dict of (str, LedgerEntry)
+            Last submission of each task indexed by its key.
+
+        """
+        query = ("SELECT key, job_name, job_id, backend, submit_time, "
+                 "resources, state, update_time FROM ledger")
+        with self._connect() as connection:
+            if keys is None:
+                rows = connection.execute(query).fetchall()
+            else:
+                keys = list(keys)
+                rows = []
+                for start in range(0, len(keys), _BATCH_SIZE):
+                    batch = keys[start:start + _BATCH_SIZE]
+                    rows.extend(connection.execute(
+                        query + " WHERE key IN (%s)"
+                        % ", ".join("?" * len(batch)), batch))
+
+        out = dict()
+        for row in rows:
+            entry = LedgerEntry(*row)
+            out[entry.key] = entry._replace(
+                resources=json.loads(entry.resources))
+        return out
+
+    def reconcile(self, grace=60.):
+        """Update the state of the jobs in flight and return their keys.
+
+        Only the jobs whose last known state is queued or running are
+        queried, with :func:`clusterlib.scheduler.job_states`. If the
+        scheduler can not be queried, their state is left unchanged and they
+        are still considered in flight.
+
+        Parameters
+        ----------
+        grace : float, optional (default=60.)
+            Number of seconds after its submission during which a job which
+            is unknown to the scheduler is still considered in flight.
+
+        Returns
+        -------
+        in_flight : set of str
+            Keys of the tasks whose job is queued or running.
+
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT key, job_id, backend, submit_time FROM ledger "
+                "WHERE state IN (%s)" % ", ".join("?" * len(_ACTIVE_STATES)),
+                sorted(_ACTIVE_STATES)).fetchall()
+
+        job_ids = dict()
+        for _, job_id, backend, _ in rows:
+            job_ids.setdefault(backend, []).append(job_id)
+
+        states = dict()
+        queried = set()
+        for backend, ids in job_ids.items():
+            for start in range(0, len(ids), _BATCH_SIZE):
+                batch = ids[start:start + _BATCH_SIZE]
+                try:
+                    answer = job_states(batch, backend=backend)
+                except RuntimeError:
+                    # The scheduler is unavailable for now, the states of
+                    # these jobs are left unchanged.
+                    continue
+                queried.update((backend, job_id) for job_id in batch)
+                for job_id, state in answer.items():
+                    states[backend, job_id] = state
+
+        now = time.time()
+        in_flight = set()
+        updates = []
+        for key, job_id, backend, submit_time in rows:
+            state = states.get((backend, job_id))
+            if state is None and ((backend, job_id) not in queried or
+                                  now - submit_time < grace):
+                in_flight.add(key)
+                continue
+            if state is None:
+                state = "UNKNOWN"
+            elif state in _ACTIVE_STATES:
+                in_flight.add(key)
+            updates.append((state, now, key, job_id))
+
+        with self._connect() as connection:
+            with connection:
+                # A task submitted again in the mean time is left unchanged
+                connection.executemany(
+                    "UPDATE ledger SET state = ?, update_time = ? "
+                    "WHERE key = ? AND job_id = ?", updates)
+        return in_flight
@@ -0,0 +1,501 @@
+"""
+This module provides a local backend running the jobs with a bounded pool of
+processes, e.g. on a workstation or a continuous integration service without
+any scheduler.
+
+The backend is selected with ``backend="local"`` or by setting the
+"CLUSTERLIB_BACKEND" environment variable to "local", thus launchers written
+for SGE or SLURM work unchanged. The queries written by
+:func:`clusterlib.scheduler.submit` spool the jobs into the directory given by
+the "CLUSTERLIB_LOCAL_SPOOL" environment variable (by default
+``~/.clusterlib/local``). A daemon, started whenever needed, runs the spooled
+jobs with at most "CLUSTERLIB_LOCAL_N_JOBS" jobs at once (by default the
+number of cpus). The requested memory is enforced as a limit on the address
+space of each job and the requested time as a timeout.
+
+Jobs can also be submitted and served from the command line::
+
+    echo 'python main.py' | python -m clusterlib.local submit --time=10:00
+    python -m clusterlib.local serve --n-jobs 4
+
+"""
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import getpass
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from multiprocessing import cpu_count
+from tempfile import mkstemp
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from .scheduler import _file_lock
+from .scheduler import fcntl
+
+
+__all__ = [
+    "enqueue",
+    "list_jobs",
+    "serve",
+]
+
+_replace = getattr(os, "replace", os.rename)
+
+# Seconds between the termination signal and the kill of a job which has
+# exceeded its time limit
+_KILL_WAIT = 5.
+
+_MEMORY_UNITS = {"K": 1. / 1024, "M": 1, "G": 1024, "T": 1024 ** 2}
+
+# Seconds during which the final state of the ended jobs is kept
+_FINISHED_TTL = 24 * 3600.
+
+
+def _spool_directory(spool=None):
+    """Return the spool directory, creating it if needed."""
+    if spool is None:
+        spool = os.environ.get("CLUSTERLIB_LOCAL_SPOOL",
+                               os.path.join(os.path.expanduser("~"),
+                                            ".clusterlib", "local"))
+    spool = os.path.abspath(spool)
+    for state in ["queued", "running", "finished"]:
+        if not os.path.isdir(os.path.join(spool, state)):
+            try:
+                os.makedirs(os.path.join(spool, state))
+            except OSError:
+                # Concurrently created
+                if not os.path.isdir(os.path.join(spool, state)):
+                    raise
+    return spool
+
+
+def _parse_time(value):
+    """Parse a time limit in the SLURM format into seconds.
+
+    Supported formats are "minutes", "minutes:seconds",
+    "hours:minutes:seconds", "days-hours", "days-hours:minutes" and
+    "days-hours:minutes:seconds".
+    """
+    if value is None:
+        return None
+
+    days = 0
+    if "-" in value:
+        days, value = value.split("-", 1)
+        days = int(days)
+        parts = [int(part) for part in value.split(":")]
+        parts += [0] * (3 - len(parts))
+    else:
+        parts = [int(part) for part in value.split(":")]
+        if len(parts) == 1:
+            parts = [0, parts[0], 0]
+        elif len(parts) == 2:
+            parts = [0] + parts
+
+    hours, minutes, seconds = parts
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def _parse_memory(value):
+    """Parse a memory size in mega-bytes, with an optional unit suffix."""
+    if value is None:
+        return None
+
+    value = value.strip().upper()
+    if value[-1:] in _MEMORY_UNITS:
+        return float(value[:-1]) * _MEMORY_UNITS[value[-1]]
+    return float(value)
+
+
+def _write_json(file_name, data):
+    """Write atomically a JSON file."""
+    directory, base_name = os.path.split(file_name)
+    fd, tmp_name = mkstemp(prefix="." + base_name, dir=directory)
+    with os.fdopen(fd, "w") as fhandle:
+        json.dump(data, fhandle)
+    _replace(tmp_name, file_name)
+
+
+def _read_jobs(directory):
+    """Read the jobs of a state directory indexed by job id."""
+    jobs = {}
+    for file_name in os.listdir(directory):
+        if not file_name.endswith(".json") or file_name.startswith("."):
+            continue
+        try:
+            with open(os.path.join(directory, file_name)) as fhandle:
+                job = json.load(fhandle)
+        except (IOError, OSError, ValueError):
+            # The job has changed of state in the mean time
+            continue
+        jobs[job["job_id"]] = job
+    return jobs
+
+
+def _try_lock(file_name):
+    """Try to hold an exclusive lock, return the file handle or None."""
+    fhandle = open(file_name, "a")
+    try:
+        fcntl.flock(fhandle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        fhandle.close()
+        return None
+    return fhandle
+
+
+def _start_daemon(spool):
+    """Start a daemon serving the spool directory if none is running."""
+    lock = _try_lock(os.path.join(spool, "daemon.lock"))
+    if lock is None:
+        return
+    lock.close()
+
+    # The daemon must be able to import clusterlib and must not hold the
+    # output of the submission command.
+    env = dict(os.environ)
+    package_directory = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [package_directory] + [path for path in
+                               [os.environ.get("PYTHONPATH")] if path])
+    with open(os.devnull, "r+b") as devnull:
+        subprocess.Popen([sys.executable, "-m", "clusterlib.local", "serve",
+                          "--spool", spool],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, env=env, preexec_fn=os.setsid)
+
+
+def enqueue(script, job_name="job", time_limit=None, memory=None,
+            log_file=None, spool=None):
+    """Spool a job and make sure that it will be run.
+
+    Parameters
+    ----------
+    script : str
+        Job script, starting with its interpreter, e.g. "#!/bin/bash".
+
+    job_name : str, optional (default="job")
+        Name of the job.
+
+    time_limit : float or None, optional (default=None)
+        Maximum duration of the job in seconds. If None, unlimited.
+
+    memory : float or None, optional (default=None)
+        Maximum virtual memory of the job in mega-bytes. If None, unlimited.
+
+    log_file : str or None, optional (default=None)
+        Log of the job, where "%j" is replaced by the job id. If None, the
+        log is ``local-job_id.out`` in the current directory.
+
+    spool : str or None, optional (default=None)
+        Spool directory. If None, given by the "CLUSTERLIB_LOCAL_SPOOL"
+        environment variable.
+
+    Returns
+    -------
+    job_id : str
+        Id of the job.
+
+    """
+    if fcntl is None:
+        raise RuntimeError("The local backend requires the fcntl module.")
+
+    spool = _spool_directory(spool)
+    with _file_lock(os.path.join(spool, "counter.lock")):
+        counter_file = os.path.join(spool, "counter")
+        try:
+            with open(counter_file) as fhandle:
+                job_id = int(fhandle.read()) + 1
+        except (IOError, OSError, ValueError):
+            job_id = 1
+        _write_json(counter_file, job_id)
+    job_id = str(job_id)
+
+    if log_file is None:
+        log_file = os.path.join(os.getcwd(), "local-%j.out")
+
+    _write_json(os.path.join(spool, "queued", job_id + ".json"), {
+        "job_id": job_id,
+        "job_name": job_name,
+        "user": getpass.getuser(),
+        "script": script,
+        "time_limit": time_limit,
+        "memory": memory,
+        "log_file": os.path.abspath(log_file.replace("%j", job_id)),
+        "cwd": os.getcwd(),
+        "env": dict(os.environ),
+        "submit_time": time.time(),
+    })
+    _start_daemon(spool)
+    return job_id
+
+
+def list_jobs(spool=None, finished=False):
+    """List the queued or running jobs.
+
+    Parameters
+    ----------
+    spool : str or None, optional (default=None)
+        Spool directory. If None, given by the "CLUSTERLIB_LOCAL_SPOOL"
+        environment variable.
+
+    finished : bool, optional (default=False)
+        Whether to list also the jobs which have ended during the last day.
+
+    Returns
+    -------
+    jobs : list of dict
+        Queued or running jobs in the order of their id. The state of a job
+        is given by its "state" key, either "PENDING" or "RUNNING". The
+        state of an ended job is either "COMPLETED", "FAILED" or "TIMEOUT",
+        and its exit code is given by its "exit_code" key.
+
+    """
+    spool = _spool_directory(spool)
+    jobs = _read_jobs(os.path.join(spool, "finished")) if finished else {}
+    queued = _read_jobs(os.path.join(spool, "queued"))
+    jobs.update(queued)
+    for job in queued.values():
+        job["state"] = "PENDING"
+    running = _read_jobs(os.path.join(spool, "running"))
+    for job in running.values():
+        job["state"] = "RUNNING"
+    jobs.update(running)
+    return [jobs[job_id] for job_id in sorted(jobs, key=int)]
+
+
+def _limit_resources(memory):
+    """Return a function setting the limits of a job before it starts."""
+    def preexec():
+        # Signals are sent to the whole process group of the job
+        os.setsid()
+        if memory is not None and resource is not None:
+            limit = int(memory * 1024 ** 2)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    return preexec
+
+
+def _start_job(spool, job):
+    """Start a queued job and return its process."""
+    job_id = job["job_id"]
+    script_file = os.path.join(spool, "running", job_id + ".sh")
+    with open(script_file, "w") as fhandle:
+        fhandle.write(job["script"])
+    os.chmod(script_file, 0o700)
+
+    env = dict(job["env"], CLUSTERLIB_JOB_ID=job_id)
+    try:
+        with open(job["log_file"], "ab") as log:
+            with open(os.devnull, "rb") as devnull:
+                process = subprocess.Popen(
+                    [script_file], stdin=devnull, stdout=log,
+                    stderr=subprocess.STDOUT, cwd=job["cwd"], env=env,
+                    close_fds=True,
+                    preexec_fn=_limit_resources(job["memory"]))
+    except (IOError, OSError):
+        # As with a scheduler, a job whose log can not be written fails
+        process = None
+        os.remove(script_file)
+        _finish_job(spool, job, "FAILED")
+
+    if process is not None:
+        job = dict(job, start_time=time.time(), pid=process.pid)
+        _write_json(os.path.join(spool, "running", job_id + ".json"), job)
+    os.remove(os.path.join(spool, "queued", job_id + ".json"))
+    return process
+
+
+def _end_job(spool, job_id):
+    """Remove the files of a job which has ended."""
+    for extension in [".json", ".sh"]:
+        try:
+            os.remove(os.path.join(spool, "running", job_id + extension))
+        except OSError:
+            pass
+
+
+def _finish_job(spool, job, state, exit_code=None):
+    """Record the final state of a job which has ended."""
+    record = dict((key, value) for key, value in job.items()
+                  if key not in ("script", "env"))
+    record.update(state=state, exit_code=exit_code, end_time=time.time())
+    _write_json(os.path.join(spool, "finished", job["job_id"] + ".json"),
+                record)
+    _end_job(spool, job["job_id"])
+
+
+def _prune_finished(spool):
+    """Forget the final state of the jobs which have ended long ago."""
+    directory = os.path.join(spool, "finished")
+    for job_id, job in _read_jobs(directory).items():
+        if job["end_time"] < time.time() - _FINISHED_TTL:
+            try:
+                os.remove(os.path.join(directory, job_id + ".json"))
+            except OSError:
+                pass
+
+
+def serve(spool=None, n_jobs=None, idle_timeout=5., poll_interval=0.1):
+    """Run the spooled jobs until there is none for a while.
+
+    Only one daemon serves a spool directory at once. It is normally started
+    by :func:`enqueue`.
+
+    Parameters
+    ----------
+    spool : str or None, optional (default=None)
+        Spool directory. If None, given by the "CLUSTERLIB_LOCAL_SPOOL"
+        environment variable.
+
+    n_jobs : int or None, optional (default=None)
+        Maximal number of jobs running at once. If None, given by the
+        "CLUSTERLIB_LOCAL_N_JOBS" environment variable, or the number of
+        cpus.
+
+    idle_timeout : float, optional (default=5.)
+        Number of seconds without any job before the daemon stops.
+
+    poll_interval : float, optional (default=0.1)
+        Delay in seconds between two checks of the jobs.
+
+    Returns
+    -------
+    served : bool
+        Whether the spool directory was served, False if another daemon
+        was already serving it.
+
+    """
+    spool = _spool_directory(spool)
+    if n_jobs is None:
+        n_jobs = int(os.environ.get("CLUSTERLIB_LOCAL_N_JOBS", cpu_count()))
+
+    lock_file = os.path.join(spool, "daemon.lock")
+    lock = _try_lock(lock_file)
+    if lock is None:
+        return False
+
+    # Jobs left running by a previous daemon have been lost
+    for job in _read_jobs(os.path.join(spool, "running")).values():
+        _finish_job(spool, job, "FAILED")
+    _prune_finished(spool)
+
+    running = {}
+    last_activity = time.time()
+    try:
+        while True:
+            now = time.time()
+            for job_id, (process, job, killed) in list(running.items()):
+                if process.poll() is not None:
+                    if killed is not None:
+                        state = "TIMEOUT"
+                    elif process.returncode == 0:
+                        state = "COMPLETED"
+                    else:
+                        state = "FAILED"
+                    _finish_job(spool, job, state, process.returncode)
+                    del running[job_id]
+
+                elif killed is not None:
+                    if now > killed + _KILL_WAIT:
+                        os.killpg(process.pid, signal.SIGKILL)
+
+                elif (job["time_limit"] is not None and
+                        now > job["start_time"] + job["time_limit"]):
+                    with open(job["log_file"], "a") as log:
+                        log.write("clusterlib: job %s cancelled due to its "
+                                  "time limit.\n" % job_id)
+                    os.killpg(process.pid, signal.SIGTERM)
+                    running[job_id] = (process, job, now)
+
+            try:
+                queued = _read_jobs(os.path.join(spool, "queued"))
+            except OSError:
+                # The spool directory has been removed
+                return True
+
+            for job_id in sorted(queued, key=int):
+                if len(running) >= n_jobs:
+                    break
+                process = _start_job(spool, queued[job_id])
+                if process is not None:
+                    running[job_id] = (process, dict(queued[job_id],
+                                                     start_time=now), None)
+
+            if running or queued:
+                last_activity = now
+
+            elif now - last_activity > idle_timeout:
+                # A job might have been queued while the daemon was
+                # stopping, in which case the daemon goes on.
+                lock.close()
+                if not os.listdir(os.path.join(spool, "queued")):
+                    return True
+                lock = _try_lock(lock_file)
+                if lock is None:
+                    return True
+                last_activity = now
+
+            time.sleep(poll_interval)
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+def main(argv=None):
+    """Command line interface of the local backend."""
+    parser = argparse.ArgumentParser(
+        prog="python -m clusterlib.local",
+        description="Run jobs with a local pool of processes.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    # Same options as sbatch, the job script is read on stdin
+    submit_parser = subparsers.add_parser(
+        "submit", help="Submit a job whose script is read on stdin.")
+    submit_parser.add_argument("--job-name", default="job")
+    submit_parser.add_argument("--time", default=None)
+    submit_parser.add_argument("--mem", default=None)
+    submit_parser.add_argument("--mail-user", default=None,
+                               help="Ignored.")
+    submit_parser.add_argument("--mail-type", default=None,
+                               help="Ignored.")
+    submit_parser.add_argument("--cpus-per-task", default=None,
+                               help="Ignored.")
+    submit_parser.add_argument("-o", "--output", default=None)
+    submit_parser.add_argument("--spool", default=None)
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="Run the spooled jobs.")
+    serve_parser.add_argument("--n-jobs", type=int, default=None)
+    serve_parser.add_argument("--idle-timeout", type=float, default=5.)
+    serve_parser.add_argument("--spool", default=None)
+    args = parser.parse_args(argv)
+
+    if args.command == "submit":
+        script = sys.stdin.read()
+        job_id = enqueue(script, job_name=args.job_name,
+                         time_limit=_parse_time(args.time),
+                         memory=_parse_memory(args.mem),
+                         log_file=args.output, spool=args.spool)
+        print("Submitted batch job %s" % job_id)
+    else:
+        serve(args.spool, n_jobs=args.n_jobs,
+              idle_timeout=args.idle_timeout)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
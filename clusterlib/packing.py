@@ -0,0 +1,333 @@
+"""
+This module allows to pack many short tasks into a few scheduler jobs.
+
+Whenever a task lasts less than the time needed to dispatch a job and to
+start the interpreter, submitting one job per task wastes most of the
+allocated time. The tasks are thus grouped into packs, each pack being run
+by a single job which executes its tasks sequentially or with a local pool
+of processes sized to the requested cpus.
+
+The exit status of each task is recorded, so that the failed tasks can be
+submitted again on their own. A pack can also be run from the command
+line, for instance::
+
+    python -m clusterlib.packing packs/pack.0.json --n-jobs 4
+
+"""
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+from __future__ import unicode_literals
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from shlex import quote
+except ImportError:  # Python 2
+    from pipes import quote
+
+from .scheduler import _TEMPLATE
+from .scheduler import _get_backend
+from .scheduler import submit
+
+
+__all__ = [
+    "failed_tasks",
+    "run_pack",
+    "submit_packs",
+]
+
+# Environment variables holding the number of allocated cpus
+_CPUS_VARIABLES = ["SLURM_CPUS_PER_TASK", "NSLOTS"]
+
+
+def _pack_size(task_duration, target_duration, n_cpus):
+    """Number of tasks of a pack lasting about target_duration."""
+    return max(int(target_duration // task_duration), 1) * n_cpus
+
+
+def _quote(value):
+    """Quote a value of the job script given to submit.
+
+    The job script is written within a single-quoted echo, where the quotes
+    of the shell-escaped value must themselves be escaped.
+    """
+    return quote(value).replace("'", "'\\''")
+
+
+def _pack_files(pack_directory, job_name, extension):
+    """Return the files of the packs indexed by their pack id."""
+    out = dict()
+    for file_name in glob.glob(os.path.join(pack_directory, "%s.*%s"
+                                            % (job_name, extension))):
+        pack_id = file_name[:-len(extension)].rsplit(".", 1)[1]
+        if pack_id.isdigit():
+            out[int(pack_id)] = file_name
+    return out
+
+
+def _format_time(seconds):
+    """Format a duration as "HH:MM:SS"."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%02d:%02d:%02d" % (hours, minutes, seconds)
+
+
+def submit_packs(job_commands, pack_directory, task_duration,
+                 target_duration=3600., n_cpus=1, job_name="pack", time=None,
+                 memory=4000, email=None, email_options=None,
+                 log_directory=None, backend="auto",
+                 shell_script="#!/bin/bash"):
+    """Write the submission queries of packs of tasks.
+
+    The commands are split into packs lasting about ``target_duration``
+    seconds, each pack being written as ``job_name.pack_id.json`` in
+    ``pack_directory``. Each job runs a pack with ``n_cpus`` tasks at once,
+    and appends the exit status of each task to ``job_name.pack_id.status``.
+    The packs and status files of a previous submission with the same job
+    name in ``pack_directory`` are removed, e.g. when the failed tasks are
+    submitted again.
+
+    Parameters
+    ----------
+    job_commands : list of str
+        Command of each task, e.g. 'python main.py --param 1'.
+
+    pack_directory : str
+        Directory where the packs are written. It must be accessible from
+        the computing nodes.
+
+    task_duration : float
+        Expected duration in seconds of a task.
+
+    target_duration : float, optional (default=3600.)
+        Expected duration in seconds of a job running a pack.
+
+    n_cpus : int, optional (default=1)
+        Number of cpus requested by each job, which is also the number of
+        tasks running at once within a job.
+
+    job_name : str, optional (default="pack")
+        Name of the jobs.
+
+    time : str or None, optional (default=None)
+        Maximum time format "HH:MM:SS" of each job. If None, twice the
+        expected duration of the largest pack.
+
+    memory : str, optional (default=4000)
+        Maximum virtual memory in mega-bytes of each job.
+
+    email : str, optional (default=None)
+        Email where job information is sent. If None, no email is asked
+        to be sent.
+
+    email_options : str, optional (default=None)
+        Specify email options, see :func:`clusterlib.scheduler.submit`.
+
+    log_directory : str, optional (default=None)
+        Specify the log directory. If None, no log directory is specified.
+
+    backend : {'auto', 'slurm', 'sge', 'local'}, optional (default="auto")
+        Backend where the job will be submitted, see
+        :func:`clusterlib.scheduler.submit`.
+
+    shell_script : str, optional (default="#!/bin/bash")
+        Specify shell that is used by the script.
+
+    Returns
+    -------
+    submission_queries : list of str,
+        Return the submission query of each pack in the appropriate format.
+
+    Examples
+    --------
+    >>> from tempfile import mkdtemp
+    >>> from clusterlib.packing import submit_packs
+    >>> commands = ["python main.py --param %s" % p for p in range(1000)]
+    >>> queries = submit_packs(commands, mkdtemp(), task_duration=20.,
+    ...                        target_duration=3600., n_cpus=4,
+    ...                        backend="slurm")
+    >>> len(queries)
+    2
+
+    """
+    if task_duration <= 0:
+        raise ValueError("task_duration should be positive, got %r"
+                         % task_duration)
+    if n_cpus < 1:
+        raise ValueError("n_cpus should be positive, got %r" % n_cpus)
+
+    backend = _get_backend(backend)
+    if backend not in _TEMPLATE:
+        raise ValueError("Unknown backend %s expected any of %s"
+                         % (backend, "{%s}" % ",".join(_TEMPLATE)))
+
+    pack_size = _pack_size(task_duration, target_duration, n_cpus)
+    if time is None:
+        n_rounds = -(-min(pack_size, len(job_commands)) // n_cpus)
+        time = _format_time(2 * n_rounds * task_duration)
+
+    pack_directory = os.path.abspath(pack_directory)
+    for extension in [".json", ".status"]:
+        for file_name in _pack_files(pack_directory, job_name,
+                                     extension).values():
+            os.remove(file_name)
+
+    queries = []
+    for pack_id, start in enumerate(range(0, len(job_commands), pack_size)):
+        pack_file = os.path.join(pack_directory,
+                                 "%s.%s.json" % (job_name, pack_id))
+        with open(pack_file, "w") as fhandle:
+            json.dump({"commands": job_commands[start:start + pack_size]},
+                      fhandle)
+
+        query = submit("%s -m clusterlib.packing %s --n-jobs %s"
+                       % (_quote(sys.executable), _quote(pack_file), n_cpus),
+                       job_name="%s.%s" % (job_name, pack_id), time=time,
+                       memory=memory, email=email,
+                       email_options=email_options,
+                       log_directory=log_directory, backend=backend,
+                       shell_script=shell_script)
+        if n_cpus > 1:
+            query += " " + _TEMPLATE[backend]["cpus"] % n_cpus
+        queries.append(query)
+
+    return queries
+
+
+def _status_file(pack_file):
+    return os.path.splitext(pack_file)[0] + ".status"
+
+
+def run_pack(pack_file, n_jobs=None):
+    """Run the tasks of a pack and record their exit status.
+
+    The status of each task is appended as a JSON line to the status file
+    of the pack, so that it is kept even if the job is killed.
+
+    Parameters
+    ----------
+    pack_file : str
+        Pack written by :func:`submit_packs`.
+
+    n_jobs : int or None, optional (default=None)
+        Number of tasks running at once. If None, the number of cpus
+        allocated by the scheduler, 1 if unknown.
+
+    Returns
+    -------
+    n_failed : int
+        Number of tasks with a non zero exit status.
+
+    """
+    if n_jobs is None:
+        n_jobs = 1
+        for variable in _CPUS_VARIABLES:
+            if os.environ.get(variable, "").isdigit():
+                n_jobs = int(os.environ[variable])
+                break
+
+    with open(pack_file) as fhandle:
+        commands = json.load(fhandle)["commands"]
+
+    lock = threading.Lock()
+    status_file = _status_file(pack_file)
+
+    def run_task(task):
+        task_id, command = task
+        start = time.time()
+        returncode = subprocess.call(command, shell=True)
+        status = {"task_id": task_id, "command": command,
+                  "returncode": returncode,
+                  "duration": time.time() - start}
+        with lock:
+            with open(status_file, "a") as fhandle:
+                fhandle.write(json.dumps(status) + "\n")
+        return returncode
+
+    if n_jobs == 1:
+        returncodes = [run_task(task) for task in enumerate(commands)]
+    else:
+        # Threads are enough as the tasks are run in their own process
+        pool = ThreadPool(n_jobs)
+        try:
+            returncodes = pool.map(run_task, enumerate(commands),
+                                   chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return sum(returncode != 0 for returncode in returncodes)
+
+
+def failed_tasks(pack_directory, job_name="pack"):
+    """Return the commands of the tasks which did not succeed.
+
+    A task did not succeed if it has a non zero exit status or if it has
+    no status at all, e.g. its job was killed before it ended. Thus, this
+    should be called once the jobs are done.
+
+    Parameters
+    ----------
+    pack_directory : str
+        Directory of the packs given to :func:`submit_packs`.
+
+    job_name : str, optional (default="pack")
+        Name of the jobs given to :func:`submit_packs`.
+
+    Returns
+    -------
+    job_commands : list of str
+        Commands of the tasks which did not succeed, in the order of the
+        packs.
+
+    """
+    pack_files = _pack_files(pack_directory, job_name, ".json")
+    out = []
+    for pack_id in sorted(pack_files):
+        pack_file = pack_files[pack_id]
+        with open(pack_file) as fhandle:
+            commands = json.load(fhandle)["commands"]
+
+        succeeded = set()
+        status_file = _status_file(pack_file)
+        if os.path.exists(status_file):
+            with open(status_file) as fhandle:
+                for line in fhandle:
+                    try:
+                        status = json.loads(line)
+                    except ValueError:
+                        # Line partially written by a killed job
+                        continue
+                    if status["returncode"] == 0:
+                        succeeded.add(status["task_id"])
+
+        out.extend(command for task_id, command in enumerate(commands)
+                   if task_id not in succeeded)
+
+    return out
+
+
+def main(argv=None):
+    """Command line interface to run a pack of tasks."""
+    parser = argparse.ArgumentParser(
+        prog="python -m clusterlib.packing",
+        description="Run a pack of tasks and record their exit status.")
+    parser.add_argument("pack_file")
+    parser.add_argument("--n-jobs", type=int, default=None,
+                        help="Number of tasks running at once.")
+    args = parser.parse_args(argv)
+
+    return 1 if run_pack(args.pack_file, n_jobs=args.n_jobs) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
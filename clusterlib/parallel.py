@@ -0,0 +1,165 @@
+"""
+This module provides a `joblib <https://joblib.readthedocs.io>`_ parallel
+backend running the batches of delayed calls as jobs of the cluster.
+
+Importing this module registers the backend under the name "clusterlib",
+thus existing ``Parallel(n_jobs=...)(delayed(f)(x) for x in ...)`` code
+runs on the cluster within a ``parallel_backend`` context::
+
+    import clusterlib.parallel
+    from joblib import Parallel, delayed, parallel_backend
+
+    with parallel_backend("clusterlib", directory="joblib", memory=8000):
+        results = Parallel(n_jobs=100)(delayed(f)(x) for x in range(10000))
+
+The batches are run through :class:`clusterlib.executor.ClusterExecutor`,
+their results coming back through a shared directory. Whenever no scheduler
+is detected, the calls are run by a local pool of processes.
+
+"""
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+from __future__ import unicode_literals
+
+import os
+
+from joblib import register_parallel_backend
+from joblib._parallel_backends import AutoBatchingMixin
+from joblib._parallel_backends import FallbackToBackend
+from joblib._parallel_backends import LokyBackend
+from joblib._parallel_backends import ParallelBackendBase
+
+from .executor import ClusterExecutor
+from .scheduler import _get_backend
+
+
+__all__ = [
+    "ClusterBackend",
+]
+
+
+class ClusterBackend(AutoBatchingMixin, ParallelBackendBase):
+    """joblib parallel backend running batches of calls as cluster jobs.
+
+    ``n_jobs`` is the number of jobs submitted at once. The number of calls
+    run by each job is adapted so that a batch lasts between
+    ``MIN_IDEAL_BATCH_DURATION`` and ``MAX_IDEAL_BATCH_DURATION`` seconds,
+    including the time spent in the queue.
+
+    Parameters
+    ----------
+    directory : str, optional (default="clusterlib_joblib")
+        Directory where the calls and their outcome are pickled. It must be
+        accessible from the computing nodes.
+
+    job_name : str, optional (default="joblib")
+        Prefix of the names of the jobs.
+
+    time : str, optional (default="24:00:00")
+        Maximum time format "HH:MM:SS" of each job.
+
+    memory : str, optional (default=4000)
+        Maximum virtual memory in mega-bytes of each job.
+
+    log_directory : str, optional (default=None)
+        Specify the log directory. If None, no log directory is specified.
+
+    scheduler : {'auto', 'slurm', 'sge'}, optional (default="auto")
+        Backend of :mod:`clusterlib.scheduler` where the jobs will be
+        submitted. If 'auto' and no scheduler is detected, the calls are run
+        by a local pool of processes.
+
+    options : list of str or None, optional (default=None)
+        Further arguments given to the launcher.
+
+    poll_interval : float, optional (default=10.)
+        Delay in seconds between two checks of the outcome of the jobs.
+
+    max_n_jobs : int, optional (default=100)
+        Number of jobs submitted at once with ``n_jobs=-1``. As for the
+        number of cpus, ``n_jobs=-2`` means one job less.
+
+    """
+
+    supports_retrieve_callback = True
+
+    # Submitting a job and waiting for it in the queue lasts much longer
+    # than dispatching a call to a local worker.
+    MIN_IDEAL_BATCH_DURATION = 60.
+    MAX_IDEAL_BATCH_DURATION = 600.
+
+    def __init__(self, directory="clusterlib_joblib", job_name="joblib",
+                 time="24:00:00", memory=4000, log_directory=None,
+                 scheduler="auto", options=None, poll_interval=10.,
+                 max_n_jobs=100, **backend_kwargs):
+        super(ClusterBackend, self).__init__(**backend_kwargs)
+        self.directory = directory
+        self.job_name = job_name
+        self.time = time
+        self.memory = memory
+        self.log_directory = log_directory
+        self.scheduler = scheduler
+        self.options = options
+        self.poll_interval = poll_interval
+        self.max_n_jobs = max_n_jobs
+        self._executor = None
+
+    def effective_n_jobs(self, n_jobs):
+        """Determine the number of jobs submitted at once."""
+        if n_jobs == 0:
+            raise ValueError("n_jobs == 0 in Parallel has no meaning")
+        elif n_jobs is None:
+            return 1
+        elif n_jobs < 0:
+            n_jobs = max(self.max_n_jobs + 1 + n_jobs, 1)
+        return n_jobs
+
+    def configure(self, n_jobs=1, parallel=None, **backend_kwargs):
+        """Start an executor and return the number of jobs."""
+        try:
+            scheduler = _get_backend(self.scheduler)
+        except RuntimeError:
+            # No scheduler is available, e.g. on a laptop
+            raise FallbackToBackend(
+                LokyBackend(nesting_level=self.nesting_level))
+
+        n_jobs = self.effective_n_jobs(n_jobs)
+        self.parallel = parallel
+        self._executor = ClusterExecutor(
+            os.path.abspath(self.directory), job_name=self.job_name,
+            time=self.time, memory=self.memory,
+            log_directory=self.log_directory, backend=scheduler,
+            options=self.options, poll_interval=self.poll_interval)
+        return n_jobs
+
+    def submit(self, func, callback=None):
+        """Submit a job running a batch of calls."""
+        future = self._executor.submit(func)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def retrieve_result_callback(self, future):
+        """Return the result of a batch given its future."""
+        return future.result()
+
+    def terminate(self):
+        """Wait for the pending jobs and stop the executor."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.reset_batch_stats()
+
+    def abort_everything(self, ensure_ready=True):
+        """Stop waiting for the pending jobs."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+        if ensure_ready:
+            self.configure(n_jobs=self.parallel.n_jobs,
+                           parallel=self.parallel)
+
+
+register_parallel_backend("clusterlib", ClusterBackend)
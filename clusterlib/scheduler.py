@@ -4,7 +4,11 @@ Simple Linux Utility for Resource Management (SLURM).
 
 Main functions covered are :
     - get the list of names of all running jobs;
-    - generate easily a submission query for a job.
+    - get structured records of all running jobs;
+    - get the states of some jobs, including ended ones;
+    - generate easily a submission query for a job or a job array;
+    - launch many submission queries and collect the job ids;
+    - submit graphs of jobs depending on each other.
 
 """
 
@@ -13,21 +17,66 @@ Main functions covered are :
 # License: BSD 3 clause
 from __future__ import unicode_literals
 
+import json
 import os
+import random
+import re
+import shlex
 import shutil
 import subprocess
-from xml.etree.ElementTree import XMLParser, XML
+import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from tempfile import mkstemp
+from xml.etree.ElementTree import XMLParser, XML, ParseError, iterparse
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    from shlex import quote
+except ImportError:  # Python 2
+    from pipes import quote
 
 
 __all__ = [
+    "JobRecord",
+    "SubmissionReceipt",
+    "dispatch",
+    "job_states",
+    "launch",
+    "parse_job_id",
     "queued_or_running_jobs",
-    "submit"
+    "queued_or_running_job_records",
+    "submit",
+    "submit_array",
+    "submit_dag",
 ]
 
 
+# Memoized results of _which for each program and PATH value
+_WHICH_CACHE = {}
+
+
 def _which(program):
     """Check the presence of an executable in the PATH.
 
+    The result is memoized for each value of the PATH environment variable.
+    """
+    key = (program, os.environ.get("PATH"))
+    if key not in _WHICH_CACHE:
+        _WHICH_CACHE[key] = _lookup_executable(program)
+    return _WHICH_CACHE[key]
+
+
+def _lookup_executable(program):
+    """Look for an executable in the PATH.
+
     Credits: http://stackoverflow.com/questions/377017
     """
     if hasattr(shutil, 'which'):
@@ -51,19 +100,41 @@ def _which(program):
     return None
 
 
+# To detect if the backend is available, it's better to detect the presence
+# of administrator tools over launching (sbatch, qsub) or job status
+# (qstat, squeue) commands since a proxy might be provided by
+# the cluster distribution such as the rock roll cluster distribution.
+#
+# A tuple of tuple is used over a dict to impose a deterministic order
+# of backend.
+_BACKEND_COMMANDS = (
+    ('slurm', 'scontrol'),
+    ('sge', 'qmod'),
+)
+
+# Backends which are never detected, but only selected explicitly
+_EXPLICIT_BACKENDS = (
+    'local',
+)
+
+
+def _get_backends():
+    """Detect all the backends available based on the commands in the PATH.
+
+    If a backend is configured in the CLUSTERLIB_BACKEND environment
+    variable, only this one is returned.
+    """
+    backend = os.environ.get('CLUSTERLIB_BACKEND', 'auto').lower()
+    if backend != "auto":
+        return [_get_backend(backend)]
+
+    return [backend_name for backend_name, backend_cmd in _BACKEND_COMMANDS
+            if _which(backend_cmd) is not None]
+
+
 def _get_backend(backend="auto"):
     """Detect the backend to use based on the commands present in the PATH."""
-    # To detect if the backend is available, it's better to detect the presence
-    # of administrator tools over launching (sbatch, qsub) or job status
-    # (qstat, squeue) commands since a proxy might be provided by
-    # the cluster distribution such as the rock roll cluster distribution.
-    #
-    # A tuple of tuple is used over a dict to impose a deterministic order
-    # of backend.
-    backend_commands = (
-        ('slurm', 'scontrol'),
-        ('sge', 'qmod'),
-    )
+    backend_commands = _BACKEND_COMMANDS
 
     if backend == "auto":
         # If backend is auto, check that it is not configured explicitly
@@ -78,7 +149,8 @@ def _get_backend(backend="auto"):
         raise RuntimeError("Could not find any suitable backend: %s"
                            % ", ".join(b for b, c in backend_commands))
 
-    if dict(backend_commands).get(backend) is None:
+    if (dict(backend_commands).get(backend) is None and
+            backend not in _EXPLICIT_BACKENDS):
         raise ValueError("Unsupported backend: '%s'" % backend)
     return backend
 
@@ -118,7 +190,293 @@ def _slurm_queued_or_running_jobs(user=None, encoding='utf-8'):
         return []
 
 
-def queued_or_running_jobs(user=None, encoding='utf-8'):
+def _local_queued_or_running_jobs(user=None, encoding='utf-8'):
+    """Get queued or running jobs from the local backend."""
+    from .local import list_jobs
+    return [job["job_name"] for job in list_jobs()
+            if user is None or job["user"] == user]
+
+
+_QUEUE_QUERIES = {
+    "sge": _sge_queued_or_running_jobs,
+    "slurm": _slurm_queued_or_running_jobs,
+    "local": _local_queued_or_running_jobs,
+}
+
+
+class JobRecord(namedtuple("JobRecord", ["job_id", "name", "state", "user",
+                                         "partition", "submit_time",
+                                         "start_time", "resources"])):
+    """Record of a queued or running job.
+
+    Fields that are not known are None. Times are strings in the format of
+    the scheduler and resources are a dict of strings, whose keys depend on
+    the scheduler.
+    """
+    __slots__ = ()
+
+
+# squeue output format, the job name is the last field so that it can
+# contain the delimiter.
+_SLURM_RECORD_FORMAT = [
+    ("job_id", "%i"),
+    ("state", "%T"),
+    ("user", "%u"),
+    ("partition", "%P"),
+    ("submit_time", "%V"),
+    ("start_time", "%S"),
+    ("cpus", "%C"),
+    ("memory", "%m"),
+    ("time_limit", "%l"),
+    ("nodes", "%D"),
+    ("name", "%j"),
+]
+_SLURM_RECORD_FIELDS = ["job_id", "state", "user", "partition",
+                        "submit_time", "start_time"]
+
+
+def _stream_command(command):
+    """Start a command whose stdout is streamed."""
+    with open(os.devnull, 'w') as shutup:
+        return subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=shutup)
+
+
+def _findtext(elem, tag):
+    """Return the stripped text of a sub-element or None if missing."""
+    value = elem.findtext(tag)
+    return value.strip() if value else None
+
+
+def _parse_sge_records(stream, encoding='utf-8'):
+    """Parse incrementally the job records from the output of qstat -xml."""
+    ancestors = []
+    try:
+        for event, elem in iterparse(stream, events=("start", "end"),
+                                     parser=XMLParser(encoding=encoding)):
+            if event == "start":
+                ancestors.append(elem)
+                continue
+
+            ancestors.pop()
+            if elem.tag != "job_list":
+                continue
+
+            queue = _findtext(elem, "queue_name")
+            resources = {"slots": _findtext(elem, "slots")}
+            if queue is not None:
+                resources["queue"] = queue
+
+            yield JobRecord(
+                job_id=_findtext(elem, "JB_job_number"),
+                name=_findtext(elem, "JB_name"),
+                state=_findtext(elem, "state"),
+                user=_findtext(elem, "JB_owner"),
+                partition=queue.split("@")[0] if queue else None,
+                submit_time=_findtext(elem, "JB_submission_time"),
+                start_time=_findtext(elem, "JAT_start_time"),
+                resources=resources)
+
+            # Free the memory of the processed records
+            if ancestors:
+                ancestors[-1].remove(elem)
+
+    except ParseError:
+        # The output is not xml, e.g. from a proxy to qstat whenever only
+        # SLURM is installed.
+        return
+
+
+def _parse_slurm_records(lines, encoding='utf-8'):
+    """Parse the job records from the output of squeue."""
+    n_fields = len(_SLURM_RECORD_FORMAT)
+    for line in lines:
+        line = line.decode(encoding).rstrip("\n")
+        if not line:
+            continue
+
+        values = dict(zip([name for name, _ in _SLURM_RECORD_FORMAT],
+                          line.split("|", n_fields - 1)))
+        values = dict((k, None if v in ("", "N/A", "(null)") else v)
+                      for k, v in values.items())
+        record = dict((k, values.get(k)) for k in _SLURM_RECORD_FIELDS)
+        record["name"] = values.get("name")
+        record["resources"] = dict((k, values.get(k)) for k in
+                                   ("cpus", "memory", "time_limit", "nodes"))
+        yield JobRecord(**record)
+
+
+def _sge_queued_or_running_job_records(user=None, encoding='utf-8'):
+    """Stream the records of queued or running jobs from SGE."""
+    command = ["qstat", "-xml"]
+    if user is not None:
+        command.extend(["-u", user])
+
+    try:
+        process = _stream_command(command)
+    except OSError:
+        # OSError is raised if the program is not installed
+        return
+
+    try:
+        for record in _parse_sge_records(process.stdout, encoding=encoding):
+            yield record
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def _slurm_queued_or_running_job_records(user=None, encoding='utf-8'):
+    """Stream the records of queued or running jobs from SLURM."""
+    command = ["squeue", "--noheader", "-o",
+               "|".join(code for _, code in _SLURM_RECORD_FORMAT)]
+    if user is not None:
+        command.extend(["-u", user])
+
+    try:
+        process = _stream_command(command)
+    except OSError:
+        # OSError is raised if the program is not installed
+        return
+
+    try:
+        for record in _parse_slurm_records(process.stdout, encoding=encoding):
+            yield record
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def _local_queued_or_running_job_records(user=None, encoding='utf-8'):
+    """Get the records of queued or running jobs from the local backend."""
+    from .local import list_jobs
+
+    def format_time(timestamp):
+        if timestamp is None:
+            return None
+        # Same format as SLURM
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(timestamp))
+
+    return [JobRecord(job["job_id"], job["job_name"], job["state"],
+                      job["user"], None, format_time(job["submit_time"]),
+                      format_time(job.get("start_time")),
+                      {"memory": job["memory"],
+                       "time_limit": job["time_limit"]})
+            for job in list_jobs() if user is None or job["user"] == user]
+
+
+# os.replace is atomic on every platform, but only available for Python 3.3+.
+_replace = getattr(os, "replace", os.rename)
+
+# In memory cache of queued_or_running_jobs, its lock coalesces the queries
+# of concurrent threads.
+_QUEUE_CACHE = {}
+_QUEUE_CACHE_LOCK = threading.Lock()
+
+
+@contextmanager
+def _file_lock(file_name):
+    """Hold an exclusive lock on a file, if supported by the platform."""
+    with open(file_name, "a") as fhandle:
+        if fcntl is not None:
+            fcntl.flock(fhandle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fhandle.fileno(), fcntl.LOCK_UN)
+
+
+def _read_queue_cache(cache_file):
+    """Read the cache file of queued_or_running_jobs."""
+    try:
+        with open(cache_file) as fhandle:
+            return json.load(fhandle)
+    except (IOError, OSError, ValueError):
+        # Missing or corrupted cache file
+        return {}
+
+
+def _write_queue_cache(cache_file, cache):
+    """Write atomically the cache file of queued_or_running_jobs."""
+    directory, base_name = os.path.split(os.path.abspath(cache_file))
+    fd, tmp_name = mkstemp(prefix=base_name + ".", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as fhandle:
+            json.dump(cache, fhandle)
+        os.chmod(tmp_name, 0o644)
+        _replace(tmp_name, cache_file)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+def _cached_queued_or_running_jobs(user, encoding, cache_ttl, cache_file):
+    """Query the scheduler unless a fresh enough answer is cached."""
+    key = "%s|%s|%s" % (",".join(_get_backends()), user, encoding)
+
+    def is_fresh(entry):
+        return (entry is not None and
+                0 <= time.time() - entry["time"] < cache_ttl)
+
+    with _QUEUE_CACHE_LOCK:
+        entry = _QUEUE_CACHE.get(key)
+        if is_fresh(entry):
+            return list(entry["jobs"])
+
+        if cache_file is None:
+            entry = {"time": time.time(),
+                     "jobs": _queued_or_running_jobs(user, encoding)}
+
+        else:
+            # The file lock coalesces the queries of concurrent processes:
+            # the first one queries the scheduler while the others wait to
+            # read its answer.
+            with _file_lock(cache_file + ".lock"):
+                entry = _read_queue_cache(cache_file).get(key)
+                if not is_fresh(entry):
+                    entry = {"time": time.time(),
+                             "jobs": _queued_or_running_jobs(user, encoding)}
+                    cache = _read_queue_cache(cache_file)
+                    cache[key] = entry
+                    _write_queue_cache(cache_file, cache)
+
+        _QUEUE_CACHE[key] = entry
+        return list(entry["jobs"])
+
+
+def _query_backends(queries, backends, user, encoding):
+    """Run the query of each backend and return the list of results.
+
+    Whenever several backends are configured, they are queried concurrently.
+    """
+    def query(backend):
+        return list(queries[backend](user=user, encoding=encoding))
+
+    if len(backends) <= 1:
+        return [query(backend) for backend in backends]
+
+    pool = ThreadPool(len(backends))
+    try:
+        return pool.map(query, backends)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _queued_or_running_jobs(user, encoding):
+    """Query the schedulers for the queued or running jobs."""
+    out = []
+    for jobs in _query_backends(_QUEUE_QUERIES, _get_backends(), user,
+                                encoding):
+        out.extend(jobs)
+
+    return out
+
+
+def queued_or_running_jobs(user=None, encoding='utf-8', cache_ttl=None,
+                           cache_file=None):
     """Return the names of the queued or running jobs under SGE and SLURM.
 
     The list of jobs could be either the list of all jobs on the scheduler
@@ -127,6 +485,10 @@ def queued_or_running_jobs(user=None, encoding='utf-8'):
     Try ``qstat`` in SGE or ``squeue`` in SLURM to know which behavior it
     follows.
 
+    Only the schedulers detected in the PATH are queried, or the one set
+    in the "CLUSTERLIB_BACKEND" environment variable, see :func:`submit`.
+    Whenever several schedulers are detected, they are queried concurrently.
+
     Parameters
     ----------
     user : str or None, (default=None)
@@ -138,6 +500,19 @@ def queued_or_running_jobs(user=None, encoding='utf-8'):
         decoded properly with the default value. In case their are not it is
         possible to change this parameter to select the right encoding.
 
+    cache_ttl : float or None, (default=None)
+        If not None, the answer of the scheduler is cached in memory during
+        ``cache_ttl`` seconds, which spares the scheduler when this function
+        is called often, e.g. by several launchers or dashboards. Concurrent
+        calls of a process are coalesced into a single query.
+
+    cache_file : str or None, (default=None)
+        If not None and ``cache_ttl`` is not None, the answer of the
+        scheduler is also cached in this file, which allows to share it
+        between the processes of a machine, or of several machines if the
+        file system supports file locks. The file is atomically replaced
+        and concurrent calls are coalesced into a single query.
+
     Returns
     -------
     out : list of string,
@@ -145,14 +520,234 @@ def queued_or_running_jobs(user=None, encoding='utf-8'):
         or queued under the SGE or SLURM scheduler.
 
     """
-    out = []
-    for queued_or_running in (_sge_queued_or_running_jobs,
-                              _slurm_queued_or_running_jobs):
-        out.extend(queued_or_running(user=user, encoding=encoding))
+    if cache_ttl is not None:
+        return _cached_queued_or_running_jobs(user, encoding, cache_ttl,
+                                              cache_file)
 
+    return _queued_or_running_jobs(user, encoding)
+
+
+def queued_or_running_job_records(user=None, encoding='utf-8'):
+    """Iterate over the records of the queued or running jobs.
+
+    Contrarily to :func:`queued_or_running_jobs`, which returns only the job
+    names, this function yields a :class:`JobRecord` with the job id, name,
+    state, user, partition, submit and start times and requested resources
+    of each job. The output of the scheduler is parsed incrementally, thus
+    memory usage stays flat whatever the number of jobs.
+
+    The schedulers are queried as for :func:`queued_or_running_jobs`.
+
+    Parameters
+    ----------
+    user : str or None, (default=None)
+        Filter the job list using a given user name.
+
+    encoding : str, (default='utf-8')
+        Encoding to decode the output of the scheduler.
+
+    Returns
+    -------
+    out : iterator of JobRecord
+        Records of the jobs that are running or queued under the SGE or
+        SLURM scheduler.
+
+    """
+    queries = {"sge": _sge_queued_or_running_job_records,
+               "slurm": _slurm_queued_or_running_job_records,
+               "local": _local_queued_or_running_job_records}
+    backends = _get_backends()
+
+    if len(backends) == 1:
+        # Stream the records of the only backend
+        for record in queries[backends[0]](user=user, encoding=encoding):
+            yield record
+
+    else:
+        for records in _query_backends(queries, backends, user, encoding):
+            for record in records:
+                yield record
+
+
+# States of the jobs which are still queued or running, any other state is
+# final. The states of all backends are given with the SLURM names.
+_ACTIVE_STATES = frozenset(["PENDING", "RUNNING", "CONFIGURING",
+                            "COMPLETING", "SUSPENDED", "REQUEUED",
+                            "RESIZING", "STOPPED", "SIGNALING",
+                            "STAGE_OUT"])
+
+
+def _check_output(command, encoding):
+    """Return the decoded output of a command or None if it failed."""
+    try:
+        with open(os.devnull, 'w') as shutup:
+            out = subprocess.check_output(command, stderr=shutup)
+    except (OSError, subprocess.CalledProcessError):
+        # OSError is raised if the program is not installed, and a
+        # CalledProcessError e.g. if none of the job ids is known.
+        return None
+    return out.decode(encoding)
+
+
+def _query_output(command, encoding, unknown_jobs_error):
+    """Return the decoded output of a query of the queue.
+
+    A RuntimeError is raised if the query failed, except if the scheduler
+    only complains about job ids it does not know, i.e. its error contains
+    ``unknown_jobs_error``.
+    """
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except OSError as exception:
+        raise RuntimeError("Failed to run %s: %s" % (command[0], exception))
+
+    out, err = process.communicate()
+    out = out.decode(encoding, "replace")
+    err = err.decode(encoding, "replace")
+    if process.returncode != 0 and unknown_jobs_error not in out + err:
+        raise RuntimeError("%s failed with exit status %s: %s"
+                           % (command[0], process.returncode, err.strip()))
     return out
 
 
+def _parse_slurm_states(output, job_ids, states):
+    """Add the states of the jobs from lines "job_id|state"."""
+    for line in output.splitlines():
+        if "|" not in line:
+            continue
+        job_id, state = line.split("|", 1)
+        # Tasks of an array job are reported as "job_id_task_id"
+        job_id = job_id if job_id in job_ids else job_id.split("_")[0]
+        # sacct reports e.g. "CANCELLED by 1000"
+        state = state.split(" ")[0] if state.strip() else None
+        if job_id in job_ids and state and job_id not in states:
+            states[job_id] = state
+
+
+def _slurm_job_states(job_ids, encoding='utf-8'):
+    """Get the states of jobs with squeue, then sacct for ended jobs."""
+    states = {}
+    output = _query_output(["squeue", "--noheader", "-o", "%i|%T", "-j",
+                            ",".join(job_ids)], encoding,
+                           "Invalid job id specified")
+    _parse_slurm_states(output, job_ids, states)
+
+    # The jobs missing from the queue have ended, without accounting their
+    # final state is unknown.
+    missing = [job_id for job_id in job_ids if job_id not in states]
+    if missing:
+        output = _check_output(["sacct", "--noheader", "--parsable2",
+                                "--allocations", "-o", "JobID,State", "-j",
+                                ",".join(missing)], encoding)
+        if output is not None:
+            _parse_slurm_states(output, job_ids, states)
+    return states
+
+
+def _parse_qacct_state(output):
+    """Return the final state of a job from the output of qacct -j."""
+    codes = []
+    for line in output.splitlines():
+        fields = line.split(None, 1)
+        if len(fields) == 2 and fields[0] in ("failed", "exit_status"):
+            codes.append(fields[1].split()[0])
+    if not codes:
+        return None
+    # SGE does not tell apart reliably jobs killed for exceeding their
+    # time limit from jobs killed for exceeding their memory limit.
+    return "COMPLETED" if all(code == "0" for code in codes) else "FAILED"
+
+
+def _sge_job_states(job_ids, encoding='utf-8'):
+    """Get the states of jobs with qstat -j, then qacct for ended jobs."""
+    states = {}
+    output = _query_output(["qstat", "-xml", "-j", ",".join(job_ids)],
+                           encoding, "do not exist")
+    try:
+        tree = XML(output.encode(encoding),
+                   parser=XMLParser(encoding=encoding))
+    except ParseError:
+        # Only the error message, none of the jobs is queued or running
+        tree = None
+    if tree is not None:
+        for elem in tree.iter():
+            job_id = _findtext(elem, "JB_job_number")
+            if job_id in job_ids and job_id not in states:
+                # Only the tasks which have started are listed
+                tasks = elem.find("JB_ja_tasks")
+                states[job_id] = ("RUNNING" if tasks is not None and
+                                  len(tasks) else "PENDING")
+
+    for job_id in job_ids:
+        if job_id not in states:
+            output = _check_output(["qacct", "-j", job_id], encoding)
+            state = None if output is None else _parse_qacct_state(output)
+            if state is not None:
+                states[job_id] = state
+    return states
+
+
+def _local_job_states(job_ids, encoding='utf-8'):
+    """Get the states of jobs from the local backend."""
+    from .local import list_jobs
+    return dict((job["job_id"], job["state"])
+                for job in list_jobs(finished=True)
+                if job["job_id"] in job_ids)
+
+
+_JOB_STATE_QUERIES = {
+    "sge": _sge_job_states,
+    "slurm": _slurm_job_states,
+    "local": _local_job_states,
+}
+
+
+def job_states(job_ids, backend="auto", encoding='utf-8'):
+    """Return the states of some jobs given their ids.
+
+    Contrarily to :func:`queued_or_running_jobs`, only the given jobs are
+    queried, e.g. with ``squeue -j`` for SLURM or ``qstat -j`` for SGE, thus
+    the cost of the query does not depend on the size of the queue. The
+    final state of the jobs which have left the queue is queried from the
+    accounting of the scheduler, i.e. ``sacct`` for SLURM or ``qacct`` for
+    SGE.
+
+    Parameters
+    ----------
+    job_ids : list of str
+        Ids of the jobs.
+
+    backend : {'auto', 'slurm', 'sge', 'local'}, optional (default="auto")
+        Backend of the jobs, see :func:`submit`.
+
+    encoding : str, (default='utf-8')
+        Encoding to decode the output of the scheduler.
+
+    Returns
+    -------
+    states : dict of (str, str)
+        State of each job known by the scheduler, given by its SLURM name,
+        e.g. "PENDING", "RUNNING", "COMPLETED", "FAILED", "TIMEOUT" or
+        "CANCELLED". Jobs which are unknown, e.g. ended without
+        accounting, are missing. The states of SGE jobs are either
+        "PENDING", "RUNNING", "COMPLETED" or "FAILED".
+
+    Raises
+    ------
+    RuntimeError
+        If the queue could not be queried, e.g. the scheduler is not
+        responding. A job missing from the answer is thus known to have
+        left the queue.
+
+    """
+    job_ids = [str(job_id) for job_id in job_ids]
+    if not job_ids:
+        return {}
+    backend = _get_backend(backend)
+    return _JOB_STATE_QUERIES[backend](job_ids, encoding=encoding)
+
+
 _SGE_TEMPLATE = {
     "job_name": '-N "%s"',
     "memory": "-l h_vmem=%sM",
@@ -166,6 +761,14 @@ _SGE_TEMPLATE = {
     # the qsub command it-self is responsible for doing the interpolation
     # in the filename.
     "log_directory": "-j y -o '%s/$JOB_NAME.$JOB_ID.txt'",
+    "array_log_directory": "-j y -o '%s/$JOB_NAME.$JOB_ID.$TASK_ID.txt'",
+    "array": "-t 1-%s",
+    "max_concurrent": "-tc %s",
+    # The name of the parallel environment depends on the cluster
+    "cpus": "-pe smp %s",
+    # The job is held until the listed jobs have ended, whatever their
+    # exit status.
+    "dependencies": "-hold_jid %s",
 }
 
 _SLURM_TEMPLATE = {
@@ -175,18 +778,114 @@ _SLURM_TEMPLATE = {
     "email": "--mail-user=%s",
     "email_options": "--mail-type=%s",
     "log_directory": "-o %s/%s.%%j.txt",
+    "array_log_directory": "-o %s/%s.%%A.%%a.txt",
+    "array": "--array=1-%s",
+    "max_concurrent": "%%%s",
+    "cpus": "--cpus-per-task=%s",
+    "dependencies": "--dependency=afterok:%s",
+}
+
+# The local backend accepts the same options as SLURM, apart from job arrays
+# and dependencies.
+_LOCAL_TEMPLATE = dict((option, _SLURM_TEMPLATE[option])
+                       for option in ["job_name", "memory", "time", "email",
+                                      "email_options", "log_directory",
+                                      "cpus"])
+
+# Separator of the job ids in the dependencies option
+_DEPENDENCY_SEPARATOR = {
+    "sge": ",",
+    "slurm": ":",
+}
+
+# Environment variables holding the index of a task of a job array
+_ARRAY_TASK_ID = {
+    "sge": "SGE_TASK_ID",
+    "slurm": "SLURM_ARRAY_TASK_ID",
 }
 
 _TEMPLATE = {
     "sge": _SGE_TEMPLATE,
-    "slurm": _SLURM_TEMPLATE
+    "slurm": _SLURM_TEMPLATE,
+    "local": _LOCAL_TEMPLATE,
 }
 
 _LAUNCHER = {
     "sge": "qsub",
     "slurm": "sbatch",
+    "local": "%s -m clusterlib.local submit" % quote(sys.executable),
 }
 
+# Same options as an argument vector given to the launcher without any shell,
+# thus without quoting.
+_ARGV_TEMPLATE = {
+    "sge": {
+        "job_name": ["-N", "%s"],
+        "memory": ["-l", "h_vmem=%sM"],
+        "time": ["-l", "h_rt=%s"],
+        "email": ["-M", "%s"],
+        "email_options": ["-m", "%s"],
+        "log_directory": ["-j", "y", "-o", "%s/$JOB_NAME.$JOB_ID.txt"],
+        "dependencies": ["-hold_jid", "%s"],
+    },
+    "slurm": {
+        "job_name": ["--job-name=%s"],
+        "memory": ["--mem=%s"],
+        "time": ["--time=%s"],
+        "email": ["--mail-user=%s"],
+        "email_options": ["--mail-type=%s"],
+        "log_directory": ["-o", "%s/%s.%%j.txt"],
+        "dependencies": ["--dependency=afterok:%s"],
+    },
+}
+_ARGV_TEMPLATE["local"] = dict((option, _ARGV_TEMPLATE["slurm"][option])
+                               for option in _LOCAL_TEMPLATE
+                               if option in _ARGV_TEMPLATE["slurm"])
+
+
+def _job_options(backend, job_name, time, memory, email, email_options,
+                 log_directory, array=False, argv=False):
+    """Format the options of the submission query.
+
+    If argv is True, the options are an argument vector for the launcher.
+    """
+    if backend in _TEMPLATE:
+        template = (_ARGV_TEMPLATE if argv else _TEMPLATE)[backend]
+    else:
+        raise ValueError("Unknown backend %s expected any of %s"
+                         % (backend, "{%s}" % ",".join(_TEMPLATE)))
+
+    job_options = []
+
+    def add(option, args):
+        if argv:
+            # Only the tokens with a placeholder are formatted
+            job_options.extend(token % args if "%" in token else token
+                               for token in template[option])
+        else:
+            job_options.append(template[option] % args)
+
+    add("job_name", job_name)
+    add("time", time)
+    add("memory", memory)
+
+    if email:
+        add("email", email)
+
+    if email_options:
+        add("email_options", email_options)
+
+    if log_directory is not None:
+        # SGE is non-robust to non absolute path
+        log_directory = os.path.abspath(log_directory)
+        log_option = "array_log_directory" if array else "log_directory"
+        if backend == "sge":
+            add(log_option, log_directory)
+        else:
+            add(log_option, (log_directory, job_name))
+
+    return job_options
+
 
 def submit(job_command, job_name="job", time="24:00:00", memory=4000,
            email=None, email_options=None, log_directory=None, backend="auto",
@@ -222,12 +921,15 @@ def submit(job_command, job_name="job", time="24:00:00", memory=4000,
         Job logs will be at log_directory with the name ``job_name.job_id.txt``
         where the ``job_id`` is given by the scheduler.
 
-    backend : {'auto', 'slurm', 'sge'}, optional (default="auto")
+    backend : {'auto', 'slurm', 'sge', 'local'}, optional (default="auto")
         Backend where the job will be submitted. If 'auto', try detect
         the backend to use based on the commands available in the PATH
         variable looking first for 'slurm' and then for 'sge' if slurm is
         not found. The default backend selected when backend='auto' can also
         be fixed by setting the "CLUSTERLIB_BACKEND" environment variable.
+        The 'local' backend, which runs the jobs on the current host with
+        :mod:`clusterlib.local`, is never detected but must be selected
+        explicitly.
 
     shell_script : str, optional (default="#!/bin/bash")
         Specify shell that is used by the script.
@@ -254,33 +956,9 @@ def submit(job_command, job_name="job", time="24:00:00", memory=4000,
 
     """
     backend = _get_backend(backend)
-    if backend in _TEMPLATE:
-        launcher = _LAUNCHER[backend]
-        template = _TEMPLATE[backend]
-    else:
-        raise ValueError("Unknown backend %s expected any of %s"
-                         % (backend, "{%s}" % ",".join(_TEMPLATE)))
-
-    job_options = [
-        template["job_name"] % job_name,
-        template["time"] % time,
-        template["memory"] % memory,
-    ]
-
-    if email:
-        job_options.append(template["email"] % email)
-
-    if email_options:
-        job_options.append(template["email_options"] % email_options)
-
-    if log_directory is not None:
-        # SGE is non-robust to non absolute path
-        log_directory = os.path.abspath(log_directory)
-        if backend == "sge":
-            job_options.append(template["log_directory"] % log_directory)
-        elif backend == "slurm":
-            job_options.append(template["log_directory"]
-                               % (log_directory, job_name))
+    launcher = _LAUNCHER[backend]
+    job_options = _job_options(backend, job_name, time, memory, email,
+                               email_options, log_directory)
 
     # Using echo job_commands | launcher job_options allows to avoid creating
     # a script file. The script is indeed created on the flight.
@@ -288,3 +966,599 @@ def submit(job_command, job_name="job", time="24:00:00", memory=4000,
                % (shell_script, job_command, launcher, " ".join(job_options)))
 
     return command
+
+
+def launch(job_command, job_name="job", time="24:00:00", memory=4000,
+           email=None, email_options=None, log_directory=None, backend="auto",
+           shell_script="#!/bin/bash", options=None, encoding="utf-8"):
+    """Submit a job and return its job id.
+
+    Contrarily to the query written by :func:`submit`, the launcher
+    (``sbatch`` or ``qsub``) is directly executed with an argument vector,
+    while the job script is given on its standard input. No shell is
+    involved, thus the job command can contain any quote and no process is
+    spawned apart from the launcher.
+
+    Parameters
+    ----------
+    job_command : str,
+        Command associated to the job, e.g. 'python main.py'.
+
+    job_name : str, optional (default="job")
+        Name of the job.
+
+    time : str, optional (default="24:00:00")
+        Maximum time format "HH:MM:SS".
+
+    memory : str, optional (default=4000)
+        Maximum virtual memory in mega-bytes
+
+    email : str, optional (default=None)
+        Email where job information is sent. If None, no email is asked
+        to be sent.
+
+    email_options : str, optional (default=None)
+        Specify email options, see :func:`submit`.
+
+    log_directory : str, optional (default=None)
+        Specify the log directory. If None, no log directory is specified.
+        Job logs will be at log_directory with the name ``job_name.job_id.txt``
+        where the ``job_id`` is given by the scheduler.
+
+    backend : {'auto', 'slurm', 'sge', 'local'}, optional (default="auto")
+        Backend where the job will be submitted, see :func:`submit`.
+
+    shell_script : str, optional (default="#!/bin/bash")
+        Specify shell that is used by the script.
+
+    options : list of str or None, optional (default=None)
+        Further arguments given to the launcher, e.g. ``["--partition=long"]``.
+
+    encoding : str, optional (default='utf-8')
+        Encoding of the job script and of the output of the launcher.
+
+    Returns
+    -------
+    job_id : str
+        Job id given by the scheduler.
+
+    """
+    backend = _get_backend(backend)
+    job_options = _job_options(backend, job_name, time, memory, email,
+                               email_options, log_directory, argv=True)
+    if options is not None:
+        job_options.extend(options)
+
+    script = "%s\n%s\n" % (shell_script, job_command)
+    process = subprocess.Popen(shlex.split(_LAUNCHER[backend]) + job_options,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output, error = process.communicate(script.encode(encoding))
+    output = output.decode(encoding)
+    if process.returncode != 0:
+        raise RuntimeError("Failed to submit the job %s with %s:\n%s"
+                           % (job_name, _LAUNCHER[backend],
+                              error.decode(encoding)))
+
+    return parse_job_id(output)
+
+
+def _topological_order(jobs, dependencies):
+    """Order the jobs such that each job comes after its dependencies."""
+    for name, parents in dependencies.items():
+        for job in [name] + list(parents):
+            if job not in jobs:
+                raise ValueError("Unknown job %r in the dependencies." % job)
+
+    children = dict((name, []) for name in jobs)
+    n_parents = dict((name, 0) for name in jobs)
+    for name, parents in dependencies.items():
+        for parent in set(parents):
+            children[parent].append(name)
+            n_parents[name] += 1
+
+    ready = sorted(name for name in jobs if n_parents[name] == 0)
+    order = []
+    while ready:
+        name = ready.pop(0)
+        order.append(name)
+        for child in sorted(children[name]):
+            n_parents[child] -= 1
+            if n_parents[child] == 0:
+                ready.append(child)
+
+    if len(order) != len(jobs):
+        raise ValueError("The dependencies have a cycle between the jobs %s."
+                         % sorted(set(jobs) - set(order)))
+    return order
+
+
+def _dependency_options(backend, job_ids):
+    """Format the argument vector of the dependencies on some jobs."""
+    return [token % _DEPENDENCY_SEPARATOR[backend].join(job_ids)
+            if "%" in token else token
+            for token in _ARGV_TEMPLATE[backend]["dependencies"]]
+
+
+def submit_dag(jobs, dependencies=None, max_dependencies=100,
+               backend="auto", encoding="utf-8"):
+    """Submit a graph of jobs whose dependencies are handled by the scheduler.
+
+    All the jobs are submitted at once with :func:`launch`, each job after
+    its dependencies, so that the scheduler starts a job as soon as its
+    dependencies are done without any polling. With SLURM, a job starts
+    only if all its dependencies succeeded (``--dependency=afterok``).
+    With SGE, a job starts once all its dependencies have ended
+    (``-hold_jid``), whatever their exit status.
+
+    Whenever a job depends on more than ``max_dependencies`` jobs, the
+    dependencies are gathered by chunk through barrier jobs, which do
+    nothing apart from waiting for a chunk of dependencies.
+
+    The submission is not atomic: if a job fails to be submitted, the jobs
+    submitted before it stay queued. The exception raised by :func:`launch`
+    is then given the ``job_ids`` attribute, the job id of each submitted
+    job of the graph indexed by its name, and the ``barrier_ids`` attribute,
+    the list of the job ids of the submitted barrier jobs, e.g. to cancel
+    them before submitting the graph again.
+
+    Parameters
+    ----------
+    jobs : dict
+        Specification of each job indexed by its name, either a job command
+        or a dict of the parameters of :func:`launch`, e.g.
+        ``{"job_command": "python fit.py", "memory": 8000}``. If missing, the
+        job name is the name of the job in the graph.
+
+    dependencies : dict or None, optional (default=None)
+        List of the names of the jobs on which each job depends, indexed by
+        the name of the job. If None, the jobs are independent.
+
+    max_dependencies : int, optional (default=100)
+        Maximal number of jobs on which a submitted job depends.
+
+    backend : {'auto', 'slurm', 'sge'}, optional (default="auto")
+        Backend where the jobs will be submitted, see :func:`submit`.
+
+    encoding : str, optional (default='utf-8')
+        Encoding of the job scripts and of the output of the launcher.
+
+    Returns
+    -------
+    job_ids : dict
+        Job id given by the scheduler of each job indexed by its name.
+
+    Examples
+    --------
+    Here, the fits start once the preprocessing is done and the results
+    are aggregated once all the fits are done.
+
+    >>> from clusterlib.scheduler import submit_dag
+    >>> jobs = {"preprocess": "python preprocess.py",
+    ...         "aggregate": "python aggregate.py"}
+    >>> dependencies = {"aggregate": []}
+    >>> for i in range(1000):
+    ...     jobs["fit-%s" % i] = "python fit.py --fold %s" % i
+    ...     dependencies["fit-%s" % i] = ["preprocess"]
+    ...     dependencies["aggregate"].append("fit-%s" % i)
+    >>> job_ids = submit_dag(jobs, dependencies)  # doctest: +SKIP
+
+    """
+    if max_dependencies < 2:
+        raise ValueError("max_dependencies should be at least 2, got %r"
+                         % max_dependencies)
+
+    backend = _get_backend(backend)
+    if "dependencies" not in _TEMPLATE[backend]:
+        raise ValueError("Dependencies are not supported by the %s backend."
+                         % backend)
+    if dependencies is None:
+        dependencies = {}
+
+    job_ids = {}
+    all_barrier_ids = []
+    try:
+        for name in _topological_order(jobs, dependencies):
+            params = jobs[name]
+            if not isinstance(params, dict):
+                params = {"job_command": params}
+            params = dict(params, backend=backend, encoding=encoding)
+            params.setdefault("job_name", name)
+
+            parent_ids = sorted(set(job_ids[parent]
+                                    for parent in dependencies.get(name, [])))
+            n_barriers = 0
+            while len(parent_ids) > max_dependencies:
+                barrier_ids = []
+                for start in range(0, len(parent_ids), max_dependencies):
+                    barrier_ids.append(launch(
+                        "true", job_name="%s.barrier%s" % (params["job_name"],
+                                                           n_barriers),
+                        time="00:05:00", memory=100,
+                        log_directory=params.get("log_directory"),
+                        backend=backend,
+                        options=_dependency_options(
+                            backend,
+                            parent_ids[start:start + max_dependencies]),
+                        encoding=encoding))
+                    all_barrier_ids.append(barrier_ids[-1])
+                    n_barriers += 1
+                parent_ids = barrier_ids
+
+            if parent_ids:
+                params["options"] = (list(params.get("options") or []) +
+                                     _dependency_options(backend, parent_ids))
+
+            job_ids[name] = launch(**params)
+
+    except Exception as exception:
+        # The jobs already submitted stay queued
+        exception.job_ids = job_ids
+        exception.barrier_ids = all_barrier_ids
+        raise
+
+    return job_ids
+
+
+def _array_script(job_commands, backend, shell_script):
+    """Write a script running the command selected by the array task id."""
+    lines = [shell_script,
+             'case "$%s" in' % _ARRAY_TASK_ID[backend]]
+    for task_id, job_command in enumerate(job_commands, 1):
+        lines.extend(["%s)" % task_id, job_command, ";;"])
+    lines.extend(["*)",
+                  'echo "Unknown task id: $%s" >&2' % _ARRAY_TASK_ID[backend],
+                  "exit 1",
+                  ";;",
+                  "esac",
+                  ""])
+    return "\n".join(lines)
+
+
+def submit_array(job_commands, script_directory, job_name="job",
+                 time="24:00:00", memory=4000, email=None, email_options=None,
+                 log_directory=None, backend="auto",
+                 shell_script="#!/bin/bash", parameters=None,
+                 max_concurrent=None, max_array_size=1000):
+    """Write the submission queries of a job array.
+
+    Submitting a large number of jobs one at a time floods the scheduler
+    and hits quickly the limits on the number of submitted jobs. With a job
+    array, all the commands are submitted at once as the tasks of a single
+    job. The commands are written into a script in ``script_directory``,
+    each task running the command selected by its index given by the
+    scheduler. Arrays larger than ``max_array_size`` are split into several
+    job arrays.
+
+    Parameters
+    ----------
+    job_commands : list of str or str
+        Command associated to each task, e.g. 'python main.py --param 1'. If
+        ``parameters`` is given, a command template formatted with each dict
+        of parameters, e.g. 'python main.py --param %(param)s'.
+
+    script_directory : str
+        Directory where the scripts of the job arrays are written. It must
+        be accessible from the computing nodes.
+
+    job_name : str, optional (default="job")
+        Name of the job arrays.
+
+    time : str, optional (default="24:00:00")
+        Maximum time format "HH:MM:SS" of each task.
+
+    memory : str, optional (default=4000)
+        Maximum virtual memory in mega-bytes of each task.
+
+    email : str, optional (default=None)
+        Email where job information is sent. If None, no email is asked
+        to be sent.
+
+    email_options : str, optional (default=None)
+        Specify email options, see :func:`submit`.
+
+    log_directory : str, optional (default=None)
+        Specify the log directory. If None, no log directory is specified.
+        Task logs will be at log_directory with the name
+        ``job_name.job_id.task_id.txt`` where the ``job_id`` is given by the
+        scheduler and ``task_id`` is the index of the task in the array.
+
+    backend : {'auto', 'slurm', 'sge'}, optional (default="auto")
+        Backend where the job will be submitted, see :func:`submit`.
+
+    shell_script : str, optional (default="#!/bin/bash")
+        Specify shell that is used by the script.
+
+    parameters : list of dict or None, optional (default=None)
+        Table of parameters, each row is used to format ``job_commands``.
+
+    max_concurrent : int or None, optional (default=None)
+        Maximal number of tasks of each job array running at once. If None,
+        the number of running tasks is not limited.
+
+    max_array_size : int, optional (default=1000)
+        Maximal number of tasks of a job array, which is limited by the
+        scheduler configuration, e.g. by MaxArraySize in SLURM.
+
+    Returns
+    -------
+    submission_queries : list of str,
+        Return the submission query of each job array in the appropriate
+        format. Task ``i`` of job array ``j`` runs the command
+        ``j * max_array_size + i - 1``.
+
+    Examples
+    --------
+    >>> from tempfile import mkdtemp
+    >>> from clusterlib.scheduler import submit_array
+    >>> script_directory = mkdtemp()
+    >>> queries = submit_array("python main.py --param %(param)s",
+    ...                        script_directory,
+    ...                        parameters=[{"param": p} for p in range(5)],
+    ...                        max_concurrent=2, backend="slurm")
+    >>> print(queries[0].replace(script_directory, "..."))
+    sbatch --job-name=job --time=24:00:00 --mem=4000 --array=1-5%2 .../job.0.sh
+
+    """
+    backend = _get_backend(backend)
+    launcher = _LAUNCHER[backend]
+    template = _TEMPLATE[backend]
+    if "array" not in template:
+        raise ValueError("Job arrays are not supported by the %s backend."
+                         % backend)
+
+    if parameters is not None:
+        job_commands = [job_commands % params for params in parameters]
+    elif isinstance(job_commands, type("")):
+        job_commands = [job_commands]
+
+    if max_array_size < 1:
+        raise ValueError("max_array_size should be positive, got %r"
+                         % max_array_size)
+
+    job_options = _job_options(backend, job_name, time, memory, email,
+                               email_options, log_directory, array=True)
+    script_directory = os.path.abspath(script_directory)
+
+    queries = []
+    for chunk, start in enumerate(range(0, len(job_commands),
+                                        max_array_size)):
+        commands = job_commands[start:start + max_array_size]
+        script_name = os.path.join(script_directory,
+                                   "%s.%s.sh" % (job_name, chunk))
+        with open(script_name, "wb") as fhandle:
+            fhandle.write(_array_script(commands, backend,
+                                        shell_script).encode("utf-8"))
+
+        array_options = [template["array"] % len(commands)]
+        if max_concurrent is not None:
+            if backend == "slurm":
+                # The throttle is a suffix of the array range
+                array_options[0] += template["max_concurrent"] % max_concurrent
+            else:
+                array_options.append(template["max_concurrent"]
+                                     % max_concurrent)
+
+        queries.append("%s %s %s" % (launcher,
+                                     " ".join(job_options + array_options),
+                                     script_name))
+
+    return queries
+
+
+# Job id in the output of sbatch, sbatch --parsable, qsub and qsub -terse
+_JOB_ID_PATTERNS = [
+    re.compile(r"^Submitted batch job (\d+)", re.MULTILINE),
+    re.compile(r"^Your job(?:-array)? (\d+)", re.MULTILINE),
+    re.compile(r"^(\d+)(?:[;.]\S*)?\s*$", re.MULTILINE),
+]
+
+# Errors of a submission which are worth retrying, e.g. an overloaded
+# controller or a full queue
+_TRANSIENT_ERRORS = [
+    "socket timed out",
+    "temporarily unavailable",
+    "try again",
+    "unable to contact qmaster",
+    "unable to send message to qmaster",
+    "slurm_persist_conn_open",
+    "job submit limit",
+    "maxsubmitjobs",
+]
+
+
+def parse_job_id(output):
+    """Parse the job id from the output of a submission command.
+
+    The output of ``sbatch``, ``sbatch --parsable``, ``qsub`` and
+    ``qsub -terse`` is supported, for both single jobs and job arrays.
+    Lines such as warnings printed before the job id are ignored.
+
+    Parameters
+    ----------
+    output : str
+        Standard output of the submission command.
+
+    Returns
+    -------
+    job_id : str
+        Job id given by the scheduler.
+
+    Examples
+    --------
+    >>> from clusterlib.scheduler import parse_job_id
+    >>> print(parse_job_id("Submitted batch job 1234"))
+    1234
+    >>> print(parse_job_id('Your job-array 42.1-10:1 ("job") has been '
+    ...                    'submitted'))
+    42
+
+    """
+    for pattern in _JOB_ID_PATTERNS:
+        match = pattern.search(output)
+        if match is not None:
+            return match.group(1)
+
+    raise ValueError("Failed to parse the job id from the output:\n%s"
+                     % output)
+
+
+class SubmissionReceipt(namedtuple("SubmissionReceipt",
+                                   ["query", "job_id", "returncode",
+                                    "output", "error", "n_attempts"])):
+    """Outcome of a submission query launched by :func:`dispatch`.
+
+    Attributes
+    ----------
+    query : str
+        Submission query.
+
+    job_id : str or None
+        Job id given by the scheduler, None if the submission failed.
+
+    returncode : int
+        Exit status of the last attempt.
+
+    output : str
+        Standard output of the last attempt.
+
+    error : str
+        Standard error of the last attempt.
+
+    n_attempts : int
+        Number of times the query was launched.
+
+    """
+    __slots__ = ()
+
+
+class _RateLimiter(object):
+    """Space out the calls of several threads to at most rate per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_call = 0.
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.rate is None:
+            return
+
+        with self.lock:
+            now = time.time()
+            wait_time = self.next_call - now
+            self.next_call = max(now, self.next_call) + 1. / self.rate
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def _is_transient(error):
+    """Check if the error of a submission is worth retrying."""
+    error = error.lower()
+    return any(message in error for message in _TRANSIENT_ERRORS)
+
+
+def _launch_query(query, rate_limiter, max_retries, backoff, encoding):
+    """Launch a submission query until it succeeds or fails for good."""
+    delay = backoff
+    n_attempts = 0
+    while True:
+        rate_limiter.wait()
+        n_attempts += 1
+        process = subprocess.Popen(query.encode(encoding), shell=True,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        output, error = process.communicate()
+        output = output.decode(encoding)
+        error = error.decode(encoding)
+
+        if process.returncode == 0:
+            try:
+                job_id = parse_job_id(output)
+            except ValueError:
+                job_id = None
+            break
+
+        job_id = None
+        if n_attempts > max_retries or not _is_transient(error):
+            break
+
+        # The jitter avoids that the retries hit the scheduler together
+        time.sleep(delay * random.uniform(0.5, 1.5))
+        delay *= 2
+
+    return SubmissionReceipt(query, job_id, process.returncode, output,
+                             error, n_attempts)
+
+
+def dispatch(queries, n_jobs=1, rate=None, max_retries=3, backoff=1.,
+             encoding="utf-8"):
+    """Launch submission queries and collect the job ids.
+
+    The queries, e.g. generated with :func:`submit` or :func:`submit_array`,
+    are launched by ``n_jobs`` threads while at most ``rate`` queries are
+    started per second, so as not to overload the scheduler. Queries which
+    fail with a transient error, e.g. a timeout of the scheduler or a full
+    queue, are retried with an exponential backoff.
+
+    Failed submissions do not raise an exception, their receipt has a
+    ``job_id`` set to None.
+
+    Parameters
+    ----------
+    queries : list of str
+        Submission queries launched through the shell.
+
+    n_jobs : int, optional (default=1)
+        Number of queries launched concurrently.
+
+    rate : float or None, optional (default=None)
+        Maximal number of queries started per second. If None, the rate is
+        not limited.
+
+    max_retries : int, optional (default=3)
+        Maximal number of retries of a query failing with a transient error.
+
+    backoff : float, optional (default=1.)
+        Delay in seconds before the first retry, which is doubled at each
+        retry.
+
+    encoding : str, optional (default='utf-8')
+        Encoding of the queries and of their output.
+
+    Returns
+    -------
+    receipts : list of SubmissionReceipt
+        Receipt of each query, in the order of the queries.
+
+    Examples
+    --------
+    >>> from clusterlib.scheduler import dispatch
+    >>> receipts = dispatch(["echo 'Submitted batch job 1'",
+    ...                      "echo 'Your job 2 has been submitted'"],
+    ...                     n_jobs=2, rate=10.)
+    >>> print(" ".join(receipt.job_id for receipt in receipts))
+    1 2
+
+    """
+    if n_jobs < 1:
+        raise ValueError("n_jobs should be positive, got %r" % n_jobs)
+    if rate is not None and rate <= 0:
+        raise ValueError("rate should be positive, got %r" % rate)
+
+    rate_limiter = _RateLimiter(rate)
+
+    def launch(query):
+        return _launch_query(query, rate_limiter, max_retries, backoff,
+                             encoding)
+
+    if n_jobs == 1 or len(queries) <= 1:
+        return [launch(query) for query in queries]
+
+    pool = ThreadPool(min(n_jobs, len(queries)))
+    try:
+        return pool.map(launch, queries)
+    finally:
+        pool.close()
+        pool.join()
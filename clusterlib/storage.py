@@ -7,21 +7,82 @@ library and `sqlite3 <http://www.sqlite.org/>`_.
 This can be used to cache results of functions or scripts in distributed
 environments.
 
+Maintenance of a database can be done from the command line, for instance::
+
+    python -m clusterlib.storage stats results.sqlite3
+    python -m clusterlib.storage vacuum --mode full results.sqlite3
+    python -m clusterlib.storage snapshot results.sqlite3 /tmp/results.sqlite3
+
 """
 # Authors: Arnaud Joly
 #
 # License: BSD 3 clause
 from __future__ import unicode_literals
 
+import argparse
+import hashlib
+import json
+import math
 import os
+import shutil
 import sqlite3
+import struct
+import sys
 import pickle
+import random
+import time
+import warnings
+from collections import deque
+from contextlib import closing
+from contextlib import contextmanager
+from itertools import product
+from multiprocessing import cpu_count
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from tempfile import mkstemp
 
 __all__ = [
+    "sqlite3_iterloads",
     "sqlite3_loads",
     "sqlite3_dumps",
+    "sqlite3_loads_fields",
+    "sqlite3_dumps_fields",
+    "grid_index",
+    "sqlite3_gather",
+    "sqlite3_gather_frame",
+    "sqlite3_cache_loads",
+    "sqlite3_cache_dumps",
+    "sqlite3_cache_sweep",
+    "sqlite3_bloom",
+    "sqlite3_contains",
+    "sqlite3_stats",
+    "sqlite3_vacuum",
+    "sqlite3_snapshot",
 ]
 
+# os.replace is atomic on every platform, but only available for Python 3.3+.
+_replace = getattr(os, "replace", os.rename)
+
+_AUTO_VACUUM = {0: "none", 1: "full", 2: "incremental"}
+
+# Order in which entries are evicted from the cache for each policy
+_EVICTION_ORDER = {"lru": "atime", "lfu": "hits, atime"}
+
+# Seconds to wait for the lock to record accesses to the cache
+_ACCESS_TIMEOUT = 1.0
+
+# Header of the Bloom filter files: magic string, bits and hash functions
+_BLOOM_MAGIC = b"CLBLOOM1"
+_BLOOM_HEADER = str(">8sQI")
+
+# Python types stored natively by sqlite3 in the fields table
+_TEXT_TYPE = type("")
+_NATIVE_TYPES = (int, float, _TEXT_TYPE)
+try:
+    _BLOB_TYPES = (bytes, buffer)
+except NameError:  # Python 3
+    _BLOB_TYPES = (bytes, )
+
 
 def _decompressed(value):
     """Decompressed a binary object compressed with pickle from sqlite3."""
@@ -34,7 +95,163 @@ def _compressed(value):
                                        protocol=pickle.HIGHEST_PROTOCOL))
 
 
-def sqlite3_loads(file_name, key=None, timeout=7200.0):
+def _decompressed_chunk(values):
+    """Decompressed a list of binary objects, used by the worker pools."""
+    return [_decompressed(value) for value in values]
+
+
+def _effective_n_jobs(n_jobs):
+    """Return the number of workers, negative values counting from cpus."""
+    if n_jobs == 0:
+        raise ValueError("n_jobs == 0 has no meaning.")
+    if n_jobs < 0:
+        n_jobs = max(cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
+def _exists(file_name):
+    """Check if there is a database at file_name or if it is a connection."""
+    return (isinstance(file_name, sqlite3.Connection) or
+            os.path.exists(file_name))
+
+
+@contextmanager
+def _reader(file_name, timeout):
+    """Open a connection to read the database, unless it is one already."""
+    if isinstance(file_name, sqlite3.Connection):
+        yield file_name
+    else:
+        with closing(sqlite3.connect(file_name,
+                                     timeout=timeout)) as connection:
+            yield connection
+
+
+def _iter_raw(connection, key, chunk_size):
+    """Yield chunks of raw (key, value) pairs read from the database."""
+    cursor = connection.cursor()
+    try:
+        if key is None:
+            cursor.execute("SELECT key, value FROM dict")
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [(k, bytes(value)) for k, value in rows]
+
+        else:
+            rows = []
+            for k in key:
+                cursor.execute("SELECT value FROM dict where key = ?", (k,))
+                value = cursor.fetchone()  # key is the primary key
+                if value is not None:
+                    rows.append((k, bytes(value[0])))
+                    if len(rows) >= chunk_size:
+                        yield rows
+                        rows = []
+            if rows:
+                yield rows
+    finally:
+        cursor.close()
+
+
+def sqlite3_iterloads(file_name, key=None, timeout=7200.0, n_jobs=1,
+                      pool="process", chunk_size=256):
+    """Iterate over (key, value) pairs stored in the sqlite3 database.
+
+    A single reader streams the raw pickled values from the database while
+    ``n_jobs`` workers decode them. Pairs are yielded in a deterministic
+    order: the order of ``key`` if given, the storage order otherwise.
+    At most ``2 * n_jobs`` chunks are in flight at any time so that memory
+    usage stays bounded whatever the size of the database.
+
+    Parameters
+    ----------
+    file_name : str or sqlite3.Connection
+        Path to the sqlite database or connection to an in-memory snapshot,
+        see :func:`sqlite3_snapshot`.
+
+    key : str or list of str or None, optional (default=None)
+        Key or list of keys used when the value was stored. If ``key`` is None,
+        all key value pairs are returned from the database.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    n_jobs : int, optional (default=1)
+        Number of workers used to decode the values. If -1, all cpus are
+        used. With ``n_jobs=1``, values are decoded in the calling thread.
+
+    pool : {'process', 'thread'}, optional (default='process')
+        Kind of worker pool. Unpickling is CPU bound and holds the GIL, thus
+        a process pool should be used in general. A thread pool is only
+        useful with values whose decoding releases the GIL.
+
+    chunk_size : int, optional (default=256)
+        Number of values sent at once to a worker.
+
+    Returns
+    -------
+    out : iterator of (str, object)
+        Iterator over the stored key-value pairs. If there is no sqlite3
+        database at ``file_name``, the iterator is empty.
+
+    Examples
+    --------
+    >>> from tempfile import NamedTemporaryFile
+    >>> from clusterlib.storage import sqlite3_dumps
+    >>> from clusterlib.storage import sqlite3_iterloads
+    >>> with NamedTemporaryFile() as fhandle:
+    ...     sqlite3_dumps({"3": 3, "2": 5}, fhandle.name)
+    ...     print(list(sqlite3_iterloads(fhandle.name, key=["3", "2"])))
+    [('3', 3), ('2', 5)]
+
+    """
+    if isinstance(key, str):
+        key = [key]
+
+    if pool not in ("process", "thread"):
+        raise ValueError("Unknown pool %r expected any of {process,thread}"
+                         % pool)
+    n_jobs = _effective_n_jobs(n_jobs)
+
+    if not _exists(file_name):
+        return
+
+    with _reader(file_name, timeout) as connection:
+        chunks = _iter_raw(connection, key, chunk_size)
+
+        if n_jobs == 1:
+            for rows in chunks:
+                for k, value in rows:
+                    yield k, _decompressed(value)
+            return
+
+        workers = (Pool if pool == "process" else ThreadPool)(n_jobs)
+        try:
+            # Keep a bounded window of pending chunks, the results are
+            # consumed in submission order to get a deterministic output.
+            pending = deque()
+            for rows in chunks:
+                keys = [k for k, _ in rows]
+                values = [value for _, value in rows]
+                pending.append((keys, workers.apply_async(_decompressed_chunk,
+                                                          (values,))))
+                if len(pending) >= 2 * n_jobs:
+                    keys, result = pending.popleft()
+                    for pair in zip(keys, result.get()):
+                        yield pair
+
+            while pending:
+                keys, result = pending.popleft()
+                for pair in zip(keys, result.get()):
+                    yield pair
+        finally:
+            workers.terminate()
+            workers.join()
+
+
+def sqlite3_loads(file_name, key=None, timeout=7200.0, n_jobs=1):
     """Load value with key from sqlite3 stored at fname.
 
     In order to improve performance, it's advised to query the database using as
@@ -44,8 +261,9 @@ def sqlite3_loads(file_name, key=None, timeout=7200.0):
 
     Parameters
     ----------
-    file_name : str
-        Path to the sqlite database.
+    file_name : str or sqlite3.Connection
+        Path to the sqlite database or connection to an in-memory snapshot,
+        see :func:`sqlite3_snapshot`.
 
     key : str or list of str or None, optional (default=None)
         Key or list of keys used when the value was stored. If ``key`` is None,
@@ -55,6 +273,10 @@ def sqlite3_loads(file_name, key=None, timeout=7200.0):
         The timeout parameter specifies how long the connection should wait
         for the lock to go away until raising an exception.
 
+    n_jobs : int, optional (default=1)
+        Number of processes used to decode the values, see
+        :func:`sqlite3_iterloads`. If -1, all cpus are used.
+
     Returns
     -------
     out : dict
@@ -89,13 +311,17 @@ def sqlite3_loads(file_name, key=None, timeout=7200.0):
     1
 
     """
+    if n_jobs != 1:
+        return dict(sqlite3_iterloads(file_name, key=key, timeout=timeout,
+                                      n_jobs=n_jobs))
+
     if isinstance(key, str):
         key = [key]
 
     out = dict()
-    if os.path.exists(file_name):
+    if _exists(file_name):
         if key is None:
-            with sqlite3.connect(file_name, timeout=timeout) as connection:
+            with _reader(file_name, timeout) as connection:
                 cursor = connection.cursor()
                 cursor.execute("SELECT key, value FROM dict")
                 out = cursor.fetchall()
@@ -103,7 +329,7 @@ def sqlite3_loads(file_name, key=None, timeout=7200.0):
             out = dict((key, _decompressed(value)) for key, value in out)
 
         else:
-            with sqlite3.connect(file_name, timeout=timeout) as connection:
+            with _reader(file_name, timeout) as connection:
                 cursor = connection.cursor()
                 for k in key:
                     cursor.execute("SELECT value FROM dict where key = ?",
@@ -172,3 +398,1237 @@ def sqlite3_dumps(dictionnary, file_name, timeout=7200.0, overwrite=False):
         else:
             connection.executemany("INSERT INTO dict(key, value) VALUES (?, ?)",
                                    compressed_dict.items())
+
+        # Update the Bloom filter before the commit
+        _bloom_add(file_name, compressed_dict)
+
+
+def _field_value(value):
+    """Keep scalars native for sqlite3, otherwise compress the value."""
+    # Exact types are checked: bool or numpy scalars are pickled so that
+    # their type is preserved.
+    if value is None or type(value) in _NATIVE_TYPES:
+        if type(value) is not int or -2 ** 63 <= value < 2 ** 63:
+            return value
+    return _compressed(value)
+
+
+def _field_loaded(value):
+    """Decompress a field value if it was not stored natively."""
+    if isinstance(value, _BLOB_TYPES):
+        return _decompressed(value)
+    return value
+
+
+def sqlite3_dumps_fields(dictionnary, file_name, timeout=7200.0,
+                         overwrite=False):
+    """Dump dict values field by field in the sqlite3 database.
+
+    Each field of a value is stored in its own row of the ``fields`` table.
+    Scalar fields (None, int, float and str) are stored natively, while
+    others are pickled. A subset of the fields can then be loaded
+    with :func:`sqlite3_loads_fields` without unpickling whole values.
+
+    Parameters
+    ----------
+    dictionnary: dict of (str, dict of (str, object))
+        Each key is a string associated to a dict of fields to store in the
+        database, it will raise an exception if the key is already present in
+        the database.
+
+    file_name : str
+        Path to the sqlite database.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    overwrite : bool, optional (default=False)
+        Whether to overwrite the fields associated to a key already present
+        in the database. If True, all the fields of the key are replaced in
+        case of conflict. If False, an IntegrityError is raised in case of
+        conflict.
+
+    Examples
+    --------
+    >>> from tempfile import NamedTemporaryFile
+    >>> from clusterlib.storage import sqlite3_dumps_fields
+    >>> from clusterlib.storage import sqlite3_loads_fields
+    >>> with NamedTemporaryFile() as fhandle:
+    ...     sqlite3_dumps_fields({"job-1": {"accuracy": 0.9, "time": 10},
+    ...                           "job-2": {"accuracy": 0.8, "time": 12}},
+    ...                          fhandle.name)
+    ...     out = sqlite3_loads_fields(fhandle.name, field="accuracy")
+    ...     print(out["job-1"], out["job-2"])
+    {'accuracy': 0.9} {'accuracy': 0.8}
+
+    """
+    rows = []
+    for key, fields in dictionnary.items():
+        if not isinstance(key, _TEXT_TYPE):
+            raise TypeError("Key %r is not a string." % (key, ))
+        if not isinstance(fields, dict):
+            raise TypeError("Value of key %r is not a dict of fields."
+                            % (key, ))
+        rows.extend((field, key, _field_value(value))
+                    for field, value in fields.items())
+
+    with sqlite3.connect(file_name, timeout=timeout) as connection:
+        # Create table if needed, the primary key allows to read efficiently
+        # a field for all keys and the index all the fields of a key.
+        connection.execute("""CREATE TABLE IF NOT EXISTS fields
+                              (field TEXT, key TEXT, value,
+                               PRIMARY KEY (field, key))""")
+        connection.execute("""CREATE INDEX IF NOT EXISTS fields_key
+                              ON fields (key)""")
+
+        for key in dictionnary:
+            present = connection.execute(
+                "SELECT 1 FROM fields WHERE key = ? LIMIT 1",
+                (key, )).fetchone()
+            if present is not None:
+                if not overwrite:
+                    raise sqlite3.IntegrityError("Key %r is already present "
+                                                 "in the database." % key)
+                connection.execute("DELETE FROM fields WHERE key = ?",
+                                   (key, ))
+
+        connection.executemany("INSERT INTO fields(field, key, value) "
+                               "VALUES (?, ?, ?)", rows)
+        _bloom_add(file_name, dictionnary)
+
+
+def sqlite3_loads_fields(file_name, key=None, field=None, timeout=7200.0):
+    """Load a subset of the fields stored with :func:`sqlite3_dumps_fields`.
+
+    Parameters
+    ----------
+    file_name : str or sqlite3.Connection
+        Path to the sqlite database or connection to an in-memory snapshot,
+        see :func:`sqlite3_snapshot`.
+
+    key : str or list of str or None, optional (default=None)
+        Key or list of keys used when the fields were stored. If ``key`` is
+        None, the fields of all keys are returned from the database.
+
+    field : str or list of str or None, optional (default=None)
+        Field or list of fields to load. If ``field`` is None, all
+        fields are returned.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    Returns
+    -------
+    out : dict
+        Return a dict where each key is associated to a dict of its stored
+        fields. Keys without any of the requested fields are missing from
+        ``out``. If there is no sqlite3 database at ``file_name``, then an
+        empty dictionary is returned.
+
+    """
+    if isinstance(key, str):
+        key = [key]
+    if isinstance(field, str):
+        field = [field]
+
+    out = dict()
+    if not _exists(file_name):
+        return out
+
+    with _reader(file_name, timeout) as connection:
+        cursor = connection.cursor()
+        if field is None and key is None:
+            cursor.execute("SELECT key, field, value FROM fields")
+            rows = cursor
+
+        elif field is None:
+            rows = ((k, f, value)
+                    for k in key
+                    for f, value in cursor.execute(
+                        "SELECT field, value FROM fields WHERE key = ?",
+                        (k, )).fetchall())
+
+        elif key is None:
+            rows = ((k, f, value)
+                    for f in field
+                    for k, value in cursor.execute(
+                        "SELECT key, value FROM fields WHERE field = ?",
+                        (f, )).fetchall())
+
+        else:
+            rows = ((k, f, value[0])
+                    for k in key
+                    for f in field
+                    for value in cursor.execute(
+                        "SELECT value FROM fields WHERE field = ? AND key = ?",
+                        (f, k)).fetchall())
+
+        for k, f, value in rows:
+            out.setdefault(k, dict())[f] = _field_loaded(value)
+        cursor.close()
+
+    return out
+
+
+def _iter_field(file_name, field, key, timeout, chunk_size=1024):
+    """Yield (key, value) pairs of a field stored in the fields table."""
+    if not _exists(file_name):
+        return
+
+    with _reader(file_name, timeout) as connection:
+        cursor = connection.cursor()
+        try:
+            if key is None:
+                cursor.execute("SELECT key, value FROM fields "
+                               "WHERE field = ?", (field, ))
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for k, value in rows:
+                        yield k, _field_loaded(value)
+            else:
+                for k in key:
+                    cursor.execute("SELECT value FROM fields "
+                                   "WHERE field = ? AND key = ?", (field, k))
+                    value = cursor.fetchone()
+                    if value is not None:
+                        yield k, _field_loaded(value[0])
+        finally:
+            cursor.close()
+
+
+def grid_index(key, grid):
+    """Map the keys of a parameter grid to their position in the grid.
+
+    Parameters
+    ----------
+    key : str or callable
+        Either a format string, e.g. ``"job-alpha=%(alpha)s-n=%(n)s"``,
+        formatted with the dict of parameters of each grid point, or a
+        function taking this dict and returning the key.
+
+    grid : list of (str, list)
+        Name and values of each parameter. The order of the parameters gives
+        the order of the axes.
+
+    Returns
+    -------
+    index : dict of (str, tuple of int)
+        Position of each key in the grid, which can be given to
+        :func:`sqlite3_gather`.
+
+    Examples
+    --------
+    >>> from clusterlib.storage import grid_index
+    >>> index = grid_index("alpha=%(alpha)s-n=%(n)s",
+    ...                    [("alpha", [0.1, 1.]), ("n", [10, 100, 1000])])
+    >>> print(index["alpha=1.0-n=10"])
+    (1, 0)
+
+    """
+    key_format = key if callable(key) else key.__mod__
+
+    index = dict()
+    n_points = 0
+    for position in product(*[range(len(values)) for _, values in grid]):
+        params = dict((name, values[i])
+                      for (name, values), i in zip(grid, position))
+        index[key_format(params)] = position
+        n_points += 1
+
+    if len(index) != n_points:
+        raise ValueError("The keys of the grid are not unique.")
+    return index
+
+
+def sqlite3_gather(file_name, index, shape=None, value_shape=(),
+                   dtype="float64", fill_value=0, field=None, timeout=7200.0,
+                   n_jobs=1):
+    """Gather stored values into a preallocated NumPy array.
+
+    Values are streamed from the database straight into the array, thus
+    without building an intermediate dict of all the stored objects.
+    This function requires NumPy.
+
+    Parameters
+    ----------
+    file_name : str or sqlite3.Connection
+        Path to the sqlite database or connection to an in-memory snapshot,
+        see :func:`sqlite3_snapshot`.
+
+    index : dict or callable
+        Position in the array of each key, e.g. obtained with
+        :func:`grid_index`. Only the keys of the dict are loaded. If a
+        function is given, all stored keys are parsed by this function which
+        returns either a position or None to ignore the key.
+
+    shape : int or tuple of int or None, optional (default=None)
+        Shape of the positions. It can be None only if ``index`` is a dict,
+        the smallest shape holding all positions is then used.
+
+    value_shape : tuple of int, optional (default=())
+        Shape of each stored value, the shape of the output array is
+        ``shape + value_shape``.
+
+    dtype : str or numpy dtype, optional (default="float64")
+        Data type of the output array.
+
+    fill_value : scalar, optional (default=0)
+        Value of the array at the position of missing keys.
+
+    field : str or None, optional (default=None)
+        If not None, the values of this field stored with
+        :func:`sqlite3_dumps_fields` are gathered instead of the values
+        stored with :func:`sqlite3_dumps`.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    n_jobs : int, optional (default=1)
+        Number of processes used to decode the values, see
+        :func:`sqlite3_iterloads`. Field values stored natively do not need
+        to be decoded.
+
+    Returns
+    -------
+    out : numpy array of shape ``shape + value_shape``
+        Stored values at their position.
+
+    missing : numpy array of bool of shape ``shape``
+        True at the position of keys missing from the database.
+
+    Examples
+    --------
+    >>> from tempfile import NamedTemporaryFile
+    >>> from clusterlib.storage import grid_index
+    >>> from clusterlib.storage import sqlite3_dumps
+    >>> from clusterlib.storage import sqlite3_gather
+    >>> index = grid_index("p=%(p)s", [("p", [0, 1, 2])])
+    >>> with NamedTemporaryFile() as fhandle:
+    ...     sqlite3_dumps({"p=0": 0.5, "p=2": 2.5}, fhandle.name)
+    ...     out, missing = sqlite3_gather(fhandle.name, index)
+    >>> print(out.tolist(), missing.tolist())
+    [0.5, 0.0, 2.5] [False, True, False]
+
+    """
+    import numpy as np
+
+    if callable(index):
+        if shape is None:
+            raise ValueError("The shape is required with a key parsing "
+                             "function.")
+        keys = None
+        position = index
+    else:
+        keys = list(index)
+        position = index.get
+        if shape is None:
+            positions = np.array(list(index.values()), dtype=np.intp)
+            shape = (tuple(positions.max(axis=0) + 1)
+                     if positions.size else (0, ))
+
+    if not isinstance(shape, tuple):
+        shape = tuple(shape) if hasattr(shape, "__iter__") else (shape, )
+
+    out = np.empty(shape + tuple(value_shape), dtype=dtype)
+    out.fill(fill_value)
+    missing = np.ones(shape, dtype=bool)
+
+    if field is None:
+        pairs = sqlite3_iterloads(file_name, key=keys, timeout=timeout,
+                                  n_jobs=n_jobs)
+    else:
+        pairs = _iter_field(file_name, field, keys, timeout)
+
+    for k, value in pairs:
+        pos = position(k)
+        if pos is not None:
+            out[pos] = value
+            missing[pos] = False
+
+    return out, missing
+
+
+def sqlite3_gather_frame(file_name, key=None, field=None, chunk_size=10000,
+                         timeout=7200.0, n_jobs=1):
+    """Gather stored dict values into a pandas DataFrame built by chunks.
+
+    The frame is built from chunks of ``chunk_size`` rows, thus without
+    building an intermediate dict of all the stored objects. This function
+    requires pandas.
+
+    Parameters
+    ----------
+    file_name : str or sqlite3.Connection
+        Path to the sqlite database or connection to an in-memory snapshot,
+        see :func:`sqlite3_snapshot`.
+
+    key : str or list of str or None, optional (default=None)
+        Key or list of keys to gather. If None, all keys are gathered.
+
+    field : str or list of str or None, optional (default=None)
+        If None, the dict values stored with :func:`sqlite3_dumps` are
+        gathered, a value which is not a dict is put in a ``value`` column.
+        Otherwise, the given fields stored with
+        :func:`sqlite3_dumps_fields` are gathered column by column.
+
+    chunk_size : int, optional (default=10000)
+        Number of rows converted at once.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    n_jobs : int, optional (default=1)
+        Number of processes used to decode the values stored with
+        :func:`sqlite3_dumps`, see :func:`sqlite3_iterloads`.
+
+    Returns
+    -------
+    frame : pandas DataFrame
+        A DataFrame indexed by key with one column per field. Keys missing
+        from the database are missing from the frame, missing fields
+        are NaN.
+
+    """
+    import pandas as pd
+
+    if isinstance(key, str):
+        key = [key]
+    if isinstance(field, str):
+        field = [field]
+
+    def chunked(pairs):
+        index, values = [], []
+        for k, value in pairs:
+            index.append(k)
+            values.append(value)
+            if len(index) >= chunk_size:
+                yield index, values
+                index, values = [], []
+        if index:
+            yield index, values
+
+    if field is None:
+        pairs = sqlite3_iterloads(file_name, key=key, timeout=timeout,
+                                  n_jobs=n_jobs)
+        frames = [pd.DataFrame.from_records(
+                      [value if isinstance(value, dict) else {"value": value}
+                       for value in values], index=index)
+                  for index, values in chunked(pairs)]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames)
+
+    columns = dict()
+    for f in field:
+        series = [pd.Series(values, index=index)
+                  for index, values in chunked(_iter_field(file_name, f, key,
+                                                           timeout))]
+        if series:
+            columns[f] = pd.concat(series)
+    return pd.DataFrame(columns, columns=[f for f in field if f in columns])
+
+
+def _create_cache_table(connection):
+    """Create the tables used by the cache functions if needed."""
+    connection.execute("""CREATE TABLE IF NOT EXISTS dict
+                          (key TEXT PRIMARY KEY, value BLOB)""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS cache
+                          (key TEXT PRIMARY KEY, size INTEGER, expire REAL,
+                           atime REAL, hits REAL)""")
+    connection.execute("""CREATE INDEX IF NOT EXISTS cache_expire
+                          ON cache (expire)""")
+    connection.execute("""CREATE INDEX IF NOT EXISTS cache_atime
+                          ON cache (atime)""")
+    connection.execute("""CREATE INDEX IF NOT EXISTS cache_hits
+                          ON cache (hits, atime)""")
+
+
+def _delete_keys(connection, keys):
+    """Delete the given keys from the dict and the cache tables."""
+    rows = [(k, ) for k in keys]
+    connection.executemany("DELETE FROM dict WHERE key = ?", rows)
+    connection.executemany("DELETE FROM cache WHERE key = ?", rows)
+    return len(rows)
+
+
+def _evict(connection, now, max_bytes, policy, protected=()):
+    """Evict expired entries, then entries over the bytes budget."""
+    if policy not in _EVICTION_ORDER:
+        raise ValueError("Unknown policy %r expected any of {%s}"
+                         % (policy, ",".join(sorted(_EVICTION_ORDER))))
+
+    n_evicted = _delete_keys(connection, [
+        k for k, in connection.execute("SELECT key FROM cache "
+                                       "WHERE expire <= ?", (now, ))])
+
+    if max_bytes is not None:
+        excess = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        excess -= max_bytes
+
+        victims = []
+        if excess > 0:
+            cursor = connection.execute(
+                "SELECT key, size FROM cache ORDER BY %s"
+                % _EVICTION_ORDER[policy])
+            for k, size in cursor:
+                if excess <= 0:
+                    break
+                if k not in protected:
+                    victims.append(k)
+                    excess -= size
+            cursor.close()
+        n_evicted += _delete_keys(connection, victims)
+
+    return n_evicted
+
+
+def sqlite3_cache_dumps(dictionnary, file_name, ttl=None, max_bytes=None,
+                        policy="lru", timeout=7200.0):
+    """Dump values in the sqlite3 database used as a bounded cache.
+
+    Values are stored as with :func:`sqlite3_dumps` with ``overwrite=True``,
+    along with their size, expiry time and access statistics. Eviction is
+    done lazily at each call: expired entries are removed, then entries are
+    evicted according to ``policy`` until the total size of the values fits
+    in ``max_bytes``. Values dumped during the call are never evicted.
+
+    Parameters
+    ----------
+    dictionnary: dict of (str, object)
+        Each key is a string associated to an object to store in the
+        database.
+
+    file_name : str
+        Path to the sqlite database.
+
+    ttl : float or None, optional (default=None)
+        Time to live of the entries in seconds. If None, entries never
+        expire.
+
+    max_bytes : int or None, optional (default=None)
+        Budget in bytes for the values of the cache. If None, the size of
+        the cache is unbounded.
+
+    policy : {'lru', 'lfu'}, optional (default='lru')
+        Evict first the least recently used entries ('lru') or the least
+        frequently used ones ('lfu').
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    Examples
+    --------
+    >>> from tempfile import NamedTemporaryFile
+    >>> from clusterlib.storage import sqlite3_cache_dumps
+    >>> from clusterlib.storage import sqlite3_cache_loads
+    >>> with NamedTemporaryFile() as fhandle:
+    ...     sqlite3_cache_dumps({"a": "a" * 100}, fhandle.name, ttl=3600)
+    ...     sqlite3_cache_dumps({"b": "b" * 100}, fhandle.name,
+    ...                         max_bytes=150)
+    ...     print(sorted(sqlite3_cache_loads(fhandle.name)))
+    ['b']
+
+    """
+    compressed_dict = {k: _compressed(v) for k, v in dictionnary.items()}
+    now = time.time()
+    expire = None if ttl is None else now + ttl
+
+    with sqlite3.connect(file_name, timeout=timeout) as connection:
+        _create_cache_table(connection)
+        connection.executemany("INSERT OR REPLACE INTO dict(key, value) "
+                               "VALUES (?, ?)", compressed_dict.items())
+        connection.executemany(
+            "INSERT OR REPLACE INTO cache(key, size, expire, atime, hits) "
+            "VALUES (?, ?, ?, ?, 0)",
+            [(k, len(v), expire, now) for k, v in compressed_dict.items()])
+        _evict(connection, now, max_bytes, policy, protected=compressed_dict)
+        _bloom_add(file_name, compressed_dict)
+
+
+def sqlite3_cache_loads(file_name, key=None, timeout=7200.0,
+                        access_sampling=0.1):
+    """Load values from the sqlite3 database used as a cache.
+
+    Expired entries are not returned. In order to keep reads cheap,
+    accesses are recorded for a random sample of the loaded entries only,
+    in a single write transaction at the end of the call. This write is
+    skipped if the database is locked. The number of hits of a sampled
+    entry is incremented by ``1 / access_sampling`` so that it is unbiased.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the sqlite database.
+
+    key : str or list of str or None, optional (default=None)
+        Key or list of keys used when the value was stored. If ``key`` is None,
+        all key value pairs are returned from the database.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    access_sampling : float, optional (default=0.1)
+        Probability to record the access of a loaded entry. If 0, accesses
+        are never recorded and the database is never written.
+
+    Returns
+    -------
+    out : dict
+        Return a dict where each key point is associated to the stored object.
+        Missing or expired keys have no entry in out.
+
+    """
+    if isinstance(key, str):
+        key = [key]
+
+    out = dict()
+    if not os.path.exists(file_name):
+        return out
+
+    now = time.time()
+    with closing(sqlite3.connect(file_name, timeout=timeout)) as connection:
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE "
+                              "type = 'table' AND name = 'cache'"
+                              ).fetchone() is None:
+            # Nothing was stored with sqlite3_cache_dumps
+            return sqlite3_loads(connection, key=key, timeout=timeout)
+
+        query = ("SELECT dict.key, dict.value FROM dict "
+                 "LEFT JOIN cache ON dict.key = cache.key "
+                 "WHERE (cache.expire IS NULL OR cache.expire > ?)")
+        if key is None:
+            rows = connection.execute(query, (now, )).fetchall()
+        else:
+            rows = [row for k in key
+                    for row in connection.execute(query + " AND dict.key = ?",
+                                                  (now, k)).fetchall()]
+        out = dict((k, _decompressed(value)) for k, value in rows)
+
+        accessed = [(now, 1. / access_sampling, k) for k in out
+                    if access_sampling > 0 and
+                    random.random() < access_sampling]
+        if accessed:
+            try:
+                with connection:
+                    connection.execute("PRAGMA busy_timeout = %d"
+                                       % (1000 * _ACCESS_TIMEOUT))
+                    connection.executemany("UPDATE cache SET atime = ?, "
+                                           "hits = hits + ? WHERE key = ?",
+                                           accessed)
+            except sqlite3.OperationalError:
+                pass  # The database is locked, accesses are not recorded
+
+    return out
+
+
+def sqlite3_cache_sweep(file_name, max_bytes=None, policy="lru",
+                        timeout=7200.0):
+    """Evict expired entries and entries over budget from the cache.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the sqlite database.
+
+    max_bytes : int or None, optional (default=None)
+        Budget in bytes for the values of the cache. If None, only
+        expired entries are evicted.
+
+    policy : {'lru', 'lfu'}, optional (default='lru')
+        Evict first the least recently used entries ('lru') or the least
+        frequently used ones ('lfu').
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    Returns
+    -------
+    n_evicted : int
+        Number of evicted entries.
+
+    """
+    if not os.path.exists(file_name):
+        return 0
+
+    with sqlite3.connect(file_name, timeout=timeout) as connection:
+        _create_cache_table(connection)
+        return _evict(connection, time.time(), max_bytes, policy)
+
+
+def _bloom_name(file_name):
+    """Path of the Bloom filter associated to the database."""
+    return file_name + ".bloom"
+
+
+def _bloom_positions(key, n_bits, n_hashes):
+    """Bit positions of the key with the double hashing scheme."""
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    h1, h2 = struct.unpack(">QQ", digest[:16])
+    return [(h1 + i * h2) % n_bits for i in range(n_hashes)]
+
+
+def _bloom_read(bloom_name):
+    """Read the header and the bits of a Bloom filter."""
+    with open(bloom_name, "rb") as fhandle:
+        magic, n_bits, n_hashes = struct.unpack(
+            _BLOOM_HEADER, fhandle.read(struct.calcsize(_BLOOM_HEADER)))
+        if magic != _BLOOM_MAGIC:
+            raise ValueError("'%s' is not a Bloom filter." % bloom_name)
+        return n_bits, n_hashes, bytearray(fhandle.read())
+
+
+def _bloom_add(file_name, keys):
+    """Add keys in place to the Bloom filter of the database, if any.
+
+    This must be called while holding the write lock on the database,
+    which serializes the updates of the filter.
+    """
+    bloom_name = _bloom_name(file_name)
+    if not os.path.exists(bloom_name):
+        return
+
+    offset = struct.calcsize(_BLOOM_HEADER)
+    with open(bloom_name, "r+b") as fhandle:
+        magic, n_bits, n_hashes = struct.unpack(_BLOOM_HEADER,
+                                                fhandle.read(offset))
+        if magic != _BLOOM_MAGIC:
+            raise ValueError("'%s' is not a Bloom filter." % bloom_name)
+
+        # Only the modified bytes are read and written
+        masks = dict()
+        for key in keys:
+            for position in _bloom_positions(key, n_bits, n_hashes):
+                byte = offset + position // 8
+                masks[byte] = masks.get(byte, 0) | (1 << (position % 8))
+
+        for byte in sorted(masks):
+            fhandle.seek(byte)
+            value = bytearray(fhandle.read(1))[0] | masks[byte]
+            fhandle.seek(byte)
+            fhandle.write(bytearray([value]))
+
+
+def _stored_keys(connection):
+    """Iterate over the keys of the dict and fields tables."""
+    tables = set(name for name, in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    if "dict" in tables:
+        for key, in connection.execute("SELECT key FROM dict"):
+            yield key
+    if "fields" in tables:
+        for key, in connection.execute("SELECT DISTINCT key FROM fields"):
+            yield key
+
+
+def sqlite3_bloom(file_name, capacity=None, error_rate=0.01, timeout=7200.0):
+    """Build the Bloom filter of the keys stored in the sqlite3 database.
+
+    The filter is a compact file next to the database, at
+    ``file_name + ".bloom"``. Once built, it is updated at each dump, and
+    rebuilt with the same size by :func:`sqlite3_vacuum`, thus a filter
+    nearing its capacity should be built again with a larger one. It allows
+    :func:`sqlite3_contains` to check which keys are stored while querying
+    the database only for the keys hitting the filter.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the sqlite database.
+
+    capacity : int or None, optional (default=None)
+        Expected number of keys. The false positive rate grows beyond it,
+        until the filter is rebuilt. If None, twice the current number of
+        keys is used, with a minimum of 100000 keys.
+
+    error_rate : float, optional (default=0.01)
+        False positive rate of the filter at capacity.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    Returns
+    -------
+    bloom_name : str
+        Path to the Bloom filter.
+
+    """
+    _check_database(file_name)
+    if not 0. < error_rate < 1.:
+        raise ValueError("error_rate should be in ]0, 1[, got %r"
+                         % error_rate)
+
+    def size(n_keys):
+        n_items = max(2 * n_keys, 100000) if capacity is None else capacity
+
+        # Optimal size and number of hash functions
+        n_bits = int(math.ceil(-n_items * math.log(error_rate) /
+                               math.log(2) ** 2))
+        n_bits = 8 * int(math.ceil(n_bits / 8.))
+        n_hashes = max(int(round(n_bits / float(n_items) * math.log(2))), 1)
+        return n_bits, n_hashes
+
+    return _bloom_build(file_name, size, timeout)
+
+
+def _bloom_build(file_name, size, timeout):
+    """Write the Bloom filter of the stored keys.
+
+    The number of bits and of hash functions are given by ``size`` from
+    the number of stored keys.
+    """
+    bloom_name = _bloom_name(file_name)
+    directory, base_name = os.path.split(os.path.abspath(bloom_name))
+
+    # The write lock is held until the new filter replaced the old one, so
+    # that no key is dumped in between.
+    with closing(sqlite3.connect(file_name, timeout=timeout,
+                                 isolation_level=None)) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            keys = list(_stored_keys(connection))
+            n_bits, n_hashes = size(len(keys))
+            bits = bytearray(n_bits // 8)
+            for key in keys:
+                for position in _bloom_positions(key, n_bits, n_hashes):
+                    bits[position // 8] |= 1 << (position % 8)
+
+            fd, tmp_name = mkstemp(prefix=base_name + ".", dir=directory)
+            try:
+                with os.fdopen(fd, "wb") as fhandle:
+                    fhandle.write(struct.pack(_BLOOM_HEADER, _BLOOM_MAGIC,
+                                              n_bits, n_hashes))
+                    fhandle.write(bits)
+                shutil.copymode(file_name, tmp_name)
+                _replace(tmp_name, bloom_name)
+            except BaseException:
+                if os.path.exists(tmp_name):
+                    os.remove(tmp_name)
+                raise
+        finally:
+            connection.execute("ROLLBACK")
+
+    return bloom_name
+
+
+def sqlite3_contains(file_name, key, timeout=7200.0, batch_size=500):
+    """Return the keys which are stored in the sqlite3 database.
+
+    Keys stored with :func:`sqlite3_dumps` or :func:`sqlite3_dumps_fields`
+    are considered. If the database has a Bloom filter, see
+    :func:`sqlite3_bloom`, the database is only queried for the keys
+    hitting the filter. Checking millions of keys against the filter takes
+    then seconds at most without loading all the stored keys.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the sqlite database.
+
+    key : str or list of str
+        Key or list of keys to check.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    batch_size : int, optional (default=500)
+        Number of keys checked with a single query.
+
+    Returns
+    -------
+    out : set of str
+        Keys of ``key`` which are stored in the database.
+
+    Examples
+    --------
+    >>> import os
+    >>> from tempfile import NamedTemporaryFile
+    >>> from clusterlib.storage import sqlite3_bloom
+    >>> from clusterlib.storage import sqlite3_contains
+    >>> from clusterlib.storage import sqlite3_dumps
+    >>> with NamedTemporaryFile() as fhandle:
+    ...     sqlite3_dumps({"3": 3, "2": 5}, fhandle.name)
+    ...     bloom_name = sqlite3_bloom(fhandle.name)
+    ...     sqlite3_dumps({"7": 7}, fhandle.name)
+    ...     print(sorted(sqlite3_contains(fhandle.name, ["1", "2", "7"])))
+    ...     os.remove(bloom_name)
+    ['2', '7']
+
+    """
+    if isinstance(key, str):
+        key = [key]
+
+    out = set()
+    if not os.path.exists(file_name):
+        return out
+
+    bloom_name = _bloom_name(file_name)
+    if os.path.exists(bloom_name):
+        n_bits, n_hashes, bits = _bloom_read(bloom_name)
+        key = [k for k in key
+               if all(bits[position // 8] & (1 << (position % 8))
+                      for position in _bloom_positions(k, n_bits, n_hashes))]
+
+    with closing(sqlite3.connect(file_name, timeout=timeout)) as connection:
+        tables = set(name for name, in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"))
+        for start in range(0, len(key), batch_size):
+            batch = key[start:start + batch_size]
+            placeholders = ", ".join("?" * len(batch))
+            for table in ("dict", "fields"):
+                if table in tables:
+                    out.update(k for k, in connection.execute(
+                        "SELECT DISTINCT key FROM %s WHERE key IN (%s)"
+                        % (table, placeholders), batch))
+
+    return out
+
+
+def _check_database(file_name):
+    """Raise an IOError if there is no database at file_name.
+
+    sqlite3.connect would otherwise create silently an empty database.
+    """
+    if not os.path.exists(file_name):
+        raise IOError("No sqlite3 database at '%s'" % file_name)
+
+
+def _pragma(connection, name):
+    """Return the value of a pragma."""
+    return connection.execute("PRAGMA %s" % name).fetchone()[0]
+
+
+def sqlite3_stats(file_name, timeout=7200.0, detailed=False):
+    """Report page usage and fragmentation of the sqlite3 database.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the sqlite database.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    detailed : bool, optional (default=False)
+        Whether to also count the unused bytes inside the pages using the
+        ``dbstat`` virtual table. This requires to read the whole database
+        and sqlite to be compiled with the ``dbstat`` table. If the table is
+        not available, ``unused_bytes`` is None.
+
+    Returns
+    -------
+    stats : dict
+        A dictionary with the ``file_size`` in bytes, the ``page_size``, the
+        ``page_count``, the number of free pages ``freelist_count``, the
+        ``auto_vacuum`` mode, the ``journal_mode``, the ``fragmentation``,
+        i.e. the fraction of free pages, and ``unused_bytes`` if ``detailed``.
+
+    Examples
+    --------
+    >>> from tempfile import NamedTemporaryFile
+    >>> from clusterlib.storage import sqlite3_dumps
+    >>> from clusterlib.storage import sqlite3_stats
+    >>> with NamedTemporaryFile() as fhandle:
+    ...     sqlite3_dumps({"3": 3, "2": 5}, fhandle.name)
+    ...     print(sqlite3_stats(fhandle.name)["freelist_count"])
+    0
+
+    """
+    _check_database(file_name)
+
+    with closing(sqlite3.connect(file_name, timeout=timeout)) as connection:
+        stats = {
+            "file_size": os.path.getsize(file_name),
+            "page_size": _pragma(connection, "page_size"),
+            "page_count": _pragma(connection, "page_count"),
+            "freelist_count": _pragma(connection, "freelist_count"),
+            "auto_vacuum": _AUTO_VACUUM[_pragma(connection, "auto_vacuum")],
+            "journal_mode": _pragma(connection, "journal_mode"),
+        }
+
+        if detailed:
+            try:
+                stats["unused_bytes"] = connection.execute(
+                    "SELECT COALESCE(SUM(unused), 0) FROM dbstat"
+                ).fetchone()[0]
+            except sqlite3.OperationalError:
+                # sqlite compiled without SQLITE_ENABLE_DBSTAT_VTAB
+                stats["unused_bytes"] = None
+
+    stats["fragmentation"] = (float(stats["freelist_count"]) /
+                              max(stats["page_count"], 1))
+    return stats
+
+
+def sqlite3_vacuum(file_name, mode="incremental", analyze=True,
+                   timeout=7200.0, n_pages=None):
+    """Reclaim unused space of the sqlite3 database.
+
+    Deleting or overwriting values leaves free pages in the database, which
+    makes the file larger and the full table scans slower than needed.
+    If the database has a Bloom filter, see :func:`sqlite3_bloom`, it is
+    rebuilt afterwards.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the sqlite database.
+
+    mode : {'incremental', 'full'}, optional (default='incremental')
+        How to reclaim space:
+
+            - 'incremental' removes free pages from the end of the file with
+              ``PRAGMA incremental_vacuum``. It is fast and holds the write
+              lock briefly, but it is only effective once the database
+              is in incremental auto vacuum mode, which is set by the
+              'full' mode.
+            - 'full' rebuilds the database in place with ``VACUUM``. The
+              database is locked for readers and writers meanwhile, thus
+              concurrent writers wait for the lock instead of losing their
+              writes.
+
+    analyze : bool, optional (default=True)
+        Whether to gather statistics with ``ANALYZE`` for the query planner.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    n_pages : int or None, optional (default=None)
+        Maximal number of pages to remove with the 'incremental' mode. If
+        None, all free pages are removed.
+
+    Returns
+    -------
+    stats : dict
+        Statistics of the database after the vacuum, see
+        :func:`sqlite3_stats`.
+
+    Examples
+    --------
+    >>> from tempfile import NamedTemporaryFile
+    >>> from clusterlib.storage import sqlite3_dumps
+    >>> from clusterlib.storage import sqlite3_vacuum
+    >>> with NamedTemporaryFile() as fhandle:
+    ...     sqlite3_dumps({"3": 3, "2": 5}, fhandle.name)
+    ...     stats = sqlite3_vacuum(fhandle.name, mode="full")
+    ...     print(stats["auto_vacuum"], stats["freelist_count"])
+    incremental 0
+
+    """
+    if mode not in ("incremental", "full"):
+        raise ValueError("Unknown mode %r expected any of "
+                         "{incremental,full}" % mode)
+    _check_database(file_name)
+
+    with closing(sqlite3.connect(file_name, timeout=timeout,
+                                 isolation_level=None)) as connection:
+        auto_vacuum = _AUTO_VACUUM[_pragma(connection, "auto_vacuum")]
+
+        if mode == "incremental":
+            if auto_vacuum != "incremental":
+                warnings.warn("The database '%s' is not in incremental auto "
+                              "vacuum mode, use a 'full' vacuum first."
+                              % file_name)
+            # The pragma frees one page per step. Contrarily to execute,
+            # executescript steps the statement until completion.
+            if n_pages is None:
+                connection.executescript("PRAGMA incremental_vacuum;")
+            else:
+                connection.executescript("PRAGMA incremental_vacuum(%d);"
+                                         % n_pages)
+
+        else:
+            # Enable incremental vacuum for the next maintenance operations,
+            # it is taken into account by the VACUUM that follows.
+            connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.execute("VACUUM")
+
+    if analyze:
+        with closing(sqlite3.connect(file_name, timeout=timeout,
+                                     isolation_level=None)) as connection:
+            connection.execute("ANALYZE")
+
+    bloom_name = _bloom_name(file_name)
+    if os.path.exists(bloom_name):
+        # The size chosen when the filter was built is kept
+        n_bits, n_hashes, _ = _bloom_read(bloom_name)
+        _bloom_build(file_name, lambda n_keys: (n_bits, n_hashes), timeout)
+
+    return sqlite3_stats(file_name, timeout=timeout)
+
+
+def _change_counter(file_name):
+    """Return the file change counter from the header of the database.
+
+    The counter is None in WAL journal mode, since it is then not
+    incremented at each transaction.
+    """
+    with open(file_name, "rb") as fhandle:
+        header = fhandle.read(100)
+    if len(header) < 100 or bytearray(header)[18] == 2:
+        return None
+    return struct.unpack(">I", header[24:28])[0]
+
+
+def sqlite3_snapshot(file_name, snapshot=":memory:", pages=1024, sleep=0.0,
+                     timeout=7200.0):
+    """Copy the sqlite3 database to a local file or into memory.
+
+    The copy is made with the sqlite backup API ``pages`` pages at a time.
+    The lock on the database is only held during each step, thus jobs can
+    keep writing in the database during the copy. Analysis on the snapshot
+    runs then at local disk or memory speed without holding any lock on
+    the shared database.
+
+    Calling again this function with the same snapshot refreshes it. The
+    refresh is skipped if the database has not been modified since the last
+    copy, which is detected through the file change counter of the
+    database (except in WAL journal mode where the copy is always done).
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the sqlite database.
+
+    snapshot : str or sqlite3.Connection, optional (default=":memory:")
+        Path of the snapshot, e.g. on a node-local disk. If ":memory:",
+        the snapshot is created in memory. A connection returned by a
+        previous call refreshes the in-memory snapshot.
+
+    pages : int, optional (default=1024)
+        Number of pages copied at each step.
+
+    sleep : float, optional (default=0.0)
+        Number of seconds to sleep between successive steps, which lets
+        writers access the database.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock to go away until raising an exception.
+
+    Returns
+    -------
+    snapshot : str or sqlite3.Connection
+        Path of the snapshot or connection to the in-memory snapshot, which
+        can be given to :func:`sqlite3_loads`.
+
+    Examples
+    --------
+    >>> from tempfile import NamedTemporaryFile
+    >>> from clusterlib.storage import sqlite3_dumps
+    >>> from clusterlib.storage import sqlite3_loads
+    >>> from clusterlib.storage import sqlite3_snapshot
+    >>> with NamedTemporaryFile() as fhandle:
+    ...     sqlite3_dumps({"3": 3, "2": 5}, fhandle.name)
+    ...     snapshot = sqlite3_snapshot(fhandle.name)
+    ...     print(sqlite3_loads(snapshot, key="3"))
+    {'3': 3}
+
+    """
+    _check_database(file_name)
+    change_counter = _change_counter(file_name)
+
+    if isinstance(snapshot, sqlite3.Connection):
+        destination = snapshot
+    else:
+        destination = sqlite3.connect(snapshot, timeout=timeout)
+
+    try:
+        copied = None
+        if change_counter is not None:
+            try:
+                copied = destination.execute(
+                    "SELECT change_counter FROM snapshot WHERE source = ?",
+                    (os.path.abspath(file_name),)).fetchone()
+            except sqlite3.OperationalError:
+                pass  # Not a snapshot yet
+
+        if copied is None or copied[0] != change_counter:
+            with closing(sqlite3.connect(file_name,
+                                         timeout=timeout)) as connection:
+                connection.backup(destination, pages=pages, sleep=sleep)
+
+            with destination:
+                destination.execute("""CREATE TABLE IF NOT EXISTS snapshot
+                                       (source TEXT PRIMARY KEY,
+                                        change_counter INTEGER)""")
+                destination.execute(
+                    "INSERT OR REPLACE INTO snapshot(source, change_counter) "
+                    "VALUES (?, ?)",
+                    (os.path.abspath(file_name), change_counter))
+    except BaseException:
+        if destination is not snapshot:
+            destination.close()
+        raise
+
+    if isinstance(snapshot, sqlite3.Connection) or snapshot == ":memory:":
+        return destination
+
+    destination.close()
+    return snapshot
+
+
+def main(argv=None):
+    """Command line interface to maintain sqlite3 databases."""
+    parser = argparse.ArgumentParser(
+        prog="python -m clusterlib.storage",
+        description="Maintenance of clusterlib sqlite3 databases.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    stats_parser = subparsers.add_parser(
+        "stats", help="Report page usage and fragmentation.")
+    stats_parser.add_argument("file_name")
+    stats_parser.add_argument("--detailed", action="store_true",
+                              help="Count unused bytes in all pages.")
+
+    vacuum_parser = subparsers.add_parser(
+        "vacuum", help="Reclaim unused space and analyze the database.")
+    vacuum_parser.add_argument("file_name")
+    vacuum_parser.add_argument("--mode", default="incremental",
+                               choices=["incremental", "full"])
+    vacuum_parser.add_argument("--n-pages", type=int, default=None)
+    vacuum_parser.add_argument("--no-analyze", dest="analyze",
+                               action="store_false")
+
+    snapshot_parser = subparsers.add_parser(
+        "snapshot", help="Copy or refresh a snapshot of the database.")
+    snapshot_parser.add_argument("file_name")
+    snapshot_parser.add_argument("snapshot")
+    snapshot_parser.add_argument("--pages", type=int, default=1024)
+    snapshot_parser.add_argument("--sleep", type=float, default=0.0)
+
+    parser.add_argument("--timeout", type=float, default=7200.0)
+    args = parser.parse_args(argv)
+
+    if args.command == "stats":
+        stats = sqlite3_stats(args.file_name, timeout=args.timeout,
+                              detailed=args.detailed)
+    elif args.command == "snapshot":
+        sqlite3_snapshot(args.file_name, args.snapshot, pages=args.pages,
+                         sleep=args.sleep, timeout=args.timeout)
+        stats = sqlite3_stats(args.snapshot, timeout=args.timeout)
+    else:
+        stats = sqlite3_vacuum(args.file_name, mode=args.mode,
+                               analyze=args.analyze, timeout=args.timeout,
+                               n_pages=args.n_pages)
+
+    print(json.dumps(stats, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
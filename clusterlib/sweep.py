@@ -0,0 +1,271 @@
+"""
+This module allows to plan the jobs of a sweep over a huge parameter grid.
+
+Parameter grids are lazy: the points of a grid are computed on demand from
+their position, thus a grid of ten millions points takes no memory. Pending
+tasks, i.e. neither queued, running nor done, are streamed by batches of
+grid points checked against the set of queued or running jobs and against
+the keys stored in a :mod:`clusterlib.storage` database.
+
+"""
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+from __future__ import unicode_literals
+
+import random
+from getpass import getuser
+from itertools import islice
+
+from .scheduler import queued_or_running_jobs
+from .storage import sqlite3_contains
+
+
+__all__ = [
+    "ProductGrid",
+    "ZipGrid",
+    "SampledGrid",
+    "pending",
+]
+
+
+class _Grid(object):
+    """Base class of lazy grids of parameters."""
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def _point(self, index):
+        raise NotImplementedError()
+
+    def __getitem__(self, index):
+        n_points = len(self)
+        if index < 0:
+            index += n_points
+        if not 0 <= index < n_points:
+            raise IndexError("grid index out of range")
+        return self._point(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._point(index)
+
+
+class ProductGrid(_Grid):
+    """Cartesian product of the values of each parameter.
+
+    The points are ordered as with :func:`itertools.product`, the values of
+    the last parameter varying the fastest.
+
+    Parameters
+    ----------
+    grid : list of (str, list)
+        Name and values of each parameter, as in
+        :func:`clusterlib.storage.grid_index`.
+
+    Examples
+    --------
+    >>> from clusterlib.sweep import ProductGrid
+    >>> grid = ProductGrid([("alpha", [0.1, 1.]), ("n", range(1000))])
+    >>> len(grid)
+    2000
+    >>> sorted(grid[1001].items())
+    [('alpha', 1.0), ('n', 1)]
+
+    """
+
+    def __init__(self, grid):
+        self.grid = list(grid)
+
+    def __len__(self):
+        n_points = 1
+        for _, values in self.grid:
+            n_points *= len(values)
+        return n_points
+
+    def _point(self, index):
+        params = dict()
+        for name, values in reversed(self.grid):
+            index, position = divmod(index, len(values))
+            params[name] = values[position]
+        return params
+
+
+class ZipGrid(_Grid):
+    """Values of the parameters taken together, as with :func:`zip`.
+
+    Parameters
+    ----------
+    grid : list of (str, list)
+        Name and values of each parameter. All the parameters must have the
+        same number of values.
+
+    Examples
+    --------
+    >>> from clusterlib.sweep import ZipGrid
+    >>> grid = ZipGrid([("alpha", [0.1, 1.]), ("n", [10, 100])])
+    >>> [sorted(params.items()) for params in grid]
+    [[('alpha', 0.1), ('n', 10)], [('alpha', 1.0), ('n', 100)]]
+
+    """
+
+    def __init__(self, grid):
+        self.grid = list(grid)
+        if len(set(len(values) for _, values in self.grid)) > 1:
+            raise ValueError("The parameters of a ZipGrid should have the "
+                             "same number of values.")
+
+    def __len__(self):
+        return len(self.grid[0][1]) if self.grid else 0
+
+    def _point(self, index):
+        return dict((name, values[index]) for name, values in self.grid)
+
+
+class SampledGrid(_Grid):
+    """Random sample without replacement of the points of a grid.
+
+    Only the positions of the sampled points are stored.
+
+    Parameters
+    ----------
+    grid : grid
+        Grid to sample, e.g. a :class:`ProductGrid`.
+
+    n_samples : int
+        Number of sampled points.
+
+    random_state : int or None, optional (default=None)
+        Seed of the sample. The same seed gives the same sample, which is
+        needed to launch the jobs of a sweep several times.
+
+    Examples
+    --------
+    >>> from clusterlib.sweep import ProductGrid
+    >>> from clusterlib.sweep import SampledGrid
+    >>> grid = ProductGrid([("alpha", range(10 ** 4)),
+    ...                     ("beta", range(10 ** 4))])
+    >>> sample = SampledGrid(grid, n_samples=100, random_state=0)
+    >>> len(sample)
+    100
+    >>> sample[0] == SampledGrid(grid, n_samples=100, random_state=0)[0]
+    True
+
+    """
+
+    def __init__(self, grid, n_samples, random_state=None):
+        if n_samples > len(grid):
+            raise ValueError("Cannot sample %s points from a grid of %s "
+                             "points." % (n_samples, len(grid)))
+        self.grid = grid
+        self.n_samples = n_samples
+        self.random_state = random_state
+        self._indices = random.Random(random_state).sample(range(len(grid)),
+                                                           n_samples)
+
+    def __len__(self):
+        return self.n_samples
+
+    def _point(self, index):
+        return self.grid[self._indices[index]]
+
+
+def _formatter(key):
+    return key if callable(key) else key.__mod__
+
+
+def pending(grid, job_name, job_command, queued=None, storage=None, key=None,
+            batch_size=10000):
+    """Stream the tasks of a grid which are neither queued nor done.
+
+    The grid is traversed by batches: the job names of a batch are checked
+    against the set of queued or running jobs and its keys are looked up in
+    the storage database with :func:`clusterlib.storage.sqlite3_contains`,
+    which takes advantage of its Bloom filter if any. The memory is thus
+    bounded by the batch size and the size of the queue, whatever the size
+    of the grid.
+
+    Parameters
+    ----------
+    grid : iterable of dict
+        Parameters of each task, e.g. a :class:`ProductGrid`.
+
+    job_name : str or callable
+        Either a format string, e.g. ``"job-alpha=%(alpha)s"``, formatted
+        with the dict of parameters of each task, or a function taking this
+        dict and returning the job name.
+
+    job_command : str or callable
+        Format string or function giving the job command, as ``job_name``.
+
+    queued : collection of str or None, optional (default=None)
+        Names of the queued or running jobs. If None, the queue of the user
+        is queried once with
+        :func:`clusterlib.scheduler.queued_or_running_jobs`.
+
+    storage : str or None, optional (default=None)
+        Path to the sqlite database where the tasks store their results. If
+        None, the done tasks are not checked.
+
+    key : str, callable or None, optional (default=None)
+        Format string or function giving the key of a task in the storage,
+        as ``job_name``. If None, the key is the job command.
+
+    batch_size : int, optional (default=10000)
+        Number of tasks checked at once.
+
+    Returns
+    -------
+    tasks : generator of (job_name, job_command)
+        Pending tasks in the order of the grid.
+
+    Examples
+    --------
+    >>> from clusterlib.sweep import ProductGrid
+    >>> from clusterlib.sweep import pending
+    >>> grid = ProductGrid([("param", range(4))])
+    >>> for task in pending(grid, "job-param=%(param)s",
+    ...                     "./main --param %(param)s",
+    ...                     queued=["job-param=1"]):
+    ...     print(task)
+    ('job-param=0', './main --param 0')
+    ('job-param=2', './main --param 2')
+    ('job-param=3', './main --param 3')
+
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size should be positive, got %r"
+                         % batch_size)
+
+    if queued is None:
+        queued = queued_or_running_jobs(user=getuser())
+    if not isinstance(queued, (set, frozenset, dict)):
+        queued = set(queued)
+
+    name_format = _formatter(job_name)
+    command_format = _formatter(job_command)
+    key_format = None if key is None else _formatter(key)
+
+    points = iter(grid)
+    while True:
+        batch = list(islice(points, batch_size))
+        if not batch:
+            return
+
+        tasks = []
+        for params in batch:
+            name = name_format(params)
+            if name not in queued:
+                command = command_format(params)
+                tasks.append((name, command, command if key_format is None
+                              else key_format(params)))
+
+        if storage is not None:
+            done = sqlite3_contains(storage, [task_key
+                                              for _, _, task_key in tasks])
+        else:
+            done = ()
+
+        for name, command, task_key in tasks:
+            if task_key not in done:
+                yield name, command
@@ -0,0 +1,227 @@
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+
+from __future__ import unicode_literals
+
+import os.path as op
+import subprocess
+import warnings
+from time import sleep
+
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from .. import controller
+from ..controller import Controller
+from ..storage import sqlite3_dumps
+from .._testing import TemporaryDirectory
+
+
+class _FakeScheduler(object):
+    """Record the launched jobs and report them as queued.
+
+    The submission of a job raises once the exception given in ``errors``.
+    While ``failing``, the queries of the scheduler fail as those of SGE.
+    """
+
+    def __init__(self):
+        self.queue = []
+        self.launched = []
+        self.names = {}
+        self.errors = {}
+        self.failing = False
+
+    def launch(self, job_command, job_name="job", **kwargs):
+        if job_name in self.errors:
+            raise self.errors.pop(job_name)
+        self.queue.append(job_name)
+        self.launched.append(job_name)
+        job_id = str(len(self.names) + 1)
+        self.names[job_id] = job_name
+        return job_id
+
+    def queued_or_running_jobs(self, user=None):
+        return [] if self.failing else list(self.queue)
+
+    def job_states(self, job_ids, backend="auto"):
+        if self.failing:
+            raise RuntimeError("qstat failed")
+        return dict((job_id, "RUNNING" if self.names[job_id] in self.queue
+                     else "COMPLETED")
+                    for job_id in job_ids if job_id in self.names)
+
+
+def _check_controller(temp_folder, tasks, **kwargs):
+    instance = Controller(tasks, op.join(temp_folder, "state.json"),
+                          queue_poll_interval=0, **kwargs)
+    return _FakeScheduler(), instance
+
+
+def _step(scheduler, instance):
+    old_launch = controller.launch
+    old_queued = controller.queued_or_running_jobs
+    old_job_states = controller.job_states
+    controller.launch = scheduler.launch
+    controller.queued_or_running_jobs = scheduler.queued_or_running_jobs
+    controller.job_states = scheduler.job_states
+    try:
+        return instance.step()
+    finally:
+        controller.launch = old_launch
+        controller.queued_or_running_jobs = old_queued
+        controller.job_states = old_job_states
+
+
+def test_controller():
+    assert_raises(ValueError, Controller, [], "state.json", n_in_flight=0)
+
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        storage = op.join(temp_folder, "results.sqlite3")
+        tasks = [("job-%s" % i, "command %s" % i) for i in range(7)]
+        scheduler, instance = _check_controller(temp_folder, tasks,
+                                                storage=storage,
+                                                n_in_flight=3)
+
+        # Only n_in_flight jobs are submitted
+        assert_true(_step(scheduler, instance))
+        assert_equal(scheduler.launched, ["job-0", "job-1", "job-2"])
+
+        # A new job is submitted as soon as a task is done
+        sqlite3_dumps({"command 1": 1}, storage)
+        scheduler.queue.remove("job-1")
+        assert_true(_step(scheduler, instance))
+        assert_equal(scheduler.launched[3:], ["job-3"])
+        assert_equal(instance.n_done, 1)
+
+        # The controller resumes from its state file
+        scheduler.queue = ["job-0", "job-2", "job-3"]
+        sqlite3_dumps({"command 4": 4}, storage)
+        scheduler_2, instance = _check_controller(temp_folder, tasks,
+                                                  storage=storage,
+                                                  n_in_flight=3)
+        scheduler_2.queue = scheduler.queue
+        scheduler_2.names = scheduler.names
+        assert_equal(sorted(instance.in_flight),
+                     ["job-0", "job-2", "job-3"])
+        sqlite3_dumps({"command 0": 0, "command 2": 2}, storage)
+        scheduler_2.queue = ["job-3"]
+        assert_true(_step(scheduler_2, instance))
+        # job-4 is already done, thus it is not submitted
+        assert_equal(scheduler_2.launched, ["job-5", "job-6"])
+        assert_equal(instance.n_done, 4)
+
+        # A job which has left the queue without result has failed
+        sqlite3_dumps({"command 3": 3, "command 5": 5}, storage)
+        scheduler_2.queue = []
+        assert_true(not _step(scheduler_2, instance))
+        assert_equal(instance.failed, {"job-6": "command 6"})
+        assert_equal(instance.n_done, 6)
+
+
+def test_controller_limits():
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        storage = op.join(temp_folder, "results.sqlite3")
+        tasks = [("job-%s" % i, "command %s" % i) for i in range(10)]
+        scheduler, instance = _check_controller(temp_folder, tasks,
+                                                storage=storage,
+                                                n_in_flight=5,
+                                                max_submit_jobs=4,
+                                                max_retries=1)
+
+        # Jobs of the user which are already queued are counted
+        scheduler.queue = ["other"]
+        _step(scheduler, instance)
+        assert_equal(scheduler.launched, ["job-0", "job-1", "job-2"])
+
+        # Failed jobs are retried
+        scheduler.queue.remove("job-0")
+        _step(scheduler, instance)
+        assert_equal(scheduler.launched[3:], ["job-0"])
+        assert_equal(instance.in_flight["job-0"]["n_attempts"], 2)
+        scheduler.queue.remove("job-0")
+        _step(scheduler, instance)
+        assert_equal(instance.failed, {"job-0": "command 0"})
+        assert_equal(scheduler.launched[4:], ["job-3"])
+
+    # Without storage, a job which has left the queue is done
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        tasks = [("job-%s" % i, "command %s" % i) for i in range(3)]
+        scheduler, instance = _check_controller(temp_folder, tasks,
+                                                n_in_flight=2)
+        assert_true(_step(scheduler, instance))
+        scheduler.queue = []
+        assert_true(_step(scheduler, instance))
+        scheduler.queue = []
+        assert_true(not _step(scheduler, instance))
+        assert_equal(instance.n_done, 3)
+        assert_equal(instance.failed, {})
+
+
+def test_controller_submit_errors():
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        tasks = [("job-%s" % i, "command %s" % i) for i in range(4)]
+        scheduler, instance = _check_controller(temp_folder, tasks,
+                                                n_in_flight=2,
+                                                poll_interval=0.5)
+
+        # A failed submission is retried later instead of stopping
+        scheduler.errors["job-0"] = RuntimeError("sbatch: error")
+        with warnings.catch_warnings(record=True) as records:
+            warnings.simplefilter("always")
+            assert_true(_step(scheduler, instance))
+        assert_equal(len(records), 1)
+        assert_true("job-0" in str(records[0].message))
+        assert_equal(scheduler.launched, [])
+        _step(scheduler, instance)
+        assert_equal(scheduler.launched, [])
+
+        sleep(0.6)
+        _step(scheduler, instance)
+        assert_equal(scheduler.launched, ["job-0", "job-1"])
+
+        # The state is saved after each submission
+        scheduler.queue = []
+        scheduler.errors["job-3"] = KeyboardInterrupt()
+        assert_raises(KeyboardInterrupt, _step, scheduler, instance)
+        _, instance = _check_controller(temp_folder, tasks, n_in_flight=2)
+        assert_equal(list(instance.in_flight), ["job-2"])
+        assert_equal(instance.position, 3)
+        assert_equal(instance.n_done, 2)
+
+
+def test_controller_query_errors():
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        tasks = [("job-%s" % i, "command %s" % i) for i in range(6)]
+        scheduler, instance = _check_controller(temp_folder, tasks,
+                                                n_in_flight=3)
+        assert_true(_step(scheduler, instance))
+        assert_equal(scheduler.launched, ["job-0", "job-1", "job-2"])
+
+        # The jobs in flight are left unchanged while the scheduler fails
+        scheduler.failing = True
+        assert_true(_step(scheduler, instance))
+        assert_equal(instance.n_done, 0)
+        assert_equal(sorted(instance.in_flight),
+                     ["job-0", "job-1", "job-2"])
+        assert_equal(scheduler.launched, ["job-0", "job-1", "job-2"])
+
+        # A failure of squeue does not stop the controller
+        def failing_queue(user=None):
+            raise subprocess.CalledProcessError(1, "squeue")
+
+        scheduler.queued_or_running_jobs = failing_queue
+        assert_true(_step(scheduler, instance))
+        assert_equal(instance.n_done, 0)
+
+        scheduler.failing = False
+        scheduler.queue.remove("job-1")
+        assert_true(_step(scheduler, instance))
+        assert_equal(instance.n_done, 1)
+        assert_equal(scheduler.launched[3:], ["job-3"])
@@ -0,0 +1,80 @@
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+
+from __future__ import unicode_literals
+
+import os
+import os.path as op
+from time import sleep
+
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from ..executor import ClusterExecutor
+from .._testing import TemporaryDirectory
+from .._testing import fake_executable
+from .._testing import prepend_path
+
+
+def _square(x, offset=0):
+    return x ** 2 + offset
+
+
+def _fail(x):
+    raise ValueError("invalid %s" % x)
+
+
+def test_cluster_executor():
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        # Job scripts are run synchronously by the submission
+        fake_executable(temp_folder, "sbatch", "Submitted batch job 1\n",
+                        run=True)
+
+        with prepend_path(temp_folder):
+            executor_folder = op.join(temp_folder, "executor")
+            with ClusterExecutor(executor_folder, backend="slurm",
+                                 poll_interval=0.05) as executor:
+                future = executor.submit(_square, 3, offset=1)
+                assert_equal(future.result(timeout=30), 10)
+
+                future = executor.submit(_fail, 3)
+                assert_true(isinstance(future.exception(timeout=30),
+                                       ValueError))
+
+                assert_equal(list(executor.map(_square, range(5), [1] * 5,
+                                               chunksize=2, timeout=30)),
+                             [1, 2, 5, 10, 17])
+                results = executor.map(_fail, [1])
+                assert_raises(ValueError, next, results)
+
+                assert_raises(ValueError, executor.map, _square, [1],
+                              chunksize=0)
+                assert_raises(TypeError, executor.map, _square, [1],
+                              unknown=0)
+
+            # The files of the jobs are removed once they are done
+            assert_equal(os.listdir(executor_folder), [])
+            assert_raises(RuntimeError, executor.submit, _square, 1)
+
+            # Jobs without outcome which have left the queue are lost, but
+            # not while the scheduler can not be queried.
+            fake_executable(temp_folder, "sbatch", "Submitted batch job 1\n")
+            fake_executable(temp_folder, "squeue", "slurm_load_jobs error: "
+                            "Socket timed out\n", returncode=1)
+            fake_executable(temp_folder, "sacct", "")
+            with ClusterExecutor(executor_folder, backend="slurm",
+                                 poll_interval=0.05) as executor:
+                future = executor.submit(_square, 3)
+                sleep(0.5)
+                assert_true(not future.done())
+
+                # Without accounting, the job is unknown to the scheduler
+                fake_executable(temp_folder, "squeue",
+                                "slurm_load_jobs error: "
+                                "Invalid job id specified\n", returncode=1)
+                exception = future.exception(timeout=30)
+                assert_true(isinstance(exception, RuntimeError))
+                assert_true("without any outcome" in str(exception))
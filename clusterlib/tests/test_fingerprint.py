@@ -0,0 +1,140 @@
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+
+from __future__ import unicode_literals
+
+import os.path as op
+import subprocess
+import sys
+
+from nose import SkipTest
+from nose.tools import assert_equal
+from nose.tools import assert_not_equal
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from .. import fingerprint as fingerprint_module
+from ..fingerprint import fingerprint
+from ..fingerprint import job_name
+from ..fingerprint import sqlite3_dumps_index
+from ..storage import sqlite3_loads
+from .._testing import TemporaryDirectory
+
+
+def test_fingerprint():
+    params = {"alpha": 0.1, "n": 10, "kernel": "rbf", "tol": None,
+              "layers": [10, (5, 2)], "flags": set(["a", "b"])}
+    digest = fingerprint(params)
+    assert_equal(len(digest), 40)
+
+    # Fingerprints are the same in another process, whatever the order
+    code = ("from clusterlib.fingerprint import fingerprint; "
+            "print(fingerprint({'flags': set(['b', 'a']), "
+            "'layers': [10, (5, 2)], 'tol': None, 'kernel': 'rbf', "
+            "'n': 10, 'alpha': 0.1}))")
+    output = subprocess.check_output([sys.executable, "-c", code])
+    assert_equal(output.decode("utf-8").strip(), digest)
+
+    # Objects of different types have different fingerprints
+    values = [None, True, 1, 1., "1", b"1", [1], (1, ), {1: 1}, set([1]),
+              [], (), {}, set(), ["a", "b"], ["ab"], [["a"], "b"]]
+    assert_equal(len(set(fingerprint(value) for value in values)),
+                 len(values))
+
+    assert_raises(TypeError, fingerprint, object())
+
+
+def test_fingerprint_numpy():
+    try:
+        import numpy as np
+    except ImportError:
+        raise SkipTest("numpy is required for this test.")
+
+    array = np.arange(24, dtype=np.float64).reshape(4, 6)
+    digest = fingerprint(array)
+    assert_equal(fingerprint(array.copy()), digest)
+    assert_equal(fingerprint(np.asfortranarray(array)), digest)
+    assert_not_equal(fingerprint(array.reshape(6, 4)), digest)
+    assert_not_equal(fingerprint(array.astype(np.float32)), digest)
+    assert_equal(fingerprint(array[:, ::2]),
+                 fingerprint(np.ascontiguousarray(array[:, ::2])))
+    assert_equal(fingerprint(np.array(["a", 1], dtype=object)),
+                 fingerprint(np.array(["a", 1], dtype=object)))
+
+    # NumPy scalars have the fingerprint of Python scalars
+    assert_equal(fingerprint(np.float64(0.5)), fingerprint(0.5))
+    assert_equal(fingerprint({"n": np.int64(3)}), fingerprint({"n": 3}))
+
+    # Arrays are hashed by chunks
+    old_chunk_size = fingerprint_module._CHUNK_SIZE
+    fingerprint_module._CHUNK_SIZE = 7
+    try:
+        assert_equal(fingerprint(array), digest)
+        assert_equal(fingerprint(np.asfortranarray(array)), digest)
+    finally:
+        fingerprint_module._CHUNK_SIZE = old_chunk_size
+
+    # Only the fingerprints of read-only arrays are cached
+    fingerprint(array)
+    array[0, 0] = -1
+    assert_not_equal(fingerprint(array), digest)
+    view = array[1:]
+    view.flags.writeable = False
+    fingerprint(view)
+    assert_true(id(view) not in fingerprint_module._ARRAY_CACHE)
+    array = array.copy()
+    array.flags.writeable = False
+    digest = fingerprint(array)
+    assert_true(id(array) in fingerprint_module._ARRAY_CACHE)
+    assert_equal(fingerprint(array), digest)
+    view = array[1:]
+    fingerprint(view)
+    assert_true(id(view) in fingerprint_module._ARRAY_CACHE)
+    key = id(array)
+    del array, view
+    assert_true(key not in fingerprint_module._ARRAY_CACHE)
+
+    # The fingerprint of an array made writeable again is computed again
+    array = np.arange(10)
+    array.flags.writeable = False
+    digest = fingerprint(array)
+    array.flags.writeable = True
+    array[0] = -1
+    assert_not_equal(fingerprint(array), digest)
+    assert_true(id(array) not in fingerprint_module._ARRAY_CACHE)
+
+    # Arrays whose data is a mutable buffer are not cached
+    data = bytearray(80)
+    array = np.frombuffer(data, dtype=np.float64)
+    array.flags.writeable = False
+    digest = fingerprint(array)
+    assert_true(id(array) not in fingerprint_module._ARRAY_CACHE)
+    data[0] = 1
+    assert_not_equal(fingerprint(array), digest)
+
+
+def test_job_name():
+    params = {"alpha": 0.1, "n": 10}
+    digest = fingerprint(params)
+
+    assert_equal(job_name(params), "job-" + digest)
+    assert_equal(job_name(params, prefix="svm c/d", max_length=30),
+                 "svm_c_d-" + digest[:22])
+    assert_equal(job_name(params, prefix="a" * 100, max_length=20),
+                 "aaa-" + digest[:16])
+    assert_equal(job_name(params, prefix="", max_length=16), digest[:16])
+    assert_equal(job_name(params, max_length=16), digest[:16])
+    assert_raises(ValueError, job_name, params, max_length=15)
+
+    with TemporaryDirectory() as temp_folder:
+        file_name = op.join(temp_folder, "index.sqlite3")
+        all_params = [{"n": n} for n in range(5)]
+        names = sqlite3_dumps_index(all_params, file_name, prefix="svm")
+        assert_equal(names, [job_name(p, prefix="svm") for p in all_params])
+
+        # Names can be indexed again
+        names = sqlite3_dumps_index(all_params[:2], file_name, prefix="svm")
+        index = sqlite3_loads(file_name)
+        assert_equal(len(index), 5)
+        assert_equal(index[names[1]], {"n": 1})
@@ -0,0 +1,97 @@
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+
+from __future__ import unicode_literals
+
+import os.path as op
+
+from nose.tools import assert_equal
+
+from .. import ledger
+from ..ledger import Ledger
+from .._testing import TemporaryDirectory
+
+
+def test_ledger():
+    launched = []
+    queried = []
+    states = {}
+    failing = []
+
+    def fake_launch(job_command, job_name="job", **kwargs):
+        launched.append((job_command, job_name, kwargs))
+        return str(len(launched))
+
+    def fake_job_states(job_ids, backend="auto"):
+        if failing:
+            raise RuntimeError("squeue failed with exit status 1")
+        queried.append((sorted(job_ids), backend))
+        return dict((job_id, states[job_id]) for job_id in job_ids
+                    if job_id in states)
+
+    old_launch, old_job_states = ledger.launch, ledger.job_states
+    ledger.launch, ledger.job_states = fake_launch, fake_job_states
+    try:
+        with TemporaryDirectory() as temp_folder:
+            instance = Ledger(op.join(temp_folder, "ledger.sqlite3"))
+            assert_equal(instance.entries(), {})
+            assert_equal(instance.reconcile(), set())
+            assert_equal(queried, [])
+
+            for param in range(4):
+                job_id = instance.launch("main %s" % param,
+                                         job_name="job-%s" % param,
+                                         memory=100, backend="slurm")
+                assert_equal(job_id, str(param + 1))
+            instance.record("other", 9, job_name="other", backend="sge")
+            assert_equal(launched[0], ("main 0", "job-0",
+                                       {"time": "24:00:00", "memory": 100,
+                                        "backend": "slurm"}))
+
+            entry = instance.entries(["main 1"])["main 1"]
+            assert_equal((entry.job_name, entry.job_id, entry.backend,
+                          entry.state, entry.resources),
+                         ("job-1", "2", "slurm", "PENDING",
+                          {"time": "24:00:00", "memory": 100}))
+
+            # Jobs are queried by backend, unknown jobs are in flight during
+            # the grace period
+            states.update({"1": "RUNNING", "2": "COMPLETED",
+                           "3": "TIMEOUT"})
+            assert_equal(instance.reconcile(),
+                         set(["main 0", "main 3", "other"]))
+            assert_equal(sorted(queried),
+                         [(["1", "2", "3", "4"], "slurm"), (["9"], "sge")])
+            assert_equal(instance.entries()["main 2"].state, "TIMEOUT")
+
+            # The states are left unchanged while the scheduler fails
+            failing.append(True)
+            assert_equal(instance.reconcile(grace=0),
+                         set(["main 0", "main 3", "other"]))
+            entries = instance.entries()
+            assert_equal(entries["main 0"].state, "RUNNING")
+            assert_equal(entries["main 3"].state, "PENDING")
+            del failing[:]
+
+            # Only the jobs in flight are queried
+            del queried[:]
+            states.update({"1": "COMPLETED"})
+            assert_equal(instance.reconcile(grace=0), set())
+            assert_equal(sorted(queried),
+                         [(["1", "4"], "slurm"), (["9"], "sge")])
+            entries = instance.entries()
+            assert_equal(entries["main 0"].state, "COMPLETED")
+            assert_equal(entries["main 3"].state, "UNKNOWN")
+            assert_equal(entries["other"].state, "UNKNOWN")
+
+            # A task submitted again replaces its previous submission
+            instance.launch("main 2", job_name="job-2", backend="slurm")
+            entry = instance.entries()["main 2"]
+            assert_equal((entry.job_id, entry.state), ("5", "PENDING"))
+            del queried[:]
+            assert_equal(instance.reconcile(), set(["main 2"]))
+            assert_equal(queried, [(["5"], "slurm")])
+            assert_equal(len(instance.entries()), 5)
+    finally:
+        ledger.launch, ledger.job_states = old_launch, old_job_states
@@ -0,0 +1,141 @@
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+
+from __future__ import unicode_literals
+
+import os
+import os.path as op
+import subprocess
+import sys
+from getpass import getuser
+from time import sleep
+
+from nose import SkipTest
+from nose.tools import assert_equal
+from nose.tools import assert_in
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from ..local import _parse_memory
+from ..local import _parse_time
+from ..local import enqueue
+from ..local import list_jobs
+from ..scheduler import _get_backend
+from ..scheduler import job_states
+from ..scheduler import launch
+from ..scheduler import queued_or_running_job_records
+from ..scheduler import queued_or_running_jobs
+from ..scheduler import submit
+from ..scheduler import submit_array
+from .._testing import TemporaryDirectory
+
+
+def _wait_for(job_names, n_trials=100):
+    """Wait until the jobs are neither queued nor running."""
+    for _ in range(n_trials):
+        if not set(job_names) & set(queued_or_running_jobs()):
+            return
+        sleep(0.1)
+    raise AssertionError("The jobs %s have not completed." % job_names)
+
+
+def _read(file_name):
+    with open(file_name) as fhandle:
+        return fhandle.read()
+
+
+def test_parse():
+    assert_equal(_parse_time(None), None)
+    assert_equal(_parse_time("700"), 700 * 60)
+    assert_equal(_parse_time("10:30"), 10 * 60 + 30)
+    assert_equal(_parse_time("24:00:00"), 24 * 3600)
+    assert_equal(_parse_time("2-12"), 60 * 3600)
+    assert_equal(_parse_time("1-00:00:10"), 24 * 3600 + 10)
+
+    assert_equal(_parse_memory(None), None)
+    assert_equal(_parse_memory("4000"), 4000)
+    assert_equal(_parse_memory("2G"), 2048)
+    assert_equal(_parse_memory("512k"), 0.5)
+
+
+def test_local_backend():
+    if os.name != "posix":
+        raise SkipTest("The local backend requires a POSIX system.")
+
+    original_env = dict(os.environ)
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        os.environ["CLUSTERLIB_LOCAL_SPOOL"] = op.join(temp_folder, "spool")
+        os.environ["CLUSTERLIB_LOCAL_N_JOBS"] = "2"
+        os.environ["CLUSTERLIB_BACKEND"] = "local"
+        try:
+            assert_equal(_get_backend(), "local")
+            assert_equal(_get_backend("local"), "local")
+
+            # Queries of submit and launch are run
+            command = submit("echo ok", job_name="query",
+                             log_directory=temp_folder)
+            output = subprocess.check_output(command, shell=True)
+            job_id = output.decode("utf-8").split()[-1]
+            job_id_2 = launch("echo \"it's ok\"", job_name="launch",
+                              log_directory=temp_folder)
+            assert_equal(int(job_id_2), int(job_id) + 1)
+
+            # The jobs are reported until they are done
+            job_names = ["sleep.%s" % i for i in range(3)]
+            for job_name in job_names:
+                launch("sleep 1", job_name=job_name,
+                       log_directory=temp_folder)
+            records = list(queued_or_running_job_records(user=getuser()))
+            assert_equal(sorted(record.name for record in records
+                                if record.name in job_names), job_names)
+            assert_true(all(record.state in ["PENDING", "RUNNING"]
+                            for record in records))
+            # There are at most 2 jobs running at once
+            assert_true(sum(job["state"] == "RUNNING"
+                            for job in list_jobs()) <= 2)
+
+            _wait_for(["query", "launch"] + job_names)
+            assert_equal(_read(op.join(temp_folder,
+                                       "query.%s.txt" % job_id)), "ok\n")
+            assert_equal(_read(op.join(temp_folder,
+                                       "launch.%s.txt" % job_id_2)),
+                         "it's ok\n")
+
+            # Time and memory limits are enforced
+            job_id = launch("sleep 60", job_name="time", time="00:00:01",
+                            log_directory=temp_folder)
+            memory_id = launch("%s -c 'bytearray(1024 ** 3)'"
+                               % sys.executable, job_name="memory",
+                               memory=500, log_directory=temp_folder)
+            _wait_for(["time", "memory"])
+            assert_in("time limit",
+                      _read(op.join(temp_folder, "time.%s.txt" % job_id)))
+            assert_in("MemoryError", _read(op.join(temp_folder,
+                                                   "memory.%s.txt"
+                                                   % memory_id)))
+
+            # The final state of the ended jobs is kept
+            assert_equal(job_states([job_id, memory_id, job_id_2, "0"],
+                                    backend="local"),
+                         {job_id: "TIMEOUT", memory_id: "FAILED",
+                          job_id_2: "COMPLETED"})
+
+            # The jobs of other users are not reported
+            enqueue("#!/bin/sh\nsleep 1\n", job_name="user",
+                    log_file=op.join(temp_folder, "user.%j.txt"))
+            assert_equal(queued_or_running_jobs(user="not-" + getuser()), [])
+            _wait_for(["user"])
+
+            assert_raises(ValueError, submit_array, "echo ok", temp_folder)
+        finally:
+            os.environ.clear()
+            os.environ.update(original_env)
+
+    # The local backend is never detected
+    if "CLUSTERLIB_BACKEND" not in os.environ:
+        try:
+            assert_true(_get_backend() != "local")
+        except RuntimeError:
+            pass
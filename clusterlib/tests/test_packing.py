@@ -0,0 +1,109 @@
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+
+from __future__ import unicode_literals
+
+import json
+import os
+import os.path as op
+import shlex
+import subprocess
+import sys
+
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+try:
+    from shlex import quote
+except ImportError:  # Python 2
+    from pipes import quote
+
+from ..packing import failed_tasks
+from ..packing import main
+from ..packing import run_pack
+from ..packing import submit_packs
+from .._testing import TemporaryDirectory
+
+
+def test_submit_packs():
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        commands = ["echo %s" % i for i in range(10)]
+
+        queries = submit_packs(commands, temp_folder, task_duration=60.,
+                               target_duration=200., backend="slurm")
+        assert_equal(len(queries), 4)
+        pack_file = op.join(temp_folder, "pack.0.json")
+        assert_equal(queries[0],
+                     "echo '#!/bin/bash\n%s -m clusterlib.packing %s "
+                     "--n-jobs 1' | sbatch --job-name=pack.0 "
+                     "--time=00:06:00 --mem=4000"
+                     % (quote(sys.executable), quote(pack_file)))
+        with open(pack_file) as fhandle:
+            assert_equal(json.load(fhandle),
+                         {"commands": ["echo 0", "echo 1", "echo 2"]})
+        with open(op.join(temp_folder, "pack.3.json")) as fhandle:
+            assert_equal(json.load(fhandle), {"commands": ["echo 9"]})
+
+        # The cpus are requested and used by the packs
+        queries = submit_packs(commands, temp_folder, task_duration=60.,
+                               target_duration=200., n_cpus=4,
+                               job_name="cpus", time="01:00:00",
+                               backend="sge")
+        assert_equal(len(queries), 1)
+        assert_true(queries[0].endswith("-l h_rt=01:00:00 -l h_vmem=4000M "
+                                        "-pe smp 4"))
+        assert_true("--n-jobs 4" in queries[0])
+
+        assert_raises(ValueError, submit_packs, commands, temp_folder,
+                      task_duration=0., backend="slurm")
+        assert_raises(ValueError, submit_packs, commands, temp_folder,
+                      task_duration=1., n_cpus=0, backend="slurm")
+        assert_raises(ValueError, submit_packs, commands, temp_folder,
+                      task_duration=1., backend="unknown")
+
+        # The pack file reaches the job script quoted
+        pack_directory = op.join(temp_folder, "my packs")
+        os.mkdir(pack_directory)
+        queries = submit_packs(commands, pack_directory, task_duration=60.,
+                               backend="slurm")
+        script = subprocess.check_output(queries[0].split(" | ")[0],
+                                         shell=True).decode("utf-8")
+        assert_equal(shlex.split(script.splitlines()[1])[3],
+                     op.join(pack_directory, "pack.0.json"))
+
+
+def test_run_pack():
+    for n_jobs in [1, 3]:
+        with TemporaryDirectory() as temp_folder:
+            commands = ["exit %s" % (i % 2) for i in range(6)]
+            submit_packs(commands, temp_folder, task_duration=1.,
+                         target_duration=4., backend="slurm")
+
+            # No task has run yet
+            assert_equal(failed_tasks(temp_folder), commands)
+
+            assert_equal(run_pack(op.join(temp_folder, "pack.0.json"),
+                                  n_jobs=n_jobs), 2)
+            with open(op.join(temp_folder, "pack.0.status")) as fhandle:
+                status = [json.loads(line) for line in fhandle]
+            assert_equal(sorted((s["task_id"], s["command"], s["returncode"])
+                                for s in status),
+                         [(0, "exit 0", 0), (1, "exit 1", 1),
+                          (2, "exit 0", 0), (3, "exit 1", 1)])
+            assert_equal(failed_tasks(temp_folder),
+                         ["exit 1", "exit 1", "exit 0", "exit 1"])
+
+            # The second pack is run from the command line
+            assert_equal(main([op.join(temp_folder, "pack.1.json")]), 1)
+            assert_equal(failed_tasks(temp_folder), ["exit 1"] * 3)
+            assert_equal(failed_tasks(temp_folder, job_name="other"), [])
+
+            # The failed tasks are submitted again in the same directory
+            commands = failed_tasks(temp_folder)
+            submit_packs(commands, temp_folder, task_duration=1.,
+                         target_duration=4., backend="slurm")
+            assert_equal(failed_tasks(temp_folder), commands)
+            assert_true(not op.exists(op.join(temp_folder, "pack.1.json")))
@@ -0,0 +1,70 @@
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+
+from __future__ import unicode_literals
+
+import os
+import os.path as op
+
+from nose import SkipTest
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from .._testing import TemporaryDirectory
+from .._testing import fake_executable
+from .._testing import prepend_path
+from .test_executor import _square
+
+
+def _import_joblib():
+    try:
+        import joblib
+    except ImportError:
+        raise SkipTest("joblib is required for this test.")
+    import clusterlib.parallel  # noqa, register the backend
+    return joblib
+
+
+def test_cluster_backend():
+    joblib = _import_joblib()
+    from clusterlib.parallel import ClusterBackend
+
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        fake_executable(temp_folder, "sbatch", "Submitted batch job 1\n",
+                        run=True)
+
+        with prepend_path(temp_folder):
+            with joblib.parallel_backend("clusterlib",
+                                         directory=op.join(temp_folder,
+                                                           "joblib"),
+                                         scheduler="slurm",
+                                         poll_interval=0.05):
+                results = joblib.Parallel(n_jobs=2)(
+                    joblib.delayed(_square)(i) for i in range(10))
+            assert_equal(results, [i ** 2 for i in range(10)])
+            assert_equal(os.listdir(op.join(temp_folder, "joblib")), [])
+
+    backend = ClusterBackend(max_n_jobs=10)
+    assert_equal(backend.effective_n_jobs(5), 5)
+    assert_equal(backend.effective_n_jobs(-1), 10)
+    assert_equal(backend.effective_n_jobs(-2), 9)
+    assert_equal(backend.effective_n_jobs(None), 1)
+    assert_raises(ValueError, backend.effective_n_jobs, 0)
+
+
+def test_cluster_backend_fallback():
+    joblib = _import_joblib()
+    from clusterlib.scheduler import _get_backend
+
+    try:
+        _get_backend("auto")
+        raise SkipTest("The fallback is used only without scheduler.")
+    except RuntimeError:
+        pass
+
+    with joblib.parallel_backend("clusterlib"):
+        results = joblib.Parallel(n_jobs=2)(
+            joblib.delayed(_square)(i) for i in range(10))
+    assert_equal(results, [i ** 2 for i in range(10)])
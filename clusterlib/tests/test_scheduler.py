@@ -5,39 +5,45 @@ from __future__ import unicode_literals
 
 import os
 import os.path as op
-from time import sleep
+from time import sleep, time
 import subprocess
+import threading
 from getpass import getuser
+from io import BytesIO
 
 from nose import SkipTest
 from nose.tools import assert_equal
 from nose.tools import assert_raises
 from nose.tools import assert_in
+from nose.tools import assert_true
 
+from clusterlib import scheduler
+from clusterlib.scheduler import JobRecord
+from clusterlib.scheduler import dispatch
+from clusterlib.scheduler import launch
+from clusterlib.scheduler import parse_job_id
 from clusterlib.scheduler import queued_or_running_jobs
+from clusterlib.scheduler import queued_or_running_job_records
 from clusterlib.scheduler import submit
+from clusterlib.scheduler import submit_array
+from clusterlib.scheduler import submit_dag
 from clusterlib.scheduler import _which
 from clusterlib.scheduler import _get_backend
+from clusterlib.scheduler import _get_backends
 from clusterlib._testing import TemporaryDirectory
+from clusterlib._testing import fake_executable
+from clusterlib._testing import prepend_path
 from clusterlib._testing import skip_if_no_backend
 
 
 def _check_job_id(command):
     """Perform a dispatch and return the job id."""
-    # TODO: This utility function should be properly documented any made more
-    # robust to be included in the scheduler module itself
-    cmd_encoding = 'utf-8'
-    output = subprocess.check_output(
-        command.encode(cmd_encoding), shell=True).decode(cmd_encoding)
-    if output.startswith(u'Your job '):
-        job_id = output.split()[2]
-    elif output.startswith(u'Submitted batch job '):
-        job_id = output.split()[3]
-    else:
+    receipt = dispatch([command])[0]
+    if receipt.job_id is None:
         raise RuntimeError(
             u"Failed to parse job_id from command output:\n %s\ncmd:\n%s"
-            % (command, output))
-    return job_id
+            % (receipt.output + receipt.error, command))
+    return receipt.job_id
 
 
 def test_auto_backend():
@@ -196,3 +202,462 @@ def test_submit():
         "--time=24:00:00 --mem=4000 -o /path/test/job.%j.txt")
 
     assert_raises(ValueError, submit, job_command="", backend="unknown")
+
+
+def test_submit_array():
+    """Test submission of job arrays."""
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        queries = submit_array("python main.py --param %(param)s",
+                               temp_folder, backend="slurm",
+                               parameters=[{"param": p} for p in range(3)])
+        assert_equal(queries, [
+            "sbatch --job-name=job --time=24:00:00 --mem=4000 --array=1-3 "
+            "%s" % op.join(temp_folder, "job.0.sh")])
+        with open(op.join(temp_folder, "job.0.sh")) as fhandle:
+            assert_equal(fhandle.read(),
+                         '#!/bin/bash\n'
+                         'case "$SLURM_ARRAY_TASK_ID" in\n'
+                         '1)\npython main.py --param 0\n;;\n'
+                         '2)\npython main.py --param 1\n;;\n'
+                         '3)\npython main.py --param 2\n;;\n'
+                         '*)\necho "Unknown task id: $SLURM_ARRAY_TASK_ID" '
+                         '>&2\nexit 1\n;;\nesac\n')
+
+        # Large arrays are split and throttled
+        queries = submit_array(["python main.py --param %s" % p
+                                for p in range(5)],
+                               temp_folder, job_name="big", backend="sge",
+                               log_directory="/path/test", max_concurrent=2,
+                               max_array_size=2)
+        assert_equal(queries, [
+            'qsub -N "big" -l h_rt=24:00:00 -l h_vmem=4000M -j y '
+            '-o \'/path/test/$JOB_NAME.$JOB_ID.$TASK_ID.txt\' -t 1-%s -tc 2 '
+            '%s' % (n_tasks, op.join(temp_folder, "big.%s.sh" % chunk))
+            for chunk, n_tasks in enumerate([2, 2, 1])])
+        with open(op.join(temp_folder, "big.2.sh")) as fhandle:
+            script = fhandle.read()
+        assert_in('case "$SGE_TASK_ID" in', script)
+        assert_in("1)\npython main.py --param 4\n", script)
+
+        queries = submit_array("python main.py", temp_folder,
+                               backend="slurm", log_directory="/path/test",
+                               max_concurrent=4)
+        assert_equal(queries, [
+            "sbatch --job-name=job --time=24:00:00 --mem=4000 "
+            "-o /path/test/job.%%A.%%a.txt --array=1-1%%4 "
+            "%s" % op.join(temp_folder, "job.0.sh")])
+
+        assert_raises(ValueError, submit_array, "", temp_folder,
+                      backend="unknown")
+        assert_raises(ValueError, submit_array, "", temp_folder,
+                      backend="slurm", max_array_size=0)
+
+
+def test_launch():
+    """Test submission without shell."""
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        fake_executable(temp_folder, "sbatch", "Submitted batch job 7\n")
+        fake_executable(temp_folder, "qsub",
+                        'Your job 8 ("job") has been submitted\n')
+
+        with prepend_path(temp_folder):
+            job_command = "python -c 'print(\"it\\'s ok\")'"
+            assert_equal(launch(job_command, job_name="a job",
+                                backend="slurm", options=["--partition=x"],
+                                log_directory="/path/test"), "7")
+            with open(op.join(temp_folder, "sbatch.argv")) as fhandle:
+                assert_equal(fhandle.read().splitlines(),
+                             ["--job-name=a job", "--time=24:00:00",
+                              "--mem=4000", "-o", "/path/test/a job.%j.txt",
+                              "--partition=x"])
+            with open(op.join(temp_folder, "sbatch.stdin")) as fhandle:
+                assert_equal(fhandle.read(),
+                             "#!/bin/bash\n%s\n" % job_command)
+
+            assert_equal(launch("echo ok", backend="sge", email="a@b.c",
+                                log_directory="/path/test"), "8")
+            with open(op.join(temp_folder, "qsub.argv")) as fhandle:
+                assert_equal(fhandle.read().splitlines(),
+                             ["-N", "job", "-l", "h_rt=24:00:00",
+                              "-l", "h_vmem=4000M", "-M", "a@b.c",
+                              "-j", "y", "-o",
+                              "/path/test/$JOB_NAME.$JOB_ID.txt"])
+
+            fake_executable(temp_folder, "sbatch", "sbatch: error\n", 1)
+            assert_raises(RuntimeError, launch, "echo ok", backend="slurm")
+            assert_raises(ValueError, launch, "echo ok", backend="unknown")
+
+
+def test_submit_dag():
+    """Test submission of graphs of jobs."""
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        # Each call gets a new job id
+        fake_executable(temp_folder, "sbatch",
+                        ["Submitted batch job %s\n" % i
+                         for i in range(1, 13)])
+
+        with prepend_path(temp_folder):
+            jobs = {"preprocess": "python preprocess.py",
+                    "aggregate": {"job_command": "python aggregate.py",
+                                  "job_name": "agg", "memory": 100}}
+            dependencies = {"aggregate": []}
+            for i in range(5):
+                jobs["fit-%s" % i] = "python fit.py %s" % i
+                dependencies["fit-%s" % i] = ["preprocess"]
+                dependencies["aggregate"].append("fit-%s" % i)
+
+            job_ids = submit_dag(jobs, dependencies, max_dependencies=2,
+                                 backend="slurm")
+            assert_equal(job_ids, {"preprocess": "1", "fit-0": "2",
+                                   "fit-1": "3", "fit-2": "4", "fit-3": "5",
+                                   "fit-4": "6", "aggregate": "12"})
+
+            with open(op.join(temp_folder, "sbatch.calls")) as fhandle:
+                calls = fhandle.read().splitlines()
+            assert_equal(calls[0], "--job-name=preprocess --time=24:00:00 "
+                                   "--mem=4000")
+            assert_equal(calls[1], "--job-name=fit-0 --time=24:00:00 "
+                                   "--mem=4000 --dependency=afterok:1")
+            # The fan-in of aggregate goes through two levels of barriers
+            barrier = "--job-name=agg.barrier%s --time=00:05:00 --mem=100 "
+            assert_equal(calls[6:], [
+                barrier % 0 + "--dependency=afterok:2:3",
+                barrier % 1 + "--dependency=afterok:4:5",
+                barrier % 2 + "--dependency=afterok:6",
+                barrier % 3 + "--dependency=afterok:7:8",
+                barrier % 4 + "--dependency=afterok:9",
+                "--job-name=agg --time=24:00:00 --mem=100 "
+                "--dependency=afterok:10:11",
+            ])
+
+            # The jobs submitted before a failure are given with the error
+            fake_executable(temp_folder, "sbatch",
+                            ["Submitted batch job %s\n" % i
+                             for i in range(1, 8)] + ["sbatch: error\n"])
+            try:
+                submit_dag(jobs, dependencies, max_dependencies=2,
+                           backend="slurm")
+            except ValueError as exception:
+                del job_ids["aggregate"]
+                assert_equal(exception.job_ids, job_ids)
+                assert_equal(exception.barrier_ids, ["7"])
+            else:
+                raise AssertionError("submit_dag should have failed")
+
+    assert_raises(ValueError, submit_dag, {"a": "true"}, {"a": ["b"]},
+                  backend="slurm")
+    assert_raises(ValueError, submit_dag, {"a": "true", "b": "true"},
+                  {"a": ["b"], "b": ["a"]}, backend="slurm")
+    assert_raises(ValueError, submit_dag, {"a": "true"}, max_dependencies=1,
+                  backend="slurm")
+
+
+def test_parse_job_id():
+    """Test parsing of the job id from the submission output."""
+    assert_equal(parse_job_id("Submitted batch job 1234\n"), "1234")
+    assert_equal(parse_job_id("sbatch: warning: low priority\n"
+                              "Submitted batch job 1234\n"), "1234")
+    assert_equal(parse_job_id("1234\n"), "1234")
+    assert_equal(parse_job_id("1234;cluster\n"), "1234")
+    assert_equal(parse_job_id("1234.1-10:1\n"), "1234")
+    assert_equal(parse_job_id('Your job 1234 ("job") has been submitted\n'),
+                 "1234")
+    assert_equal(parse_job_id('Your job-array 1234.1-10:1 ("job") has been '
+                              'submitted\n'), "1234")
+    assert_raises(ValueError, parse_job_id, "")
+    assert_raises(ValueError, parse_job_id, "sbatch: error: invalid\n")
+
+
+def test_dispatch():
+    """Test concurrent dispatch of submission queries."""
+    with TemporaryDirectory() as temp_folder:
+        flag = op.join(temp_folder, "flag")
+        queries = [
+            "echo 'Submitted batch job 1'",
+            "echo '2;cluster'",
+            "echo 'Your job 3 (\"job\") has been submitted'",
+            # Fail for good
+            "echo 'sbatch: error: invalid partition' >&2; exit 1",
+            # Fail once with a transient error
+            "test -f %s || { touch %s; echo 'Socket timed out' >&2; "
+            "exit 1; }; echo 'Submitted batch job 5'" % (flag, flag),
+        ]
+
+        start = time()
+        receipts = dispatch(queries, n_jobs=3, rate=20., backoff=0.01)
+        # The retry is also rate limited
+        assert_true(time() - start >= 5 / 20.)
+
+        assert_equal([receipt.query for receipt in receipts], queries)
+        assert_equal([receipt.job_id for receipt in receipts],
+                     ["1", "2", "3", None, "5"])
+        assert_equal([receipt.n_attempts for receipt in receipts],
+                     [1, 1, 1, 1, 2])
+        assert_equal(receipts[3].returncode, 1)
+        assert_in("invalid partition", receipts[3].error)
+
+        receipts = dispatch(["echo 'Socket timed out' >&2; exit 1"],
+                            max_retries=2, backoff=0.01)
+        assert_equal(receipts[0].job_id, None)
+        assert_equal(receipts[0].n_attempts, 3)
+
+    assert_equal(dispatch([]), [])
+    assert_raises(ValueError, dispatch, [], n_jobs=0)
+    assert_raises(ValueError, dispatch, [], rate=0)
+
+
+def test_queued_or_running_jobs_cache():
+    """Test the cache of the queued or running jobs."""
+    calls = []
+
+    def fake_queued_or_running_jobs(user, encoding):
+        calls.append(user)
+        sleep(0.1)
+        return ["job-%s" % len(calls)]
+
+    original = scheduler._queued_or_running_jobs
+    scheduler._queued_or_running_jobs = fake_queued_or_running_jobs
+    scheduler._QUEUE_CACHE.clear()
+    try:
+        # In memory cache
+        assert_equal(queued_or_running_jobs(cache_ttl=60), ["job-1"])
+        assert_equal(queued_or_running_jobs(cache_ttl=60), ["job-1"])
+        assert_equal(queued_or_running_jobs(user="other", cache_ttl=60),
+                     ["job-2"])
+        assert_equal(queued_or_running_jobs(cache_ttl=0), ["job-3"])
+        assert_equal(queued_or_running_jobs(), ["job-4"])
+
+        # Concurrent calls are coalesced
+        scheduler._QUEUE_CACHE.clear()
+        del calls[:]
+        threads = [threading.Thread(target=queued_or_running_jobs,
+                                    kwargs={"cache_ttl": 60})
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(len(calls), 1)
+
+        # Cache shared through a file
+        with TemporaryDirectory() as temp_folder:
+            cache_file = op.join(temp_folder, "queue.json")
+            scheduler._QUEUE_CACHE.clear()
+            del calls[:]
+            assert_equal(queued_or_running_jobs(cache_ttl=60,
+                                                cache_file=cache_file),
+                         ["job-1"])
+
+            # As seen from another process
+            scheduler._QUEUE_CACHE.clear()
+            assert_equal(queued_or_running_jobs(cache_ttl=60,
+                                                cache_file=cache_file),
+                         ["job-1"])
+            assert_equal(len(calls), 1)
+
+            scheduler._QUEUE_CACHE.clear()
+            sleep(0.2)
+            assert_equal(queued_or_running_jobs(cache_ttl=0.1,
+                                                cache_file=cache_file),
+                         ["job-2"])
+
+            # A corrupted cache file is ignored
+            with open(cache_file, "w") as fhandle:
+                fhandle.write("{")
+            scheduler._QUEUE_CACHE.clear()
+            assert_equal(queued_or_running_jobs(cache_ttl=60,
+                                                cache_file=cache_file),
+                         ["job-3"])
+    finally:
+        scheduler._queued_or_running_jobs = original
+        scheduler._QUEUE_CACHE.clear()
+
+
+_QSTAT_XML = b"""<?xml version='1.0'?>
+<job_info xmlns:xsd="qstat.xsd">
+  <queue_info>
+    <job_list state="running">
+      <JB_job_number>12</JB_job_number>
+      <JAT_prio>0.55500</JAT_prio>
+      <JB_name>test-sl\xc3\xa9\xc3\xa9py-job</JB_name>
+      <JB_owner>alice</JB_owner>
+      <state>r</state>
+      <JAT_start_time>2015-03-02T10:21:03</JAT_start_time>
+      <queue_name>all.q@node-1</queue_name>
+      <slots>1</slots>
+    </job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending">
+      <JB_job_number>13</JB_job_number>
+      <JAT_prio>0.00000</JAT_prio>
+      <JB_name>pending-job</JB_name>
+      <JB_owner>bob</JB_owner>
+      <state>qw</state>
+      <JB_submission_time>2015-03-02T10:21:01</JB_submission_time>
+      <queue_name></queue_name>
+      <slots>4</slots>
+    </job_list>
+  </job_info>
+</job_info>
+"""
+
+
+def test_parse_sge_records():
+    """Test the parsing of the output of qstat -xml."""
+    records = list(scheduler._parse_sge_records(BytesIO(_QSTAT_XML)))
+    assert_equal(records, [
+        JobRecord(job_id="12", name=u"test-sl\xe9\xe9py-job", state="r",
+                  user="alice", partition="all.q", submit_time=None,
+                  start_time="2015-03-02T10:21:03",
+                  resources={"slots": "1", "queue": "all.q@node-1"}),
+        JobRecord(job_id="13", name="pending-job", state="qw", user="bob",
+                  partition=None, submit_time="2015-03-02T10:21:01",
+                  start_time=None, resources={"slots": "4"}),
+    ])
+
+    # Output of a proxy to qstat
+    assert_equal(list(scheduler._parse_sge_records(BytesIO(b"job-id  name"))),
+                 [])
+
+
+def test_parse_slurm_records():
+    """Test the parsing of the output of squeue."""
+    output = [
+        b"42|RUNNING|alice|batch|2015-03-02T10:21:01|2015-03-02T10:21:03|"
+        b"1|4000M|1-00:00:00|1|job|with|pipes\n",
+        b"\n",
+        b"43_[1-10]|PENDING|bob|gpu|2015-03-02T10:21:01|N/A|8|1G|10:00|2|"
+        b"test-sl\xc3\xa9\xc3\xa9py-job\n",
+    ]
+    records = list(scheduler._parse_slurm_records(output))
+    assert_equal(records, [
+        JobRecord(job_id="42", name="job|with|pipes", state="RUNNING",
+                  user="alice", partition="batch",
+                  submit_time="2015-03-02T10:21:01",
+                  start_time="2015-03-02T10:21:03",
+                  resources={"cpus": "1", "memory": "4000M",
+                             "time_limit": "1-00:00:00", "nodes": "1"}),
+        JobRecord(job_id="43_[1-10]", name=u"test-sl\xe9\xe9py-job",
+                  state="PENDING", user="bob", partition="gpu",
+                  submit_time="2015-03-02T10:21:01", start_time=None,
+                  resources={"cpus": "8", "memory": "1G",
+                             "time_limit": "10:00", "nodes": "2"}),
+    ])
+
+
+def test_queued_or_running_job_records():
+    """Test that records and names of the jobs are consistent."""
+    if _which('qmod') is None and _which('scontrol') is None:
+        assert_equal(list(queued_or_running_job_records()), [])
+    else:
+        user = getuser()
+        names = queued_or_running_jobs(user=user)
+        records = list(queued_or_running_job_records(user=user))
+        assert_equal(sorted(record.name for record in records),
+                     sorted(names))
+
+
+def test_get_backends():
+    """Check the detection of all the available backends."""
+    original_env_backend = os.environ.pop('CLUSTERLIB_BACKEND', None)
+    try:
+        expected = []
+        if _which('scontrol'):
+            expected.append('slurm')
+        if _which('qmod'):
+            expected.append('sge')
+        assert_equal(_get_backends(), expected)
+
+        os.environ['CLUSTERLIB_BACKEND'] = 'sge'
+        assert_equal(_get_backends(), ['sge'])
+
+        os.environ['CLUSTERLIB_BACKEND'] = 'hadoop'
+        assert_raises(ValueError, _get_backends)
+    finally:
+        os.environ.pop('CLUSTERLIB_BACKEND', None)
+        if original_env_backend is not None:
+            os.environ['CLUSTERLIB_BACKEND'] = original_env_backend
+
+
+def test_query_backends():
+    """Check that several backends are queried concurrently."""
+    started = threading.Event()
+
+    def slow(user, encoding):
+        # Would time out if the backends were queried sequentially
+        if not started.wait(5):
+            return ["sequential"]
+        return ["slow-%s" % user]
+
+    def fast(user, encoding):
+        started.set()
+        return ["fast-%s" % user]
+
+    queries = {"slow": slow, "fast": fast}
+    assert_equal(scheduler._query_backends(queries, ["slow", "fast"],
+                                           "me", "utf-8"),
+                 [["slow-me"], ["fast-me"]])
+    assert_equal(scheduler._query_backends(queries, ["fast"], "me", "utf-8"),
+                 [["fast-me"]])
+    assert_equal(scheduler._query_backends(queries, [], "me", "utf-8"), [])
+
+
+def test_job_states():
+    """Test the targeted queries of the states of jobs."""
+    assert_equal(scheduler.job_states([], backend="slurm"), {})
+
+    with TemporaryDirectory() as temp_folder:
+        temp_folder = op.abspath(temp_folder)
+        fake_executable(temp_folder, "squeue",
+                        "5|RUNNING\n6_1|PENDING\n6_2|RUNNING\n")
+        fake_executable(temp_folder, "sacct",
+                        "7|COMPLETED\n8|CANCELLED by 1000\n"
+                        "8.batch|CANCELLED\n")
+        fake_executable(temp_folder, "qstat",
+                        "<detailed_job_info><djob_info>"
+                        "<element><JB_job_number>5</JB_job_number>"
+                        "<JB_ja_tasks><ulong_sublist>"
+                        "<JAT_task_number>1</JAT_task_number>"
+                        "</ulong_sublist></JB_ja_tasks></element>"
+                        "<element><JB_job_number>6</JB_job_number></element>"
+                        "</djob_info></detailed_job_info>\n")
+        fake_executable(temp_folder, "qacct",
+                        "=" * 62 + "\nqname        all.q\njobnumber    7\n"
+                        "failed       0\nexit_status  1\n")
+
+        with prepend_path(temp_folder):
+            assert_equal(scheduler.job_states(["5", "6", 7, "8", "9"],
+                                              backend="slurm"),
+                         {"5": "RUNNING", "6": "PENDING", "7": "COMPLETED",
+                          "8": "CANCELLED"})
+            with open(op.join(temp_folder, "squeue.calls")) as fhandle:
+                assert_in("-j 5,6,7,8,9", fhandle.read())
+            # Only the jobs which have left the queue are accounted
+            with open(op.join(temp_folder, "sacct.calls")) as fhandle:
+                assert_in("-j 7,8,9", fhandle.read())
+
+            assert_equal(scheduler.job_states(["5", "6", "7"], backend="sge"),
+                         {"5": "RUNNING", "6": "PENDING", "7": "FAILED"})
+
+            # Jobs unknown to the queue are accounted, while a failure of
+            # the query is raised instead of giving unknown jobs.
+            fake_executable(temp_folder, "squeue", "slurm_load_jobs error: "
+                            "Invalid job id specified\n", returncode=1)
+            states = scheduler.job_states(["7"], backend="slurm")
+            assert_equal(states["7"], "COMPLETED")
+            fake_executable(temp_folder, "squeue", "slurm_load_jobs error: "
+                            "Socket timed out\n", returncode=1)
+            assert_raises(RuntimeError, scheduler.job_states, ["7"],
+                          backend="slurm")
+
+    assert_equal(scheduler._parse_qacct_state(
+        "jobnumber 3\nfailed 0\nexit_status 0\n"), "COMPLETED")
+    assert_equal(scheduler._parse_qacct_state(
+        "jobnumber 3\nfailed 37 : qmaster enforced h_rt limit\n"
+        "exit_status 0\n"), "FAILED")
+    assert_equal(scheduler._parse_qacct_state("error: job id 3 not found"),
+                 None)
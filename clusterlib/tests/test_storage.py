@@ -2,14 +2,40 @@
 #
 # License: BSD 3 clause
 
+import os
 import sqlite3
+import threading
+import warnings
+from contextlib import closing
 from tempfile import NamedTemporaryFile
+from time import sleep
 
+from nose import SkipTest
 from nose.tools import assert_equal
 from nose.tools import assert_raises
+from nose.tools import assert_true
 
+from ..storage import _bloom_positions
+from ..storage import _bloom_read
+from ..storage import _compressed
+from ..storage import grid_index
+from ..storage import main
+from ..storage import sqlite3_iterloads
 from ..storage import sqlite3_loads
 from ..storage import sqlite3_dumps
+from ..storage import sqlite3_dumps_fields
+from ..storage import sqlite3_cache_dumps
+from ..storage import sqlite3_cache_loads
+from ..storage import sqlite3_cache_sweep
+from ..storage import sqlite3_bloom
+from ..storage import sqlite3_contains
+from ..storage import sqlite3_gather
+from ..storage import sqlite3_gather_frame
+from ..storage import sqlite3_loads_fields
+from ..storage import sqlite3_snapshot
+from ..storage import sqlite3_stats
+from ..storage import sqlite3_vacuum
+from .._testing import TemporaryDirectory
 
 
 def test_sqlite3_storage():
@@ -63,3 +89,361 @@ def test_sqlite3_storage():
     # Without any sqlite 3 database
     assert_equal(sqlite3_loads(fname, "0"), dict())
     assert_equal(sqlite3_loads(fname, ["0", "1"]), dict())
+
+
+def test_sqlite3_iterloads():
+    with NamedTemporaryFile() as fhandle:
+        fname = fhandle.name
+
+        data = dict((str(i), list(range(i))) for i in range(50))
+        sqlite3_dumps(data, fname)
+        keys = [str(i) for i in range(49, -1, -3)] + ["unknown"]
+
+        for n_jobs, pool in [(1, "process"), (2, "process"), (2, "thread"),
+                             (-1, "process")]:
+            # Order of the keys is preserved
+            assert_equal(list(sqlite3_iterloads(fname, key=keys,
+                                                n_jobs=n_jobs, pool=pool,
+                                                chunk_size=3)),
+                         [(k, data[k]) for k in keys if k in data])
+
+            # Storage order is deterministic
+            assert_equal(list(sqlite3_iterloads(fname, n_jobs=n_jobs,
+                                                pool=pool, chunk_size=7)),
+                         list(sqlite3_iterloads(fname)))
+
+            assert_equal(sqlite3_loads(fname, n_jobs=n_jobs), data)
+            assert_equal(sqlite3_loads(fname, key="3", n_jobs=n_jobs),
+                         {"3": data["3"]})
+
+        assert_raises(ValueError, list,
+                      sqlite3_iterloads(fname, n_jobs=0))
+        assert_raises(ValueError, list,
+                      sqlite3_iterloads(fname, n_jobs=2, pool="unknown"))
+
+    # Without any sqlite 3 database
+    assert_equal(list(sqlite3_iterloads(fname, n_jobs=2)), [])
+    assert_equal(sqlite3_loads(fname, n_jobs=2), dict())
+
+
+def test_sqlite3_vacuum():
+    with TemporaryDirectory() as temp_folder:
+        fname = os.path.join(temp_folder, "test.sqlite3")
+        assert_raises(IOError, sqlite3_stats, fname)
+        assert_raises(IOError, sqlite3_vacuum, fname)
+
+        # Fragment the database
+        sqlite3_dumps(dict((str(i), "a" * 5000) for i in range(50)), fname)
+        data = dict((str(i), i) for i in range(50))
+        sqlite3_dumps(data, fname, overwrite=True)
+
+        stats = sqlite3_stats(fname, detailed=True)
+        assert_equal(stats["auto_vacuum"], "none")
+        assert_true(stats["freelist_count"] > 0)
+        assert_true(0. < stats["fragmentation"] <= 1.)
+
+        # Incremental vacuum needs a first full vacuum to be effective
+        with warnings.catch_warnings(record=True) as record:
+            warnings.simplefilter("always")
+            sqlite3_vacuum(fname, mode="incremental")
+        assert_equal(len(record), 1)
+
+        stats = sqlite3_vacuum(fname, mode="full")
+        assert_equal(stats["freelist_count"], 0)
+        assert_equal(stats["auto_vacuum"], "incremental")
+        assert_equal(sqlite3_loads(fname), data)
+
+        # Free some pages and reclaim them incrementally
+        sqlite3_dumps(dict((str(i), "a" * 5000) for i in range(50)), fname,
+                      overwrite=True)
+        sqlite3_dumps(data, fname, overwrite=True)
+        n_free_pages = sqlite3_stats(fname)["freelist_count"]
+        assert_true(n_free_pages > 2)
+        stats = sqlite3_vacuum(fname, mode="incremental", n_pages=2)
+        assert_equal(stats["freelist_count"], n_free_pages - 2)
+        stats = sqlite3_vacuum(fname, mode="incremental", analyze=False)
+        assert_equal(stats["freelist_count"], 0)
+
+        stats = sqlite3_vacuum(fname, mode="full")
+        assert_equal(stats["freelist_count"], 0)
+        assert_equal(sqlite3_loads(fname), data)
+
+        assert_raises(ValueError, sqlite3_vacuum, fname, mode="unknown")
+        assert_raises(ValueError, sqlite3_vacuum, fname, mode="swap")
+
+        # No concurrent write is lost by a vacuum
+        fname = os.path.join(temp_folder, "concurrent.sqlite3")
+        sqlite3_dumps(dict((str(i), "a" * 5000) for i in range(50)), fname)
+        written = dict(("w%s" % i, i) for i in range(100))
+
+        def write():
+            for key, value in written.items():
+                sqlite3_dumps({key: value}, fname)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        for mode in ["full", "incremental"] * 5:
+            sqlite3_vacuum(fname, mode=mode, analyze=False)
+        writer.join()
+        assert_equal(sqlite3_loads(fname, key=list(written)), written)
+
+        # Command line interface
+        assert_equal(main(["vacuum", "--mode", "full", fname]), 0)
+        assert_equal(main(["stats", fname]), 0)
+
+
+def test_sqlite3_snapshot():
+    with TemporaryDirectory() as temp_folder:
+        fname = os.path.join(temp_folder, "test.sqlite3")
+        snapshot_name = os.path.join(temp_folder, "snapshot.sqlite3")
+        assert_raises(IOError, sqlite3_snapshot, fname)
+
+        data = dict((str(i), i) for i in range(50))
+        sqlite3_dumps(data, fname)
+
+        # In memory snapshot
+        snapshot = sqlite3_snapshot(fname, pages=1)
+        assert_equal(sqlite3_loads(snapshot), data)
+        assert_equal(sqlite3_loads(snapshot, key=["3", "unknown"]),
+                     {"3": 3})
+        assert_equal(list(sqlite3_iterloads(snapshot, key="3")), [("3", 3)])
+
+        # Snapshot on disk
+        assert_equal(sqlite3_snapshot(fname, snapshot_name, pages=2),
+                     snapshot_name)
+        assert_equal(sqlite3_loads(snapshot_name), data)
+
+        # Refresh is skipped whenever the database is unchanged
+        with closing(sqlite3.connect(snapshot_name)) as connection:
+            connection.execute("DELETE FROM dict WHERE key = '0'")
+            connection.commit()
+        sqlite3_snapshot(fname, snapshot_name)
+        assert_equal(len(sqlite3_loads(snapshot_name)), 49)
+
+        # Refresh after modifications
+        sqlite3_dumps({"new": "value"}, fname)
+        data["new"] = "value"
+        assert_true(sqlite3_snapshot(fname, snapshot) is snapshot)
+        assert_equal(sqlite3_loads(snapshot), data)
+        sqlite3_snapshot(fname, snapshot_name)
+        assert_equal(sqlite3_loads(snapshot_name), data)
+        snapshot.close()
+
+        # Command line interface
+        os.remove(snapshot_name)
+        assert_equal(main(["snapshot", fname, snapshot_name]), 0)
+        assert_equal(sqlite3_loads(snapshot_name), data)
+
+
+def test_sqlite3_fields():
+    with TemporaryDirectory() as temp_folder:
+        fname = os.path.join(temp_folder, "test.sqlite3")
+        assert_equal(sqlite3_loads_fields(fname), dict())
+
+        data = dict(("job-%s" % i, {"accuracy": i / 10., "n_iter": i,
+                                    "name": "job-%s" % i,
+                                    "predictions": list(range(i)),
+                                    "converged": i % 2 == 0,
+                                    "large": 2 ** 70 + i,
+                                    "none": None})
+                    for i in range(10))
+        sqlite3_dumps_fields(data, fname)
+        assert_equal(sqlite3_loads_fields(fname), data)
+
+        # Scalar fields are stored natively, others are pickled
+        with closing(sqlite3.connect(fname)) as connection:
+            types = dict(connection.execute(
+                "SELECT field, typeof(value) FROM fields "
+                "WHERE key = 'job-1'").fetchall())
+        assert_equal(types, {"accuracy": "real", "n_iter": "integer",
+                             "name": "text", "none": "null",
+                             "predictions": "blob", "converged": "blob",
+                             "large": "blob"})
+
+        # Subset of fields and keys
+        assert_equal(sqlite3_loads_fields(fname, field="accuracy"),
+                     dict((k, {"accuracy": v["accuracy"]})
+                          for k, v in data.items()))
+        assert_equal(sqlite3_loads_fields(fname, key=["job-1", "unknown"],
+                                          field=["n_iter", "unknown"]),
+                     {"job-1": {"n_iter": 1}})
+        assert_equal(sqlite3_loads_fields(fname, key="job-2"),
+                     {"job-2": data["job-2"]})
+        assert_equal(sqlite3_loads_fields(fname, field="unknown"), dict())
+
+        # Conflicts
+        assert_raises(sqlite3.IntegrityError, sqlite3_dumps_fields,
+                      {"job-1": {"other": 1}}, fname)
+        sqlite3_dumps_fields({"job-1": {"other": 1}}, fname, overwrite=True)
+        assert_equal(sqlite3_loads_fields(fname, key="job-1"),
+                     {"job-1": {"other": 1}})
+
+        assert_raises(TypeError, sqlite3_dumps_fields, {"job": 1}, fname)
+        assert_raises(TypeError, sqlite3_dumps_fields, {5: {}}, fname)
+
+
+def test_sqlite3_gather():
+    try:
+        import numpy as np
+    except ImportError:
+        raise SkipTest("numpy is required for this test.")
+
+    with TemporaryDirectory() as temp_folder:
+        fname = os.path.join(temp_folder, "test.sqlite3")
+
+        grid = [("alpha", [0.1, 1.]), ("n", [1, 2, 3])]
+        index = grid_index("alpha=%(alpha)s-n=%(n)s", grid)
+        assert_equal(len(index), 6)
+        assert_equal(index["alpha=0.1-n=3"], (0, 2))
+        assert_raises(ValueError, grid_index, "alpha=%(alpha)s", grid)
+
+        values = dict((k, np.arange(4) * i)
+                      for i, k in enumerate(sorted(index)) if i != 3)
+        sqlite3_dumps(values, fname)
+        sqlite3_dumps_fields(dict((k, {"sum": float(v.sum())})
+                                  for k, v in values.items()), fname)
+
+        for n_jobs in [1, 2]:
+            out, missing = sqlite3_gather(fname, index, value_shape=(4, ),
+                                          n_jobs=n_jobs, fill_value=-1)
+            assert_equal(out.shape, (2, 3, 4))
+            assert_equal(missing.shape, (2, 3))
+            for k, pos in index.items():
+                if k in values:
+                    np.testing.assert_array_equal(out[pos], values[k])
+                    assert_true(not missing[pos])
+                else:
+                    np.testing.assert_array_equal(out[pos], -1)
+                    assert_true(missing[pos])
+
+        # Gather a scalar field with a key parsing function
+        def parse(key):
+            alpha, n = key.split("-")
+            return ([0.1, 1.].index(float(alpha[len("alpha="):])),
+                    int(n[len("n="):]) - 1)
+
+        out, missing = sqlite3_gather(fname, parse, shape=(2, 3),
+                                      field="sum", dtype=int)
+        assert_equal(missing.sum(), 1)
+        for k, pos in index.items():
+            if k in values:
+                assert_equal(out[pos], values[k].sum())
+
+        assert_raises(ValueError, sqlite3_gather, fname, parse)
+
+        # Gather into a data frame
+        try:
+            import pandas  # noqa
+        except ImportError:
+            raise SkipTest("pandas is required for this test.")
+        sqlite3_dumps_fields({"other": {"other": 1}}, fname)
+        frame = sqlite3_gather_frame(fname, field=["sum", "other"],
+                                     chunk_size=2)
+        assert_equal(frame.shape, (6, 2))
+        assert_equal(frame.loc["alpha=0.1-n=2", "sum"], 6)
+        assert_true(np.isnan(frame.loc["alpha=0.1-n=2", "other"]))
+
+        frame = sqlite3_gather_frame(fname, key=sorted(index), chunk_size=2)
+        assert_equal(frame.shape, (5, 1))
+        assert_equal(list(frame.columns), ["value"])
+        assert_equal(sqlite3_gather_frame(fname, key="unknown").shape,
+                     (0, 0))
+
+
+def test_sqlite3_cache():
+    with TemporaryDirectory() as temp_folder:
+        fname = os.path.join(temp_folder, "test.sqlite3")
+        assert_equal(sqlite3_cache_loads(fname), dict())
+        assert_equal(sqlite3_cache_sweep(fname), 0)
+
+        # Values stored without the cache functions are loaded as usual
+        sqlite3_dumps({"plain": 1}, fname)
+        assert_equal(sqlite3_cache_loads(fname, key="plain"), {"plain": 1})
+
+        # Time to live
+        sqlite3_cache_dumps({"long": 2}, fname, ttl=3600)
+        sqlite3_cache_dumps({"short": 1}, fname, ttl=0.1)
+        sleep(0.2)
+        assert_equal(sqlite3_cache_loads(fname, key=["short", "long"]),
+                     {"long": 2})
+        assert_equal(sqlite3_cache_sweep(fname), 1)
+        assert_equal(sqlite3_loads(fname), {"plain": 1, "long": 2})
+
+        # Expired entries are lazily evicted during writes
+        sqlite3_cache_dumps({"short": 1}, fname, ttl=0.1)
+        sleep(0.2)
+        sqlite3_cache_dumps({"other": 3}, fname)
+        assert_equal(sqlite3_loads(fname), {"plain": 1, "long": 2,
+                                            "other": 3})
+
+        # Bounded size with a least recently used policy
+        size = len(_compressed("a" * 1000))
+        for k in "abc":
+            sqlite3_cache_dumps({k: k * 1000}, fname)
+        sqlite3_cache_loads(fname, key="a", access_sampling=1.)
+        sqlite3_cache_dumps({"d": "d" * 1000}, fname, max_bytes=3 * size + 10)
+        assert_equal(sorted(sqlite3_cache_loads(fname, access_sampling=0.)),
+                     ["a", "c", "d", "plain"])
+
+        # Least frequently used policy
+        for _ in range(3):
+            sqlite3_cache_loads(fname, key=["c", "d"], access_sampling=1.)
+        sqlite3_cache_loads(fname, key="a", access_sampling=1.)
+        sqlite3_cache_dumps({"e": "e" * 1000}, fname, max_bytes=3 * size + 10,
+                            policy="lfu")
+        assert_equal(sorted(sqlite3_cache_loads(fname, access_sampling=0.)),
+                     ["c", "d", "e", "plain"])
+
+        # Explicit sweep
+        assert_equal(sqlite3_cache_sweep(fname, max_bytes=size + 10), 2)
+        assert_equal(sorted(sqlite3_cache_loads(fname, access_sampling=0.)),
+                     ["e", "plain"])
+
+        assert_raises(ValueError, sqlite3_cache_sweep, fname, policy="fifo")
+
+
+def test_sqlite3_bloom():
+    with TemporaryDirectory() as temp_folder:
+        fname = os.path.join(temp_folder, "test.sqlite3")
+        assert_equal(sqlite3_contains(fname, "0"), set())
+        assert_raises(IOError, sqlite3_bloom, fname)
+
+        sqlite3_dumps(dict((str(i), i) for i in range(100)), fname)
+        sqlite3_dumps_fields({"fields": {"a": 1}}, fname)
+        assert_raises(ValueError, sqlite3_bloom, fname, error_rate=0)
+
+        for bloom in [False, True]:
+            if bloom:
+                bloom_name = sqlite3_bloom(fname, capacity=1000)
+                assert_true(os.path.exists(bloom_name))
+
+            assert_equal(sqlite3_contains(fname, "3"), set(["3"]))
+            keys = [str(i) for i in range(-100, 200)] + ["fields"]
+            assert_equal(sqlite3_contains(fname, keys, batch_size=7),
+                         set([str(i) for i in range(100)] + ["fields"]))
+
+        # The filter is updated at each dump
+        sqlite3_dumps({"new": 1}, fname)
+        sqlite3_dumps_fields({"new_fields": {"a": 1}}, fname)
+        sqlite3_cache_dumps({"new_cache": 1}, fname)
+        assert_equal(sqlite3_contains(fname, ["new", "new_fields",
+                                              "new_cache", "unknown"]),
+                     set(["new", "new_fields", "new_cache"]))
+
+        # The filter has no false negative and few false positives
+        n_bits, n_hashes, bits = _bloom_read(bloom_name)
+        for k in ["new", "new_fields", "new_cache", "0"]:
+            assert_true(all(bits[p // 8] & (1 << (p % 8))
+                            for p in _bloom_positions(k, n_bits, n_hashes)))
+        n_false_positives = sum(
+            all(bits[p // 8] & (1 << (p % 8))
+                for p in _bloom_positions("unknown-%s" % i, n_bits,
+                                          n_hashes))
+            for i in range(1000))
+        assert_true(n_false_positives < 50)
+
+        # Rebuild on compaction with the same size
+        sqlite3_vacuum(fname, mode="full")
+        assert_equal(_bloom_read(bloom_name)[:2], (n_bits, n_hashes))
+        assert_equal(sqlite3_contains(fname, ["new", "unknown"]),
+                     set(["new"]))
@@ -0,0 +1,84 @@
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+
+from __future__ import unicode_literals
+
+import os.path as op
+from itertools import product
+
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from ..storage import sqlite3_dumps
+from ..sweep import ProductGrid
+from ..sweep import SampledGrid
+from ..sweep import ZipGrid
+from ..sweep import pending
+from .._testing import TemporaryDirectory
+
+
+def test_grids():
+    grid = ProductGrid([("a", [1, 2, 3]), ("b", "xy"), ("c", range(4))])
+    expected = [dict(a=a, b=b, c=c)
+                for a, b, c in product([1, 2, 3], "xy", range(4))]
+    assert_equal(len(grid), 24)
+    assert_equal(list(grid), expected)
+    assert_equal([grid[i] for i in range(24)], expected)
+    assert_equal(grid[-1], expected[-1])
+    assert_raises(IndexError, grid.__getitem__, 24)
+    assert_equal(list(ProductGrid([("a", [1]), ("b", [])])), [])
+
+    # Huge grids are not materialized
+    grid = ProductGrid([("a", range(10 ** 4)), ("b", range(10 ** 4))])
+    assert_equal(len(grid), 10 ** 8)
+    assert_equal(grid[10 ** 8 - 2], dict(a=9999, b=9998))
+
+    grid = ZipGrid([("a", [1, 2, 3]), ("b", "xyz")])
+    assert_equal(list(grid), [dict(a=1, b="x"), dict(a=2, b="y"),
+                              dict(a=3, b="z")])
+    assert_equal(len(ZipGrid([])), 0)
+    assert_raises(ValueError, ZipGrid, [("a", [1, 2]), ("b", [1])])
+
+    sample = SampledGrid(grid, n_samples=2, random_state=1)
+    assert_equal(len(sample), 2)
+    assert_equal(list(sample), list(SampledGrid(grid, 2, random_state=1)))
+    assert_equal(len(set(params["a"] for params in sample)), 2)
+    assert_equal(sorted(params["a"]
+                        for params in SampledGrid(grid, n_samples=3)),
+                 [1, 2, 3])
+    assert_raises(ValueError, SampledGrid, grid, n_samples=4)
+
+
+def test_pending():
+    grid = ProductGrid([("a", range(10)), ("b", range(3))])
+
+    with TemporaryDirectory() as temp_folder:
+        storage = op.join(op.abspath(temp_folder), "results.sqlite3")
+        sqlite3_dumps({"run 1 2": 1, "run 5 0": 1, "run 9 1": 1}, storage)
+
+        queued = set(["job-0-0", "job-5-0", "job-7-2"])
+        expected = [("job-%s-%s" % (a, b), "run %s %s" % (a, b))
+                    for a in range(10) for b in range(3)
+                    if (a, b) not in [(0, 0), (5, 0), (7, 2), (1, 2),
+                                      (9, 1)]]
+        for batch_size in [1, 7, 100]:
+            tasks = pending(grid, "job-%(a)s-%(b)s", "run %(a)s %(b)s",
+                            queued=queued, storage=storage,
+                            batch_size=batch_size)
+            assert_equal(list(tasks), expected)
+
+        # Keys and names can be given by functions
+        tasks = pending(grid, lambda params: "job-%(a)s-%(b)s" % params,
+                        "run %(a)s %(b)s", queued=[], storage=storage,
+                        key=lambda params: "run %(a)s %(b)s" % params)
+        assert_equal(len(list(tasks)), 27)
+
+        # Without storage, only the queued jobs are skipped
+        tasks = pending(grid, "job-%(a)s-%(b)s", "run %(a)s %(b)s",
+                        queued=queued)
+        assert_equal(len(list(tasks)), 27)
+
+        assert_raises(ValueError, list,
+                      pending(grid, "%(a)s", "%(b)s", queued=[],
+                              batch_size=0))
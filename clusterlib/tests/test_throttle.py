@@ -0,0 +1,100 @@
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+
+import os
+import threading
+import time
+
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from ..throttle import Semaphore
+from ..throttle import TokenBucket
+from .._testing import TemporaryDirectory
+
+
+def test_semaphore():
+    with TemporaryDirectory() as temp_folder:
+        fname = os.path.join(temp_folder, "throttle.sqlite3")
+        assert_raises(ValueError, Semaphore, fname, value=0)
+
+        first = Semaphore(fname, "io", value=2)
+        second = Semaphore(fname, "io", value=2)
+        third = Semaphore(fname, "io", value=2)
+        other = Semaphore(fname, "other", value=1)
+
+        assert_true(first.acquire())
+        assert_true(second.acquire(blocking=False))
+        assert_true(not third.acquire(blocking=False))
+        assert_true(not third.acquire(timeout=0.1))
+        assert_raises(RuntimeError, first.acquire)
+
+        # Semaphores are independent from each others
+        assert_true(other.acquire(blocking=False))
+        other.release()
+
+        first.release()
+        assert_raises(RuntimeError, first.release)
+        assert_raises(RuntimeError, first.renew)
+        assert_true(third.acquire(blocking=False))
+        assert_true(third.renew())
+        second.release()
+        third.release()
+
+        # Leases of crashed holders expire
+        crashed = Semaphore(fname, "lease", lease=0.1)
+        assert_true(crashed.acquire())
+        waiting = Semaphore(fname, "lease", lease=0.1, poll_interval=0.05)
+        assert_true(waiting.acquire(timeout=5))
+        assert_true(not crashed.renew())
+        waiting.release()
+
+
+def test_semaphore_concurrency(n_threads=6, value=2):
+    with TemporaryDirectory() as temp_folder:
+        fname = os.path.join(temp_folder, "throttle.sqlite3")
+
+        lock = threading.Lock()
+        holders = [0]
+        max_holders = [0]
+
+        def job():
+            with Semaphore(fname, value=value, poll_interval=0.01):
+                with lock:
+                    holders[0] += 1
+                    max_holders[0] = max(max_holders[0], holders[0])
+                time.sleep(0.05)
+                with lock:
+                    holders[0] -= 1
+
+        threads = [threading.Thread(target=job) for _ in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert_equal(holders[0], 0)
+        assert_true(1 <= max_holders[0] <= value)
+
+
+def test_token_bucket():
+    with TemporaryDirectory() as temp_folder:
+        fname = os.path.join(temp_folder, "throttle.sqlite3")
+        assert_raises(ValueError, TokenBucket, fname, rate=0)
+
+        bucket = TokenBucket(fname, "write", rate=20., capacity=2.)
+        assert_raises(ValueError, bucket.acquire, 3)
+
+        # A burst up to the capacity is allowed
+        assert_true(bucket.acquire(2, blocking=False))
+        assert_true(not bucket.acquire(blocking=False))
+        assert_true(not bucket.acquire(timeout=0.))
+
+        # Then the rate is limited
+        start = time.time()
+        for _ in range(4):
+            with TokenBucket(fname, "write", rate=20., capacity=2.):
+                pass
+        assert_true(time.time() - start >= 0.15)
@@ -0,0 +1,149 @@
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+
+from __future__ import unicode_literals
+
+from nose import SkipTest
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from .. import watcher
+from ..watcher import JobWatcher
+
+
+def _fake_job_states(answers, queried):
+    """Return a fake job_states giving the answers in turn.
+
+    An answer which is an exception is raised, as for a failed query.
+    """
+    answers = iter(answers)
+
+    def job_states(job_ids, backend="auto"):
+        queried.append(list(job_ids))
+        answer = next(answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+    return job_states
+
+
+# Written as a string to keep the module importable without async syntax
+_ASYNC_COLLECT = """
+async def collect(instance):
+    events = []
+    async for event in instance:
+        events.append(event)
+    return events
+"""
+
+
+def _check_events(answers, consume, **kwargs):
+    queried = []
+    old_job_states = watcher.job_states
+    watcher.job_states = _fake_job_states(answers, queried)
+    try:
+        instance = JobWatcher(["1", "2"], min_interval=0.001,
+                              max_interval=0.004, **kwargs)
+        received = []
+        instance.add_callback(received.append)
+        events = consume(instance)
+    finally:
+        watcher.job_states = old_job_states
+    assert_equal(events, received)
+    return instance, events, queried
+
+
+def test_job_watcher():
+    answers = [{},
+               {"1": "PENDING"},
+               {"1": "RUNNING", "2": "RUNNING"},
+               {"1": "RUNNING", "2": "RUNNING"},
+               {"1": "COMPLETED", "2": "RUNNING"},
+               {"2": "OUT_OF_MEMORY"}]
+    instance, events, queried = _check_events(answers, list)
+    assert_equal([(event.kind, event.job_id, event.state,
+                   event.previous_state) for event in events],
+                 [("started", "1", "RUNNING", "PENDING"),
+                  ("started", "2", "RUNNING", None),
+                  ("completed", "1", "COMPLETED", "RUNNING"),
+                  ("failed", "2", "OUT_OF_MEMORY", "RUNNING")])
+    # Only the jobs which have not ended are queried
+    assert_equal(queried[-1], ["2"])
+    assert_equal(instance.job_ids, [])
+    assert_equal(instance.poll(), [])
+
+    # Jobs unknown to the scheduler are lost after the grace period, but
+    # not while the scheduler can not be queried.
+    instance, events, queried = _check_events(
+        [RuntimeError("squeue failed"), {"1": "TIMEOUT"}], list, grace=0)
+    assert_equal([(event.kind, event.job_id) for event in events],
+                 [("timeout", "1"), ("lost", "2")])
+    assert_equal(len(queried), 2)
+
+    assert_raises(ValueError, instance.add_callback, len, ["unknown"])
+    assert_raises(ValueError, JobWatcher, min_interval=2, max_interval=1)
+
+
+def test_job_watcher_interval():
+    queried = []
+    old_job_states = watcher.job_states
+    watcher.job_states = _fake_job_states([{}, RuntimeError("failed"), {},
+                                           {"1": "RUNNING"}], queried)
+    try:
+        instance = JobWatcher(["1"], min_interval=1, max_interval=3)
+        instance.poll()
+        assert_equal(instance.interval, 2)
+        instance.poll()
+        instance.poll()
+        assert_equal(instance.interval, 3)
+        instance.poll()
+        assert_equal(instance.interval, 1)
+        instance.interval = 3
+        instance.add(["2"])
+        assert_equal(instance.interval, 1)
+        assert_equal(instance.job_ids, ["1", "2"])
+    finally:
+        watcher.job_states = old_job_states
+
+
+def test_job_watcher_async():
+    try:
+        import asyncio
+    except ImportError:
+        raise SkipTest("asyncio is required for this test.")
+
+    def consume(instance):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        events = []
+        try:
+            while True:
+                events.append(loop.run_until_complete(instance.__anext__()))
+        except StopAsyncIteration:
+            return events
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    _, events, _ = _check_events([{"1": "RUNNING"},
+                                  {"1": "CANCELLED", "2": "COMPLETED"}],
+                                 consume)
+    assert_equal([(event.kind, event.job_id) for event in events],
+                 [("started", "1"), ("cancelled", "1"), ("completed", "2")])
+
+
+def test_job_watcher_async_for():
+    try:
+        from asyncio import run
+        namespace = dict()
+        exec(_ASYNC_COLLECT, namespace)
+    except (ImportError, SyntaxError):
+        raise SkipTest("Python >= 3.7 is required for this test.")
+
+    _, events, _ = _check_events([{"1": "RUNNING", "2": "PENDING"},
+                                  {"1": "COMPLETED", "2": "TIMEOUT"}],
+                                 lambda instance: run(
+                                     namespace["collect"](instance)))
+    assert_equal([(event.kind, event.job_id) for event in events],
+                 [("started", "1"), ("completed", "1"), ("timeout", "2")])
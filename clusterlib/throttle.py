@@ -0,0 +1,351 @@
+"""
+This module allows to throttle jobs running on many nodes using a simple
+sqlite database stored on a shared file system.
+
+Main primitives covered are :
+    - a counting semaphore capping the number of jobs doing some heavy
+      operation at once, e.g. loading input data;
+    - a token bucket capping the rate at which jobs do some operation.
+
+Permits are leases: a job which crashed without releasing its permit
+does not hold it forever.
+
+"""
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+from __future__ import unicode_literals
+
+import os
+import random
+import socket
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+
+
+__all__ = [
+    "Semaphore",
+    "TokenBucket",
+]
+
+
+def _transaction(file_name, timeout):
+    """Open a connection which is in autocommit mode."""
+    return closing(sqlite3.connect(file_name, timeout=timeout,
+                                   isolation_level=None))
+
+
+def _wait(deadline, delay, max_delay):
+    """Sleep with jitter before the next try and return the next delay.
+
+    Return None if the deadline would be exceeded.
+    """
+    now = time.time()
+    if deadline is not None and now >= deadline:
+        return None
+
+    # The jitter avoids that jobs started together retry in lockstep
+    sleep_time = delay * random.uniform(0.5, 1.5)
+    if deadline is not None:
+        sleep_time = min(sleep_time, deadline - now)
+    time.sleep(sleep_time)
+    return min(2 * delay, max_delay)
+
+
+class Semaphore(object):
+    """Counting semaphore shared by jobs through a sqlite3 database.
+
+    Up to ``value`` holders can acquire the semaphore at once. Each permit is
+    a lease which expires after ``lease`` seconds, so that the permit of a
+    crashed job is eventually reclaimed. A holder which needs the permit for
+    longer should call :meth:`renew` regularly.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the sqlite database, which should be on a file system shared
+        by all the jobs.
+
+    name : str, optional (default="semaphore")
+        Name of the semaphore. Several semaphores can share a database.
+
+    value : int, optional (default=1)
+        Maximal number of concurrent holders.
+
+    lease : float, optional (default=3600.)
+        Duration of a permit in seconds.
+
+    poll_interval : float, optional (default=1.)
+        Initial delay in seconds between two tries to acquire the semaphore.
+        The delay is doubled at each try up to ``max_poll_interval``.
+
+    max_poll_interval : float, optional (default=60.)
+        Maximal delay in seconds between two tries.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock on the database to go away until raising an exception.
+
+    Examples
+    --------
+    Here, at most 2 jobs would load the input data at once.
+
+    >>> from tempfile import NamedTemporaryFile
+    >>> from clusterlib.throttle import Semaphore
+    >>> with NamedTemporaryFile() as fhandle:
+    ...     with Semaphore(fhandle.name, "io", value=2):
+    ...         pass  # load some data
+
+    """
+
+    def __init__(self, file_name, name="semaphore", value=1, lease=3600.,
+                 poll_interval=1., max_poll_interval=60., timeout=7200.0):
+        if value < 1:
+            raise ValueError("value should be at least 1, got %r" % value)
+        self.file_name = file_name
+        self.name = name
+        self.value = value
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.holder = None
+
+    def _try_acquire(self, holder):
+        """Try once to acquire a permit."""
+        with _transaction(self.file_name, self.timeout) as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS semaphore
+                                  (name TEXT, holder TEXT, expire REAL,
+                                   PRIMARY KEY (name, holder))""")
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                connection.execute("DELETE FROM semaphore "
+                                   "WHERE name = ? AND expire <= ?",
+                                   (self.name, now))
+                n_holders = connection.execute(
+                    "SELECT COUNT(*) FROM semaphore WHERE name = ?",
+                    (self.name, )).fetchone()[0]
+                acquired = n_holders < self.value
+                if acquired:
+                    connection.execute("INSERT INTO semaphore"
+                                       "(name, holder, expire) "
+                                       "VALUES (?, ?, ?)",
+                                       (self.name, holder, now + self.lease))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return acquired
+
+    def acquire(self, blocking=True, timeout=None):
+        """Acquire a permit of the semaphore.
+
+        Parameters
+        ----------
+        blocking : bool, optional (default=True)
+            Whether to wait until a permit is available.
+
+        timeout : float or None, optional (default=None)
+            Maximal number of seconds to wait if blocking. If None, wait
+            without limit.
+
+        Returns
+        -------
+        acquired : bool
+            Whether a permit was acquired.
+
+        """
+        if self.holder is not None:
+            raise RuntimeError("The semaphore is already acquired.")
+
+        holder = "%s:%s:%s" % (socket.gethostname(), os.getpid(),
+                               uuid.uuid4().hex)
+        deadline = None if timeout is None else time.time() + timeout
+        delay = self.poll_interval
+        while not self._try_acquire(holder):
+            if not blocking:
+                return False
+            delay = _wait(deadline, delay, self.max_poll_interval)
+            if delay is None:
+                return False
+
+        self.holder = holder
+        return True
+
+    def renew(self):
+        """Extend the lease of the permit by ``lease`` seconds.
+
+        Returns
+        -------
+        renewed : bool
+            Whether the permit was renewed. It is False if the lease has
+            already expired and the permit has been reclaimed.
+
+        """
+        if self.holder is None:
+            raise RuntimeError("The semaphore is not acquired.")
+
+        with _transaction(self.file_name, self.timeout) as connection:
+            cursor = connection.execute(
+                "UPDATE semaphore SET expire = ? "
+                "WHERE name = ? AND holder = ? AND expire > ?",
+                (time.time() + self.lease, self.name, self.holder,
+                 time.time()))
+            return cursor.rowcount == 1
+
+    def release(self):
+        """Release the permit of the semaphore."""
+        if self.holder is None:
+            raise RuntimeError("The semaphore is not acquired.")
+
+        with _transaction(self.file_name, self.timeout) as connection:
+            connection.execute("DELETE FROM semaphore "
+                               "WHERE name = ? AND holder = ?",
+                               (self.name, self.holder))
+        self.holder = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class TokenBucket(object):
+    """Token bucket shared by jobs through a sqlite3 database.
+
+    Tokens are added to the bucket at ``rate`` tokens per second, up to
+    ``capacity`` tokens. Acquiring tokens waits until enough tokens are
+    available, which caps the rate of an operation over all the jobs while
+    allowing bursts of at most ``capacity`` operations. Nothing needs to be
+    released, thus a crashed job never holds any token.
+
+    Note that the clocks of the nodes are assumed to be synchronized.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the sqlite database, which should be on a file system shared
+        by all the jobs.
+
+    name : str, optional (default="token_bucket")
+        Name of the bucket. Several buckets can share a database.
+
+    rate : float, optional (default=1.)
+        Number of tokens added per second.
+
+    capacity : float, optional (default=1.)
+        Maximal number of tokens in the bucket.
+
+    max_poll_interval : float, optional (default=60.)
+        Maximal delay in seconds between two tries to acquire tokens.
+
+    timeout : float, optional (default=7200.0)
+        The timeout parameter specifies how long the connection should wait
+        for the lock on the database to go away until raising an exception.
+
+    Examples
+    --------
+    Here, jobs would write at most 10 results per second.
+
+    >>> from tempfile import NamedTemporaryFile
+    >>> from clusterlib.throttle import TokenBucket
+    >>> with NamedTemporaryFile() as fhandle:
+    ...     with TokenBucket(fhandle.name, "write", rate=10., capacity=10.):
+    ...         pass  # write results
+
+    """
+
+    def __init__(self, file_name, name="token_bucket", rate=1., capacity=1.,
+                 max_poll_interval=60., timeout=7200.0):
+        if rate <= 0:
+            raise ValueError("rate should be positive, got %r" % rate)
+        self.file_name = file_name
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+
+    def _try_acquire(self, tokens):
+        """Try once to take tokens, return the seconds to wait if missing."""
+        with _transaction(self.file_name, self.timeout) as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS token_bucket
+                                  (name TEXT PRIMARY KEY, tokens REAL,
+                                   updated REAL)""")
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = connection.execute("SELECT tokens, updated "
+                                         "FROM token_bucket WHERE name = ?",
+                                         (self.name, )).fetchone()
+                if row is None:
+                    available = self.capacity
+                else:
+                    available = min(self.capacity,
+                                    row[0] + (now - row[1]) * self.rate)
+
+                missing = tokens - available
+                if missing <= 0:
+                    available -= tokens
+                connection.execute("INSERT OR REPLACE INTO token_bucket"
+                                   "(name, tokens, updated) VALUES (?, ?, ?)",
+                                   (self.name, available, now))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return max(missing, 0) / self.rate
+
+    def acquire(self, tokens=1., blocking=True, timeout=None):
+        """Take tokens from the bucket.
+
+        Parameters
+        ----------
+        tokens : float, optional (default=1.)
+            Number of tokens to take, at most ``capacity``.
+
+        blocking : bool, optional (default=True)
+            Whether to wait until enough tokens are available.
+
+        timeout : float or None, optional (default=None)
+            Maximal number of seconds to wait if blocking. If None, wait
+            without limit.
+
+        Returns
+        -------
+        acquired : bool
+            Whether the tokens were taken.
+
+        """
+        if tokens > self.capacity:
+            raise ValueError("Can not take %r tokens from a bucket of "
+                             "capacity %r." % (tokens, self.capacity))
+
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait_time = self._try_acquire(tokens)
+            if wait_time == 0:
+                return True
+            if not blocking:
+                return False
+
+            # Other jobs are competing for the tokens, thus some jitter is
+            # added to the expected waiting time.
+            wait_time = min(wait_time * random.uniform(1., 1.5),
+                            self.max_poll_interval)
+            if deadline is not None:
+                if time.time() + wait_time > deadline:
+                    return False
+            time.sleep(wait_time)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
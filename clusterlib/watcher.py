@@ -0,0 +1,272 @@
+"""
+This module allows to react to the start and the end of jobs.
+
+A :class:`JobWatcher` tracks a set of jobs given by their ids. The states of
+the jobs are queried with :func:`clusterlib.scheduler.job_states`, thus the
+cost of a query depends on the number of tracked jobs instead of the size
+of the queue, and the final state of the ended jobs comes from the
+accounting of the scheduler. The delay between two queries is short at
+first and grows while nothing changes.
+
+"""
+# Authors: Arnaud Joly
+#
+# License: BSD 3 clause
+from __future__ import unicode_literals
+
+import time
+from collections import deque
+from collections import namedtuple
+
+from .scheduler import _ACTIVE_STATES
+from .scheduler import job_states
+
+
+__all__ = [
+    "JobEvent",
+    "JobWatcher",
+]
+
+# Kind of event of the final states, the final states which are missing are
+# those of failed jobs, e.g. "OUT_OF_MEMORY" or "NODE_FAIL".
+_EVENT_KINDS = {
+    "COMPLETED": "completed",
+    "TIMEOUT": "timeout",
+    "CANCELLED": "cancelled",
+}
+
+_KINDS = ("started", "completed", "failed", "timeout", "cancelled", "lost")
+
+
+class JobEvent(namedtuple("JobEvent", ["kind", "job_id", "state",
+                                       "previous_state", "time"])):
+    """Change of the state of a job.
+
+    The kind of the event is one of "started", "completed", "failed",
+    "timeout", "cancelled" or "lost". A job is lost if it has left the
+    scheduler without any accounting, its state is then None. States are
+    given by their SLURM name, see :func:`clusterlib.scheduler.job_states`,
+    and the time is a timestamp.
+    """
+    __slots__ = ()
+
+
+class _Exhausted(Exception):
+    """No job is tracked anymore."""
+
+
+class JobWatcher(object):
+    """Track jobs and emit an event whenever they start or end.
+
+    Events are given to the callbacks, see :meth:`add_callback`, and can be
+    iterated, either synchronously with ``for event in watcher`` or
+    asynchronously with ``async for event in watcher``. The iteration stops
+    once all the tracked jobs have ended.
+
+    Parameters
+    ----------
+    job_ids : list of str, optional (default=())
+        Ids of the jobs to track.
+
+    backend : {'auto', 'slurm', 'sge', 'local'}, optional (default="auto")
+        Backend of the jobs, see :func:`clusterlib.scheduler.submit`.
+
+    min_interval : float, optional (default=5.)
+        Delay in seconds between two queries after a change.
+
+    max_interval : float, optional (default=300.)
+        Maximal delay in seconds between two queries.
+
+    backoff : float, optional (default=2.)
+        Factor of growth of the delay while nothing changes.
+
+    grace : float, optional (default=60.)
+        Number of seconds after its tracking starts during which a job
+        unknown to the scheduler is not considered lost.
+
+    Examples
+    --------
+    >>> from clusterlib.watcher import JobWatcher
+    >>> watcher = JobWatcher(["1234", "1235"])
+    >>> def notify(event):
+    ...     print("Job %s has %s" % (event.job_id, event.kind))
+    >>> watcher.add_callback(notify, kinds=["failed", "timeout"])
+    >>> for event in watcher:  # doctest: +SKIP
+    ...     print(event.kind, event.job_id)
+    started 1234
+    started 1235
+    completed 1234
+    Job 1235 has timeout
+    timeout 1235
+
+    """
+
+    def __init__(self, job_ids=(), backend="auto", min_interval=5.,
+                 max_interval=300., backoff=2., grace=60.):
+        if min_interval > max_interval:
+            raise ValueError("min_interval should be at most max_interval, "
+                             "got %r > %r" % (min_interval, max_interval))
+        self.backend = backend
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.grace = grace
+        self.interval = min_interval
+
+        # Last known state and start of the tracking of each job
+        self._jobs = {}
+        self._callbacks = []
+        self._events = deque()
+        self._next_poll = None
+        self.add(job_ids)
+
+    @property
+    def job_ids(self):
+        """Ids of the tracked jobs which have not ended."""
+        return sorted(self._jobs)
+
+    def add(self, job_ids):
+        """Track some more jobs.
+
+        The delay between two queries is reset to ``min_interval``.
+
+        Parameters
+        ----------
+        job_ids : list of str
+            Ids of the jobs.
+
+        """
+        now = time.time()
+        for job_id in job_ids:
+            self._jobs.setdefault(str(job_id), (None, now))
+        self.interval = self.min_interval
+        self._next_poll = now
+
+    def add_callback(self, callback, kinds=None):
+        """Call a function on each event.
+
+        Parameters
+        ----------
+        callback : callable
+            Function taking a :class:`JobEvent`.
+
+        kinds : list of str or None, optional (default=None)
+            Kinds of the events given to the callback. If None, all the
+            events are given.
+
+        """
+        if kinds is not None:
+            kinds = set(kinds)
+            unknown = kinds.difference(_KINDS)
+            if unknown:
+                raise ValueError("Unknown kinds of events: %s"
+                                 % ", ".join(sorted(unknown)))
+        self._callbacks.append((callback, kinds))
+
+    def _event(self, kind, job_id, state, previous_state, now):
+        event = JobEvent(kind, job_id, state, previous_state, now)
+        for callback, kinds in self._callbacks:
+            if kinds is None or kind in kinds:
+                callback(event)
+        return event
+
+    def poll(self):
+        """Query once the states of the tracked jobs.
+
+        If the scheduler can not be queried, the states of the jobs are left
+        unchanged, thus no event is emitted, and the next query is delayed.
+
+        Returns
+        -------
+        events : list of JobEvent
+            Events since the previous query, in the order of the job ids.
+            They have already been given to the callbacks.
+
+        """
+        if not self._jobs:
+            return []
+
+        try:
+            states = job_states(self.job_ids, backend=self.backend)
+        except RuntimeError:
+            # The scheduler is unavailable for now, the jobs are not lost
+            self._delay(time.time(), changed=False)
+            return []
+
+        now = time.time()
+        events = []
+        for job_id in self.job_ids:
+            previous_state, start_time = self._jobs[job_id]
+            state = states.get(job_id)
+
+            if state is None:
+                if now - start_time >= self.grace:
+                    del self._jobs[job_id]
+                    events.append(self._event("lost", job_id, None,
+                                              previous_state, now))
+                continue
+
+            if state in _ACTIVE_STATES:
+                self._jobs[job_id] = (state, start_time)
+                if state == "RUNNING" and previous_state != "RUNNING":
+                    events.append(self._event("started", job_id, state,
+                                              previous_state, now))
+            else:
+                del self._jobs[job_id]
+                events.append(self._event(_EVENT_KINDS.get(state, "failed"),
+                                          job_id, state, previous_state,
+                                          now))
+
+        self._delay(now, changed=bool(events))
+        return events
+
+    def _delay(self, now, changed):
+        """Schedule the next query."""
+        # Poll fast while the jobs change, slowly otherwise
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+        self._next_poll = now + self.interval
+
+    def _next_event(self):
+        """Wait for the next event, raise _Exhausted if there is none."""
+        while not self._events:
+            if not self._jobs:
+                raise _Exhausted()
+            delay = self._next_poll - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self._events.extend(self.poll())
+        return self._events.popleft()
+
+    def __iter__(self):
+        while True:
+            try:
+                event = self._next_event()
+            except _Exhausted:
+                return
+            yield event
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        # The queries and the waits are run in a thread so that the event
+        # loop is not blocked. This is written without the async syntax to
+        # keep the module importable by Python 2.
+        import asyncio
+
+        def next_event():
+            try:
+                return self._next_event()
+            except _Exhausted:
+                raise StopAsyncIteration()
+
+        try:
+            loop = asyncio.get_running_loop()
+        except (AttributeError, RuntimeError):
+            # Python < 3.7 or called outside of a coroutine
+            loop = asyncio.get_event_loop()
+        return loop.run_in_executor(None, next_event)